@@ -0,0 +1,210 @@
+"""AtasoPy コアロジックのベンチマーク
+
+合成データでload_csv / load_csv_parallel / compare_data / convert_df_bomの処理時間と
+ピークメモリを計測し、JSONのベースラインとの比較で性能劣化を検出する。
+
+pandasの文字列カラムはArrowのメモリに確保されてtracemallocでは見えないため、
+ピークメモリは工程ごとに新しいプロセスで実行し、tracemallocのピークと
+Arrowのメモリプールのピークの合計で計測する。
+
+使い方:
+    python benchmark.py --save baseline.json
+    python benchmark.py --sizes 10000 100000 1000000 10000000 --compare baseline.json
+    python benchmark.py --sizes 1000000 --cardinality 1000
+"""
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from compare_core import load_csv, load_csv_parallel, compare_data, convert_df_bom
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+# 劣化とみなす増加率（0.2 = ベースラインより20%以上遅い・大きい）
+DEFAULT_THRESHOLD = 0.2
+
+# 日本語テキスト列の生成に使う文字
+KANA = np.array(list('あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん'))
+
+
+def generate_frames(rows, cols=10, dup_ratio=0.1, overlap=0.5, text_width=10, seed=0, cardinality=None):
+    """比較用の2つのDataFrameを生成する
+
+    キーは乱数で引かず、重複の割合・共通するキーの割合が指定どおりになるように
+    決めてから行の順番だけをシャッフルする。
+
+    Args:
+        rows: 各ファイルの行数
+        cols: キーを含むカラム数
+        dup_ratio: キーが重複している行の割合（重複するキーは2行ずつ。cardinalityを指定しない場合に使う）
+        overlap: ファイル2のキーの種類のうちファイル1にも存在する割合
+        text_width: 日本語テキスト列の文字数
+        cardinality: キーの種類数（各キーをほぼ同じ行数ずつ使う）
+    """
+    rng = np.random.default_rng(seed)
+    if cardinality is None:
+        pairs = int(rows * dup_ratio) // 2
+        unique = rows - pairs * 2
+        codes = np.concatenate([np.arange(unique), unique + np.repeat(np.arange(pairs), 2)])
+        distinct = unique + pairs
+    else:
+        distinct = min(max(1, int(cardinality)), rows)
+        codes = np.resize(np.arange(distinct), rows)
+    pool = [''.join(rng.choice(KANA, text_width)) for _ in range(1000)]
+
+    def frame(keys):
+        data = {'宛名番号': pd.Series(keys[rng.permutation(codes)]).astype(str).str.zfill(10)}
+        for i in range(1, cols):
+            data[f'項目{i}'] = np.take(pool, rng.integers(0, len(pool), rows))
+        return pd.DataFrame(data)
+
+    # ファイル2のキーの種類のうちoverlapの割合はファイル1のキーから選び、残りは新しいキーにする
+    shared = int(distinct * overlap)
+    keys2 = np.concatenate([rng.choice(distinct, shared, replace=False), distinct + np.arange(distinct - shared)])
+    return frame(np.arange(distinct)), frame(rng.permutation(keys2))
+
+
+def peak_memory(func, *args):
+    """funcを1回実行し、実行中に増えたメモリのピークのバイト数を返す（新しいプロセスで呼ぶ）
+
+    Pythonのヒープ（NumPyを含む）のピークはtracemalloc、Arrowのメモリのピークは
+    メモリプールのmax_memory（プロセス開始からのピーク）で計測し、その合計を返す。
+    """
+    pool = pa.default_memory_pool()
+    arrow_before = pool.bytes_allocated()
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak + max(0, pool.max_memory() - arrow_before)
+
+
+def _peak_memory_from_file(func, args_path):
+    """一時ファイルに保存した引数でpeak_memoryを呼ぶ（新しいプロセスで実行）"""
+    with open(args_path, 'rb') as f:
+        args = pickle.load(f)
+    return peak_memory(func, *args)
+
+
+def measure(func, *args, repeat=1):
+    """funcの実行時間（repeat回の最小値）とピークメモリを計測する
+
+    tracemallocは実行時間に影響し、Arrowのメモリのピークは戻せないため、
+    メモリは新しいプロセスでの別の1回で計測する。
+
+    Returns:
+        (戻り値, 秒, ピークメモリのバイト数)
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    # 引数は一時ファイル経由で渡し、プロセス間の送信用に引数全体を複製しない
+    with tempfile.TemporaryDirectory() as tmp:
+        args_path = Path(tmp) / 'args.pickle'
+        with open(args_path, 'wb') as f:
+            pickle.dump(args, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            peak = executor.submit(_peak_memory_from_file, func, args_path).result()
+    return result, seconds, peak
+
+
+def run_scenario(rows, cols, dup_ratio, overlap, text_width, repeat=1, cardinality=None, workers=None):
+    """1つの条件でCSV読み込み（1プロセス・workersプロセスでの並列）・比較・CSV出力を計測する
+
+    Returns:
+        {工程名: {'seconds': 秒, 'peak_bytes': バイト数}}
+    """
+    df1, df2 = generate_frames(rows, cols, dup_ratio, overlap, text_width, cardinality=cardinality)
+    stages = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'file1.csv'
+        df1.to_csv(path, index=False)
+        (df1, _), seconds, peak = measure(load_csv, path, repeat=repeat)
+        stages['load_csv'] = {'seconds': seconds, 'peak_bytes': peak}
+        _, seconds, peak = measure(load_csv_parallel, path, workers or os.cpu_count(), repeat=repeat)
+        stages['load_csv_parallel'] = {'seconds': seconds, 'peak_bytes': peak}
+    result, seconds, peak = measure(compare_data, df1, df2, '宛名番号', '宛名番号', repeat=repeat)
+    stages['compare_data'] = {'seconds': seconds, 'peak_bytes': peak}
+    _, seconds, peak = measure(convert_df_bom, result['unique_data1'], repeat=repeat)
+    stages['convert_df_bom'] = {'seconds': seconds, 'peak_bytes': peak}
+    return stages
+
+
+def run(sizes, cols, dup_ratio, overlap, text_width, repeat=1, cardinality=None, workers=None):
+    """行数ごとに計測し、{シナリオ名: 計測結果} を返す"""
+    results = {}
+    for rows in sizes:
+        name = f'rows={rows},cols={cols},dup={dup_ratio},overlap={overlap},width={text_width}'
+        if cardinality is not None:
+            name += f',cardinality={cardinality}'
+        for stage, stats in run_scenario(rows, cols, dup_ratio, overlap, text_width, repeat, cardinality, workers).items():
+            results[f'{name}:{stage}'] = stats
+            print(f'{name}:{stage}\t{stats["seconds"]:.3f}s\t{stats["peak_bytes"] / 2 ** 20:.1f}MiB')
+    return results
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ベースラインよりthreshold以上遅い・メモリが多い項目を返す
+
+    Returns:
+        list of (シナリオ名, 指標名, ベースライン値, 今回の値)
+    """
+    regressions = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            if stats[metric] > baseline[name][metric] * (1 + threshold):
+                regressions.append((name, metric, baseline[name][metric], stats[metric]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='compare_coreのベンチマーク')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='行数（複数指定可）')
+    parser.add_argument('--cols', type=int, default=10, help='カラム数')
+    parser.add_argument('--dup-ratio', type=float, default=0.1, help='キーが重複している行の割合（重複するキーは2行ずつ）')
+    parser.add_argument('--cardinality', type=int, help='キーの種類数（指定すると--dup-ratioより優先）')
+    parser.add_argument('--overlap', type=float, default=0.5, help='ファイル2のキーの種類のうちファイル1にも存在する割合')
+    parser.add_argument('--text-width', type=int, default=10, help='日本語テキスト列の文字数')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='並列読み込みのプロセス数')
+    parser.add_argument('--repeat', type=int, default=1, help='処理時間の計測回数（最小値を採用）')
+    parser.add_argument('--save', help='計測結果をベースラインとして保存するJSONのパス')
+    parser.add_argument('--compare', help='比較するベースラインJSONのパス')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help='劣化とみなす増加率')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.cols, args.dup_ratio, args.overlap, args.text_width, args.repeat, args.cardinality, args.workers)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding='utf-8')
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        regressions = find_regressions(results, baseline, args.threshold)
+        for name, metric, before, after in regressions:
+            print(f'劣化: {name} {metric} {before:.3g} -> {after:.3g}', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
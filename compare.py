@@ -1,11 +1,339 @@
 import streamlit as st
 import os
+import hashlib
+import inspect
+import json
+import tempfile
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial, wraps
+from pathlib import Path
 from datetime import datetime
-from compare_core import load_csv, compare_data, convert_df_bom
+from compare_core import (
+    load_csv, read_csv_columns, load_key_column, load_key_index, iter_rows, compare_keys, convert_df_bom,
+    output_file_names, file_digest, load_csv_parallel, partition_rows, page_rows, duplicate_report,
+    normalize_key, start_profiling, stop_profiling, profiling, add_profile, stage, ResultCache,
+    EXPORT_FORMATS, write_export, write_zip, export_file_name,
+)
 
 # 現在の日時を取得してフォーマット
 current_time = datetime.now().strftime('%Y%m%d_%H%M%S')
 
+# 全セッションで共有するキャッシュの合計サイズの上限（超えた場合は最も古く使われたものから破棄）
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# アップロードできるファイルの拡張子（Parquet・Featherはキーのカラムだけを読んで比較する）
+INPUT_FILE_TYPES = ['csv', 'tsv', 'txt', 'parquet', 'feather']
+
+# 比較結果のプレビューの1ページの行数
+PREVIEW_PAGE_SIZE = 100
+
+# キーの正規化の選択肢（表示名: normalize_keyの名前）
+KEY_NORMALIZER_LABELS = {
+    '前後の空白を除去': 'strip',
+    '全角・半角をそろえる（NFKC）': 'nfkc',
+    '大文字・小文字をそろえる': 'casefold',
+    '先頭の0を除去': 'lstrip0',
+    '0埋めで桁数をそろえる': 'zfill',
+}
+
+# バックグラウンドのジョブの完了を待つ秒数（短い処理は進み具合を表示せずに結果を使う）
+JOB_POLL_SECONDS = 0.5
+
+# ダウンロード形式の選択肢（表示名: write_exportの形式）
+EXPORT_FORMAT_LABELS = {
+    'CSV（BOM付きUTF-8）': 'csv',
+    'CSV（gzip圧縮）': 'csv.gz',
+    'CSV（zstd圧縮）': 'csv.zst',
+    'Parquet': 'parquet',
+}
+
+# ダウンロードするファイルをメモリ上に作る上限のバイト数（超えたら一時ファイルに書き出す）
+EXPORT_SPOOL_BYTES = 64 * 1024 * 1024
+
+# ローカルファイルのキー索引の保存先（同じマスターファイルとの比較を繰り返す場合に再利用）
+KEY_INDEX_DIR = Path.home() / '.atasopy' / 'key_index'
+
+
+def content_digest(data):
+    """入力内容（文字列またはバイト列）のSHA-256ダイジェストを返す"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def input_source(data):
+    """直接入力の文字列またはアップロードファイルから (読み込み元, ダイジェスト) を返す
+
+    アップロードファイルのダイジェストはfile_idごとにsession_stateへ保存し、
+    UI操作やジョブの完了待ちの再実行のたびに内容全体をハッシュし直さない。
+    """
+    if isinstance(data, str):
+        return data, content_digest(data)
+    digests = st.session_state.setdefault('upload_digests', {})
+    if data.file_id not in digests:
+        digests[data.file_id] = content_digest(data.getvalue())
+    return data.getvalue(), digests[data.file_id]
+
+
+@st.cache_resource
+def shared_cache():
+    """読み込み・比較結果のキャッシュ（プロセス全体で1つ、全セッションで共有）"""
+    return ResultCache(CACHE_MAX_BYTES)
+
+
+def _cache_key_value(value):
+    """キャッシュのキーに使えるよう、リスト（複合キーのカラム等）をタプルにする"""
+    if isinstance(value, list):
+        return tuple(_cache_key_value(v) for v in value)
+    return value
+
+
+def shared_cached(func):
+    """関数の結果を共有キャッシュに保存するデコレーター
+
+    st.cache_resourceと同じく、_で始まる引数はキーに含めない。キーは関数名と
+    入力内容のダイジェスト等なので、同じファイルを別のユーザーがアップロードしても
+    読み込み直さず、内容の違うファイルの結果が返ることはない。
+    """
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        key = (func.__name__,) + tuple(
+            (name, _cache_key_value(value)) for name, value in arguments.items() if not name.startswith('_')
+        )
+        return shared_cache().get_or_compute(key, partial(func, *args, **kwargs))
+
+    return wrapper
+
+
+# 読み込み・比較結果は内容のダイジェストをキーにキャッシュし、
+# プレビュー切り替え等のUI操作だけの再実行や、同じ参照ファイルを
+# 別のセッションでアップロードした場合には再計算しない。
+# 返り値はキャッシュと共有されるため読み取り専用として扱う。
+@shared_cached
+def cached_read_csv_columns(digest, _source):
+    """ダイジェストをキーにヘッダー行（カラム名）をキャッシュする"""
+    return read_csv_columns(_source)
+
+
+@shared_cached
+def cached_load_key_column(digest, column, _source, _progress=None):
+    """ダイジェストとカラム名をキーにキーカラムの読み込み結果をキャッシュする"""
+    return load_key_column(_source, column, _progress)
+
+
+@shared_cached
+def cached_load_key_index(digest, column, _source, _progress=None):
+    """ローカルファイルのキー索引をディスクから開く（無ければ作成する）
+
+    索引はファイル内容のダイジェストで保存するため、パスや更新日時が
+    変わっても内容が同じなら再利用される。
+    """
+    return load_key_index(_source, column, file_digest(_source), KEY_INDEX_DIR, _progress)
+
+
+@shared_cached
+def cached_membership_masks(digest1, digest2, column1, column2, multiset, normalizers, _key1, _key2, _progress=None):
+    """入力のダイジェストとキーカラムをキーに比較結果のマスクをキャッシュする"""
+    return compare_keys(normalize_key(_key1, normalizers), normalize_key(_key2, normalizers), multiset=multiset)
+
+
+@shared_cached
+def cached_duplicate_report(digest1, digest2, column1, column2, normalizers, _key1, _key2, _progress=None):
+    """入力のダイジェストとキーカラムをキーに重複キーのレポートをキャッシュする"""
+    return duplicate_report(normalize_key(_key1, normalizers), normalize_key(_key2, normalizers), column1)
+
+
+@shared_cached
+def cached_load_csv(digest, _source, _progress=None):
+    """ダイジェストをキーに全カラムの読み込み結果をキャッシュする（比較結果のプレビュー用）"""
+    return load_csv_parallel(_source, workers=os.cpu_count(), progress=_progress)
+
+
+@shared_cached
+def cached_partition_rows(
+    digest1, digest2, column1, column2, multiset, normalizers, partition, search, sort_by, ascending,
+    _df, _mask, _column, _progress=None,
+):
+    """比較結果の分類・検索語・並べ替えをキーに、表示する行位置をキャッシュする
+
+    ページを切り替えるだけの再実行では検索・並べ替えをやり直さない。
+    """
+    return partition_rows(_df, _mask, _column, search, sort_by, ascending)
+
+
+@st.cache_resource
+def background_executor():
+    """重い処理をページの実行とは別に進めるスレッドプール（全セッションで共有）"""
+    return ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+class JobProgress:
+    """バックグラウンドのジョブの進み具合（ワーカーのスレッドから呼ばれて更新する）
+
+    進み具合を通知しない処理ではfractionはNoneのまま。
+    処理時間の計測中に始めたジョブは、終わるとreportに計測結果が入る。
+    """
+
+    def __init__(self):
+        self.fraction = None
+        self.report = None
+
+    def __call__(self, done, total):
+        self.fraction = min(done / total, 1.0) if total else 0.0
+
+
+# このページの実行で使ったジョブ名と、終わっていないジョブがあるか
+active_jobs = set()
+pending_jobs = False
+
+
+def profiled_job(func, args, progress, memory):
+    """funcを計測しながら実行し、計測結果をprogress.reportに入れる（ワーカーのスレッドで実行）
+
+    計測状態はスレッドごとに持つため、ページの計測とは別のレポートに記録する。
+    """
+    with profiling(memory) as report:
+        try:
+            return func(*args, progress)
+        finally:
+            progress.report = report
+
+
+def run_in_background(name, container, label, func, *args):
+    """funcをバックグラウンドのスレッドで実行し、終わっていれば結果を返す
+
+    funcはキャッシュ付きの関数で、最後の引数に進み具合の通知先（JobProgress）を受け取る。
+    ジョブはsession_stateにnameをキーとして保存するので、実行中にウィジェットを
+    操作してページが再実行されても、同じnameのジョブは中断・やり直しをしない。
+    終わっていない場合は進み具合（通知しない処理では実行中の表示）を出してNoneを返し、
+    ページ末尾で再実行する。ジョブの計測結果は、結果を受け取った実行の現在の工程の下に追記する。
+    失敗したジョブは例外を表示したあと破棄し、次の実行でやり直す。
+    """
+    global pending_jobs
+    jobs = st.session_state.setdefault('background_jobs', {})
+    active_jobs.add(name)
+    if name not in jobs:
+        progress = JobProgress()
+        if profile_report is None:
+            future = background_executor().submit(func, *args, progress)
+        else:
+            future = background_executor().submit(
+                profiled_job, func, args, progress, st.session_state.get('profile_memory', False),
+            )
+        jobs[name] = (future, progress)
+    future, progress = jobs[name]
+    if not wait([future], timeout=JOB_POLL_SECONDS).done:
+        if progress.fraction is None:
+            container.status(label, state='running')
+        else:
+            container.progress(progress.fraction, text=f'{label}（{progress.fraction:.0%}）')
+        pending_jobs = True
+        return None
+    if progress.report is not None:
+        add_profile(progress.report)
+        progress.report = None
+    if future.exception() is not None:
+        del jobs[name]
+    return future.result()
+
+
+def path_source(path):
+    """ローカルファイルのパスから (読み込み元, ダイジェスト) を返す
+
+    大きなファイルの内容をハッシュしないよう、パス・サイズ・更新日時から
+    ダイジェストを作る。ファイルが無い場合のダイジェストはNone。
+    """
+    path = Path(path.strip().strip('"'))
+    if not path.is_file():
+        return path, None
+    stat = path.stat()
+    # 入力内容のダイジェストと同じ値にならないよう、接頭辞で区別する
+    return path, 'path:' + content_digest(f'{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}')
+
+
+def spooled_export(write):
+    """write(出力先)で書き出した内容をバイト列で返す
+
+    書き出し中はEXPORT_SPOOL_BYTESを超えたら一時ファイルに移すので、
+    メモリに持つのは最後に読み出す出力（圧縮後）の1つ分だけになる。
+    """
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as f:
+        write(f)
+        f.seek(0)
+        return f.read()
+
+
+def download_export(source, mask, fmt):
+    """maskがTrueの行だけをチャンク単位で読みながらfmtの形式に変換する（ダウンロード時に実行）
+
+    ローカルファイルのパスの場合は、CPUコア数のプロセスで並列に読み込む。
+    """
+    rows = iter_rows(source, mask, workers=os.cpu_count())
+    return spooled_export(lambda f: write_export(rows, f, fmt))
+
+
+def download_zip(partitions, fmt):
+    """4つの比較結果を1つのZIPにまとめる（ダウンロード時に実行、結果は1つずつ読み込む）
+
+    partitionsは {ZIP内のファイル名: (読み込み元, マスク)}。
+    """
+    frames = {
+        name: partial(iter_rows, source, mask, workers=os.cpu_count())
+        for name, (source, mask) in partitions.items()
+    }
+    return spooled_export(lambda f: write_zip(frames, f, fmt))
+
+
+def key_count(column):
+    """キーカラムの数（複合キーならリストの長さ）"""
+    return len(column) if isinstance(column, list) else 1
+
+
+def select_key(container, label, source, digest, indexed=False):
+    """ヘッダーからキーカラムを選ばせ、そのカラムだけを読み込む
+
+    追加のカラムを選んだ場合は、選択順に並べたカラム名のリスト（複合キー）になる。
+    indexedがTrueで単一カラムの場合は、ディスクに保存したキー索引を使う。
+
+    キーカラムの読み込みはバックグラウンドで行い、終わるまではキーをNoneで返す。
+
+    Returns:
+        (キーカラム名またはそのリスト, Series・DataFrame・KeyIndex のいずれか, error_message)
+    """
+    columns, err = cached_read_csv_columns(digest, source)
+    if err:
+        return None, None, err
+    column = container.selectbox(f'{label}：比較のキーとなるカラム名を選択してください', columns)
+    extra_columns = container.multiselect(
+        f'{label}：複合キーとして追加するカラム（選択順）', [c for c in columns if c != column]
+    )
+    if extra_columns:
+        column = [column] + extra_columns
+    load = cached_load_key_index if indexed and not isinstance(column, list) else cached_load_key_column
+    with stage(f'load_key:{label}'):
+        result = run_in_background(
+            f'key:{digest}:{column}:{indexed}', container, f'{label}のキーカラムを読み込んでいます',
+            load, digest, column, source,
+        )
+    if result is None:
+        return column, None, None
+    key, err = result
+    return column, key, err
+
+# 処理時間の計測（ページ末尾のチェックボックスで有効にする）
+# 前回の実行が途中で止まっていても計測が残らないよう、先に終了させてから始める
+stop_profiling()
+profile_report = start_profiling(st.session_state.get('profile_memory', False)) if st.session_state.get('profile') else None
+# ジョブの完了待ちの再実行は、前回の実行の計測結果に続けて記録する
+polling_report = st.session_state.pop('polling_report', None)
+if profile_report is not None and polling_report:
+    profile_report.extend(polling_report)
+
 st.set_page_config(
     page_title="AtasoPy",
     layout="wide",
@@ -42,10 +370,15 @@ if os.name != 'nt':
 
 uploaded_file1 = None
 uploaded_file2 = None
+local_path1 = None
+local_path2 = None
 
 # チェックボックスで入力方法を選択
 direct_input = st.checkbox('ファイルを使用せず、直接入力する')
 
+# ローカル版ではアップロードせずにファイルパスを指定できる
+local_input = os.name == 'nt' and not direct_input and st.checkbox('ファイルパスを指定する（大きなファイル向け）')
+
 if direct_input:
     col1, col2 = st.columns(2)
     with col1:
@@ -53,77 +386,130 @@ if direct_input:
     with col2:
         paste_data2 = st.text_area('データ2を入力してください')
 
-    # データの読み込み
+    # データの読み込み（ヘッダーとキーカラムのみ）
     if paste_data1:
-        df1, err1 = load_csv(paste_data1)
+        source1, digest1 = input_source(paste_data1)
+        column1, key1, err1 = select_key(col1, 'データ1', source1, digest1)
         if err1:
             st.error(f'データ1の読み込みエラー\n\n{err1}')
-        else:
-            col1.info(f'データ1: {len(df1)}件')
+            key1 = None
+        elif key1 is not None:
+            col1.info(f'データ1: {len(key1)}件')
     else:
-        df1 = None
+        key1 = None
 
     if paste_data2:
-        df2, err2 = load_csv(paste_data2)
+        source2, digest2 = input_source(paste_data2)
+        column2, key2, err2 = select_key(col2, 'データ2', source2, digest2)
         if err2:
             st.error(f'データ2の読み込みエラー\n\n{err2}')
+            key2 = None
+        elif key2 is not None:
+            col2.info(f'データ2: {len(key2)}件')
+    else:
+        key2 = None
+
+elif local_input:
+    col1, col2 = st.columns(2)
+    with col1:
+        local_path1 = st.text_input('ファイル1のパスを入力してください')
+    with col2:
+        local_path2 = st.text_input('ファイル2のパスを入力してください')
+
+    # ファイルの読み込み（ヘッダーとキーカラムのみ）
+    if local_path1:
+        source1, digest1 = path_source(local_path1)
+        if digest1 is None:
+            st.error(f'ファイル1が見つかりません: {local_path1}')
+            key1 = None
+        else:
+            column1, key1, err1 = select_key(col1, 'ファイル1', source1, digest1, indexed=True)
+            if err1:
+                st.error(f'ファイル1の読み込みエラー\n\n{err1}')
+                key1 = None
+            elif key1 is not None:
+                col1.info(f'ファイル1: {len(key1)}件')
+    else:
+        key1 = None
+
+    if local_path2:
+        source2, digest2 = path_source(local_path2)
+        if digest2 is None:
+            st.error(f'ファイル2が見つかりません: {local_path2}')
+            key2 = None
         else:
-            col2.info(f'データ2: {len(df2)}件')
+            column2, key2, err2 = select_key(col2, 'ファイル2', source2, digest2, indexed=True)
+            if err2:
+                st.error(f'ファイル2の読み込みエラー\n\n{err2}')
+                key2 = None
+            elif key2 is not None:
+                col2.info(f'ファイル2: {len(key2)}件')
     else:
-        df2 = None
+        key2 = None
 
 else:
     col1, col2 = st.columns(2)
     with col1:
-        uploaded_file1 = st.file_uploader('ファイル1を選択してください', type=['csv', 'txt'])
+        uploaded_file1 = st.file_uploader('ファイル1を選択してください', type=INPUT_FILE_TYPES)
     with col2:
-        uploaded_file2 = st.file_uploader('ファイル2を選択してください', type=['csv', 'txt'])
+        uploaded_file2 = st.file_uploader('ファイル2を選択してください', type=INPUT_FILE_TYPES)
 
-    # ファイルの読み込み
+    # ファイルの読み込み（ヘッダーとキーカラムのみ）
     if uploaded_file1:
-        df1, err1 = load_csv(uploaded_file1)
+        source1, digest1 = input_source(uploaded_file1)
+        column1, key1, err1 = select_key(col1, 'ファイル1', source1, digest1)
         if err1:
             st.error(f'ファイル1の読み込みエラー\n\n{err1}')
-        else:
-            col1.info(f'ファイル1: {len(df1)}件')
+            key1 = None
+        elif key1 is not None:
+            col1.info(f'ファイル1: {len(key1)}件')
     else:
-        df1 = None
+        key1 = None
 
     if uploaded_file2:
-        df2, err2 = load_csv(uploaded_file2)
+        source2, digest2 = input_source(uploaded_file2)
+        column2, key2, err2 = select_key(col2, 'ファイル2', source2, digest2)
         if err2:
             st.error(f'ファイル2の読み込みエラー\n\n{err2}')
-        else:
-            col2.info(f'ファイル2: {len(df2)}件')
+            key2 = None
+        elif key2 is not None:
+            col2.info(f'ファイル2: {len(key2)}件')
     else:
-        df2 = None
+        key2 = None
 
-if df1 is not None and df2 is not None:
+if key1 is not None and key2 is not None:
 
     st.divider()
 
     # プレビュー件数を定義
     MAX_PREVIEW = 20
     preview = st.checkbox('データのプレビュー(最大' + str(MAX_PREVIEW) + '行)')
-
-    # カラム名選択
-    columns1 = df1.columns.tolist()
-    columns2 = df2.columns.tolist()
-
-    col1, col2 = st.columns(2)
-    with col1:
-        column1 = st.selectbox('ファイル1：比較のキーとなるカラム名を選択してください', columns1)
-    with col2:
-        column2 = st.selectbox('ファイル2：比較のキーとなるカラム名を選択してください', columns2)
-
-    if column1 and column2:
-
-        # データ比較
-        result = compare_data(df1, df2, column1, column2)
-        unique_data1 = result['unique_data1']
-        unique_data2 = result['unique_data2']
-        merge_data1 = result['merge_data1']
-        merge_data2 = result['merge_data2']
+    multiset = st.checkbox('同じキーの行を件数どおりに1対1で対応付ける（重複キーのレポートを表示）')
+
+    # キーの正規化（比較にだけ使い、ダウンロードする行の値は変えない）
+    normalizers = [
+        KEY_NORMALIZER_LABELS[label]
+        for label in st.multiselect('キーの正規化（選択順に適用）', list(KEY_NORMALIZER_LABELS))
+    ]
+    if 'zfill' in normalizers:
+        width = st.number_input('0埋めの桁数', min_value=1, value=10)
+        normalizers = [f'zfill:{width}' if name == 'zfill' else name for name in normalizers]
+    normalizers = tuple(normalizers)
+
+    # データ比較（キーカラムのみで判定し、全カラムは表示・ダウンロード時に読む）
+    masks = None
+    if key_count(column1) == key_count(column2):
+        with stage('membership_masks'):
+            masks = run_in_background(
+                f'masks:{digest1}:{digest2}:{column1}:{column2}:{multiset}:{normalizers}', st, 'キーを比較しています',
+                cached_membership_masks, digest1, digest2, column1, column2, multiset, normalizers, key1, key2,
+            )
+
+    if key_count(column1) != key_count(column2):
+        st.warning('ファイル1とファイル2でキーカラムの数をそろえてください')
+
+    elif column1 and column2 and masks is not None:
+        mask1, mask2 = masks
 
         # データフレームをHTMLに変換
         def dataframe_to_html(df):
@@ -152,64 +538,175 @@ if df1 is not None and df2 is not None:
         if preview:
             col1, col2 = st.columns(2)
 
-            with col1:
+            with col1, stage('render_preview1'):
                 st.write('CSVファイル1のデータ')
-                st.markdown(f"<div class='dataframe-container'>{dataframe_to_html(df1)}</div>", unsafe_allow_html=True)
+                head1, _ = load_csv(source1, nrows=MAX_PREVIEW)
+                st.markdown(f"<div class='dataframe-container'>{dataframe_to_html(head1)}</div>", unsafe_allow_html=True)
 
-            with col2:
+            with col2, stage('render_preview2'):
                 st.write('CSVファイル2のデータ')
-                st.markdown(f"<div class='dataframe-container'>{dataframe_to_html(df2)}</div>", unsafe_allow_html=True)
+                head2, _ = load_csv(source2, nrows=MAX_PREVIEW)
+                st.markdown(f"<div class='dataframe-container'>{dataframe_to_html(head2)}</div>", unsafe_allow_html=True)
 
 
 
         st.divider()
 
-        # CSVダウンロード
-        count_unique_data1 = len(unique_data1)
-        count_unique_data2 = len(unique_data2)
-        count_merge_data1 = len(merge_data1)
-        count_merge_data2 = len(merge_data2)
+        # 比較結果のダウンロード
+        count_unique_data1 = int((~mask1).sum())
+        count_unique_data2 = int((~mask2).sum())
+        count_merge_data1 = int(mask1.sum())
+        count_merge_data2 = int(mask2.sum())
 
-        csv1 = convert_df_bom(unique_data1)
-        csv2 = convert_df_bom(unique_data2)
-        mergeCsv1 = convert_df_bom(merge_data1)
-        mergeCsv2 = convert_df_bom(merge_data2)
+        # ダウンロードするファイルはボタン押下時にのみ、該当行だけを読み込んで生成する
+        export_format = EXPORT_FORMAT_LABELS[st.selectbox('ダウンロード形式', list(EXPORT_FORMAT_LABELS))]
+        export_mime = EXPORT_FORMATS[export_format][1]
+        csv1 = partial(download_export, source1, ~mask1, export_format)
+        csv2 = partial(download_export, source2, ~mask2, export_format)
+        mergeCsv1 = partial(download_export, source1, mask1, export_format)
+        mergeCsv2 = partial(download_export, source2, mask2, export_format)
 
         if uploaded_file1 and uploaded_file1.name:
             file_name1 = f"{os.path.splitext(uploaded_file1.name)[0]}"
+        elif local_path1:
+            file_name1 = Path(local_path1).stem
         else:
             file_name1 = "file1"
 
         if uploaded_file2 and uploaded_file2.name:
             file_name2 = f"{os.path.splitext(uploaded_file2.name)[0]}"
+        elif local_path2:
+            file_name2 = Path(local_path2).stem
         else:
             file_name2 = "file2"
 
+        file_names = {
+            key: export_file_name(name, export_format)
+            for key, name in output_file_names(file_name1, file_name2, current_time).items()
+        }
+
         # ダウンロードボタンを縦に並べる
         st.download_button(
             label=f"CSVファイル1のみに存在するデータをダウンロード({count_unique_data1}件)",
             data=csv1,
-            file_name= f"[only_exists]{file_name1}_{current_time}.csv",
-            mime='text/csv',
+            file_name=file_names['unique_data1'],
+            mime=export_mime,
         )
 
         st.download_button(
             label=f"CSVファイル2のみに存在するデータをダウンロード({count_unique_data2}件)",
             data=csv2,
-            file_name=f"[only_exists]{file_name2}_{current_time}.csv",
-            mime='text/csv',
+            file_name=file_names['unique_data2'],
+            mime=export_mime,
         )
 
         st.download_button(
             label=f"両CSVファイルに含まれるデータをファイル1のフォーマットでダウンロード({count_merge_data1}件)",
             data=mergeCsv1,
-            file_name=f"[merge_data]Format={file_name1}_{current_time}.csv",
-            mime='text/csv',
+            file_name=file_names['merge_data1'],
+            mime=export_mime,
         )
 
         st.download_button(
             label=f"両CSVファイルに含まれるデータをファイル2のフォーマットでダウンロード({count_merge_data2}件)",
             data=mergeCsv2,
-            file_name=f"[merge_data]Format={file_name2}_{current_time}.csv",
-            mime='text/csv',
+            file_name=file_names['merge_data2'],
+            mime=export_mime,
+        )
+
+        st.download_button(
+            label="4つの比較結果をまとめてZIPでダウンロード",
+            data=partial(download_zip, {
+                file_names['unique_data1']: (source1, ~mask1),
+                file_names['unique_data2']: (source2, ~mask2),
+                file_names['merge_data1']: (source1, mask1),
+                file_names['merge_data2']: (source2, mask2),
+            }, export_format),
+            file_name=f"[compare]{file_name1}_{file_name2}_{current_time}.zip",
+            mime='application/zip',
         )
+
+        # 重複キーのレポート（どちらかのファイルで同じキーが複数行あるもの）
+        if multiset:
+            with stage('duplicate_report'):
+                report = run_in_background(
+                    f'duplicates:{digest1}:{digest2}:{column1}:{column2}:{normalizers}', st, '重複しているキーを集計しています',
+                    cached_duplicate_report, digest1, digest2, column1, column2, normalizers, key1, key2,
+                )
+            if report is not None:
+                with st.expander(f'重複しているキー({len(report)}件)'):
+                    st.dataframe(report, hide_index=True)
+                    st.download_button(
+                        label=f"重複しているキーをダウンロード({len(report)}件)",
+                        data=convert_df_bom(report),
+                        file_name=f"[duplicates]{file_name1}_{file_name2}_{current_time}.csv",
+                        mime='text/csv',
+                    )
+
+        st.divider()
+
+        # 比較結果のプレビュー（全件を描画せず、表示するページの行だけを切り出す）
+        if st.checkbox('比較結果のプレビュー'):
+            partitions = {
+                f"CSVファイル1のみに存在するデータ({count_unique_data1}件)": ('unique_data1', source1, digest1, column1, ~mask1),
+                f"CSVファイル2のみに存在するデータ({count_unique_data2}件)": ('unique_data2', source2, digest2, column2, ~mask2),
+                f"両CSVファイルに含まれるデータ・ファイル1のフォーマット({count_merge_data1}件)": ('merge_data1', source1, digest1, column1, mask1),
+                f"両CSVファイルに含まれるデータ・ファイル2のフォーマット({count_merge_data2}件)": ('merge_data2', source2, digest2, column2, mask2),
+            }
+            partition, source, digest, column, mask = partitions[st.selectbox('表示する比較結果', list(partitions))]
+            with stage('load_partition_source'):
+                loaded = run_in_background(
+                    f'csv:{digest}', st, '全カラムを読み込んでいます', cached_load_csv, digest, source,
+                )
+            df, err = loaded if loaded is not None else (None, None)
+            if err:
+                st.error(f'読み込みエラー\n\n{err}')
+            elif df is not None:
+                col1, col2, col3 = st.columns(3)
+                search = col1.text_input('キーで検索（部分一致）')
+                sort_by = col2.selectbox('並べ替えるカラム', list(df.columns), index=None, placeholder='並べ替えなし')
+                descending = col3.checkbox('降順')
+                with stage('partition_rows'):
+                    rows = run_in_background(
+                        f'rows:{digest1}:{digest2}:{column1}:{column2}:{multiset}:{normalizers}:{partition}:{search}:{sort_by}:{descending}',
+                        st, '検索・並べ替えをしています',
+                        cached_partition_rows, digest1, digest2, column1, column2, multiset, normalizers, partition,
+                        search, sort_by, not descending, df, mask, column,
+                    )
+
+                if rows is not None:
+                    n_pages = max(1, -(-len(rows) // PREVIEW_PAGE_SIZE))
+                    # 分類・検索・並べ替えを変えたら1ページ目に戻す
+                    page = st.number_input(
+                        f'ページ（全{n_pages}ページ）', min_value=1, max_value=n_pages, value=1,
+                        key=f'page_{partition}_{search}_{sort_by}_{descending}',
+                    )
+                    start = (page - 1) * PREVIEW_PAGE_SIZE
+                    st.caption(f'{len(rows)}件中 {min(start + 1, len(rows))}〜{min(start + PREVIEW_PAGE_SIZE, len(rows))}件目')
+                    with stage('render_partition_page'):
+                        st.dataframe(page_rows(df, rows, page - 1, PREVIEW_PAGE_SIZE), hide_index=True)
+
+# 処理時間の計測結果（キャッシュから返した工程はその取得時間。ダウンロード時の処理は含まれない）
+st.divider()
+if st.checkbox('処理時間を計測する', key='profile'):
+    st.checkbox('ピークメモリも計測する（処理が遅くなります）', key='profile_memory')
+    stop_profiling()
+    with st.expander('処理時間の計測結果', expanded=True):
+        if profile_report:
+            st.dataframe(pd.DataFrame(profile_report), hide_index=True)
+            st.download_button(
+                label='計測結果をJSONでダウンロード',
+                data=json.dumps(profile_report, indent=2, ensure_ascii=False),
+                file_name=f'[profile]{current_time}.json',
+                mime='application/json',
+            )
+        else:
+            st.caption('計測する処理はありませんでした（次の操作から計測します）')
+
+# 終わっていないバックグラウンドのジョブがあれば、少し待ってから進み具合を更新する
+for name in set(st.session_state.get('background_jobs', {})) - active_jobs:
+    del st.session_state['background_jobs'][name]
+if pending_jobs:
+    st.session_state['polling_report'] = profile_report
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
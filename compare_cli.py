@@ -0,0 +1,292 @@
+"""AtasoPy コマンドライン版 - 複数のファイル組をまとめて比較する
+
+マニフェスト（JSON）に書かれたファイル組をプロセスプールで並列に比較し、
+ジョブごとにcompare.pyのダウンロードと同じ名前のBOM付きCSVを4つ出力する。
+
+マニフェストの例:
+    [
+        {"file1": "master.csv", "file2": "daily.csv", "column1": "宛名番号", "column2": "宛名番号"},
+        {"file1": "a.csv", "file2": "b.csv", "column1": ["口座番号", "支店コード"],
+         "column2": ["口座番号", "支店コード"], "output_dir": "out/ab", "multiset": true}
+    ]
+
+"normalizers": ["strip", "nfkc", "zfill:10"] のように指定すると、正規化したキーで比較する
+（compare_core.normalize_key。出力する行の値は変えない）。
+"multiset": true のジョブは同じキーの行を件数どおりに1対1で対応付け、
+重複しているキーのレポートも [duplicates]ファイル1_ファイル2_日時.csv に出力する。
+"sorted": true のジョブは、キーの昇順に並んだファイル同士としてチャンク単位で
+読みながら比較し（compare_core.compare_csv_sorted）、ファイルの大きさによらず
+一定のメモリで4つのCSVを出力する。"sorted": "auto" ならキーカラムだけを読んで
+昇順か確かめ、昇順でなければ通常の比較を行う（summaryの"sorted"に使った方法が入る）。
+multiset・normalizers・incrementalとは併用できず、出力形式はcsvのみ。
+"incremental": true のジョブは比較の状態を出力先の [state]ファイル1_ファイル2.npz に保存し、
+次回はファイル1に追記された行のキーだけを読んで比較し直す（summaryの"incremental"がtrue）。
+ファイル1の追記以外の変更（途中の行の挿入・削除・書き換え）や、ファイル2・キーカラム・
+normalizersの変更があれば全体を比較し直す。単一カラムのキーのみで、multisetとは併用できない。
+"format": "csv.gz" のように指定すると、4つの結果をその形式で出力する
+（csv, csv.gz, csv.zst, parquet。既定は --format の値）。
+ファイル名はファイル1・2それぞれの名前から作るため、同じファイル1を複数のファイル2と
+比較するジョブは "output_dir" を分けること。出力ファイルが先のジョブと重なるジョブは
+実行せず、エラーとしてsummaryに入る。
+
+使い方:
+    python compare_cli.py manifest.json --output-dir out --jobs 4 --summary summary.json --format csv.zst --profile
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+
+from compare_core import (
+    load_csv, compare_data, write_csv_bom, output_file_names, profiling, stage,
+    EXPORT_FORMATS, write_export, export_file_name, is_sorted_csv, compare_csv_sorted,
+    read_csv_columns, incremental_partition, iter_rows,
+)
+
+PARTITIONS = ['unique_data1', 'unique_data2', 'merge_data1', 'merge_data2']
+
+# マニフェストの各ジョブに必須のキー
+REQUIRED_KEYS = ['file1', 'file2', 'column1', 'column2']
+
+
+def check_job(job):
+    """マニフェストのジョブの形式を確かめ、不正ならValueErrorを送出する"""
+    if not isinstance(job, dict):
+        raise ValueError('マニフェストの各ジョブはJSONのオブジェクトで指定してください')
+    missing = [key for key in REQUIRED_KEYS if key not in job]
+    if missing:
+        raise ValueError(f"マニフェストのジョブに {', '.join(missing)} がありません")
+
+
+def output_paths(job, output_dir, timestamp, fmt='csv'):
+    """ジョブの出力先のパスを返す（4つの結果と、multisetなら重複キーのレポート）
+
+    ファイル名はcompare.pyのダウンロードと同じく、ファイル1・2の名前と日時から作る。
+    """
+    fmt = job.get('format', fmt)
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不明な出力形式です: {fmt}")
+    out = Path(job.get('output_dir', output_dir))
+    stem1, stem2 = Path(job['file1']).stem, Path(job['file2']).stem
+    file_names = output_file_names(stem1, stem2, timestamp)
+    paths = {key: out / export_file_name(file_names[key], fmt) for key in PARTITIONS}
+    if job.get('multiset'):
+        paths['duplicates'] = out / f"[duplicates]{stem1}_{stem2}_{timestamp}.csv"
+    if job.get('incremental'):
+        paths['state'] = out / f"[state]{stem1}_{stem2}.npz"
+    return paths
+
+
+def run_job(job, output_dir, timestamp, profile=False, fmt='csv'):
+    """1つのファイル組を比較し、4つの結果をfmt（ジョブの"format"が優先）の形式で書き出す
+
+    profileがTrueなら、工程ごとの処理時間（compare_core.profiling）を'profile'に入れる。
+
+    Returns:
+        dict: ジョブ名、成否、エラーメッセージ、処理時間、件数
+    """
+    start = time.perf_counter()
+    summary = {'file1': None, 'file2': None, 'error': None}
+    if isinstance(job, dict):
+        summary.update(file1=str(job.get('file1')), file2=str(job.get('file2')))
+    with profiling() if profile else nullcontext() as report:
+        _run_job(job, output_dir, timestamp, summary, fmt)
+    if profile:
+        summary['profile'] = report
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def _run_job(job, output_dir, timestamp, summary, fmt='csv'):
+    """run_jobの本体。件数・エラーをsummaryに書き込む"""
+    try:
+        check_job(job)
+        paths = output_paths(job, output_dir, timestamp, fmt)
+        fmt = job.get('format', fmt)
+        if _use_sorted(job, fmt):
+            summary['sorted'] = True
+            _run_sorted_job(job, paths, summary)
+            return
+        if 'sorted' in job:
+            summary['sorted'] = False
+        if job.get('incremental'):
+            _run_incremental_job(job, paths, summary, fmt)
+            return
+        df1, err = load_csv(Path(job['file1']))
+        if err:
+            raise ValueError(f"ファイル1の読み込みエラー: {err}")
+        df2, err = load_csv(Path(job['file2']))
+        if err:
+            raise ValueError(f"ファイル2の読み込みエラー: {err}")
+        result = compare_data(
+            df1, df2, job['column1'], job['column2'], multiset=job.get('multiset', False),
+            normalizers=job.get('normalizers'),
+        )
+
+        paths['unique_data1'].parent.mkdir(parents=True, exist_ok=True)
+        with stage('write_csv'):
+            for key in PARTITIONS:
+                write_export(result[key], paths[key], fmt)
+            if 'duplicates' in result:
+                write_csv_bom(result['duplicates'], paths['duplicates'])
+                summary['duplicates'] = len(result['duplicates'])
+
+        summary['rows1'] = len(df1)
+        summary['rows2'] = len(df2)
+        summary.update({key: len(result[key]) for key in PARTITIONS})
+    except KeyError as e:
+        summary['error'] = f"カラムが見つかりません: {e}"
+    except (OSError, ValueError) as e:
+        summary['error'] = str(e)
+
+
+def _use_sorted(job, fmt):
+    """ジョブをキーの昇順を前提とした比較（compare_csv_sorted）で行うか"""
+    mode = job.get('sorted', False)
+    if not mode:
+        return False
+    if job.get('multiset') or job.get('normalizers') or job.get('incremental') or job.get('format', fmt) != 'csv':
+        raise ValueError('sortedはmultiset・normalizers・incremental・csv以外の出力形式と併用できません')
+    if mode == 'auto':
+        return (
+            is_sorted_csv(Path(job['file1']), job['column1'])
+            and is_sorted_csv(Path(job['file2']), job['column2'])
+        )
+    return True
+
+
+def _run_sorted_job(job, paths, summary):
+    """キーの昇順に並んだファイル組を、チャンク単位で読みながら比較して書き出す"""
+    paths['unique_data1'].parent.mkdir(parents=True, exist_ok=True)
+    counts, err = compare_csv_sorted(
+        Path(job['file1']), Path(job['file2']), job['column1'], job['column2'],
+        {key: paths[key] for key in PARTITIONS},
+    )
+    if err:
+        raise ValueError(err)
+    summary['rows1'] = counts['unique_data1'] + counts['merge_data1']
+    summary['rows2'] = counts['unique_data2'] + counts['merge_data2']
+    summary.update(counts)
+
+
+def _run_incremental_job(job, paths, summary, fmt):
+    """前回の比較状態を使い、ファイル1に追記された行だけでキーを比較し直して書き出す
+
+    比較は追記分だけで済むが、4つの結果は全行を読んで書き出す。
+    """
+    if job.get('multiset') or isinstance(job['column1'], list) or isinstance(job['column2'], list):
+        raise ValueError('incrementalは単一カラムのキーのみで、multisetと併用できません')
+    for name, column in (('file1', job['column1']), ('file2', job['column2'])):
+        columns, err = read_csv_columns(Path(job[name]))
+        if err:
+            raise ValueError(f"ファイル{name[-1]}の読み込みエラー: {err}")
+        if column not in columns:
+            raise KeyError(column)
+    result, err = incremental_partition(
+        Path(job['file1']), Path(job['file2']), job['column1'], job['column2'], paths['state'],
+        job.get('normalizers'),
+    )
+    if err:
+        raise ValueError(err)
+    state, summary['incremental'] = result
+    masks = {
+        'unique_data1': (job['file1'], ~state.mask1),
+        'unique_data2': (job['file2'], ~state.mask2),
+        'merge_data1': (job['file1'], state.mask1),
+        'merge_data2': (job['file2'], state.mask2),
+    }
+    with stage('write_csv'):
+        for key, (source, mask) in masks.items():
+            write_export(iter_rows(Path(source), mask), paths[key], fmt)
+    summary['rows1'] = len(state.mask1)
+    summary['rows2'] = len(state.mask2)
+    summary.update(state.counts())
+
+
+def find_output_conflicts(jobs, output_dir, timestamp, fmt='csv'):
+    """出力ファイルが先のジョブと重なるジョブを調べる
+
+    同じファイル1を複数のファイル2と比較するジョブを同じ出力先に書くと、
+    ファイル1側の結果のファイル名が同じになり、並列に上書きし合う。
+
+    Returns:
+        dict: {ジョブの位置: 重なる先のジョブの位置}（形式が不正なジョブは含めない）
+    """
+    owners = {}
+    conflicts = {}
+    for i, job in enumerate(jobs):
+        try:
+            check_job(job)
+            paths = [path.resolve() for path in output_paths(job, output_dir, timestamp, fmt).values()]
+        except ValueError:
+            # 不正なジョブはrun_jobでエラーになる
+            continue
+        clash = [owners[path] for path in paths if path in owners]
+        if clash:
+            conflicts[i] = clash[0]
+        else:
+            owners.update(dict.fromkeys(paths, i))
+    return conflicts
+
+
+def run_batch(jobs, output_dir, max_workers=None, timestamp=None, profile=False, fmt='csv'):
+    """ジョブをプロセスプールで並列に実行し、マニフェストの順に結果を返す
+
+    出力ファイルが先のジョブと重なるジョブは実行せず、エラーとして返す。
+    """
+    if timestamp is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    conflicts = find_output_conflicts(jobs, output_dir, timestamp, fmt)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            None if i in conflicts else executor.submit(run_job, job, output_dir, timestamp, profile, fmt)
+            for i, job in enumerate(jobs)
+        ]
+        summaries = []
+        for i, (job, future) in enumerate(zip(jobs, futures)):
+            if future is not None:
+                summaries.append(future.result())
+                continue
+            summaries.append({
+                'file1': str(job['file1']), 'file2': str(job['file2']), 'seconds': 0.0,
+                'error': f"出力ファイル名が{conflicts[i] + 1}番目のジョブと重なります"
+                         f"（ジョブごとにoutput_dirを分けてください）",
+            })
+        return summaries
+
+
+def format_summary(summaries):
+    """ジョブごとの処理時間と件数を表形式の文字列にする"""
+    lines = ['file1\tfile2\tseconds\t' + '\t'.join(PARTITIONS) + '\terror']
+    for s in summaries:
+        counts = '\t'.join(str(s.get(key, '')) for key in PARTITIONS)
+        lines.append(f"{s['file1']}\t{s['file2']}\t{s['seconds']}\t{counts}\t{s['error'] or ''}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CSVファイル比較ツール -AtasoPy- コマンドライン版')
+    parser.add_argument('manifest', help='比較するファイル組を書いたJSONのパス')
+    parser.add_argument('--output-dir', default='.', help='結果CSVの出力先（ジョブごとのoutput_dirが優先）')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='並列に実行するジョブ数')
+    parser.add_argument('--summary', help='ジョブごとの処理時間・件数を保存するJSONのパス')
+    parser.add_argument('--profile', action='store_true', help='工程ごとの処理時間をsummaryに含める')
+    parser.add_argument('--format', default='csv', choices=list(EXPORT_FORMATS), help='結果の出力形式')
+    args = parser.parse_args(argv)
+
+    jobs = json.loads(Path(args.manifest).read_text(encoding='utf-8'))
+    summaries = run_batch(jobs, args.output_dir, args.jobs, profile=args.profile, fmt=args.format)
+
+    print(format_summary(summaries))
+    if args.summary:
+        Path(args.summary).write_text(json.dumps(summaries, indent=2, ensure_ascii=False), encoding='utf-8')
+    return 1 if any(s['error'] for s in summaries) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,198 @@
 """AtasoPy コアロジック - Streamlit非依存の比較処理"""
+import codecs
+import gzip
+import hashlib
+import json
+import mmap
+import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from contextvars import ContextVar
+from itertools import chain, islice
+from functools import wraps
+import numpy as np
 import pandas as pd
-from io import StringIO
+from io import BufferedReader, BytesIO, RawIOBase, StringIO
+from pathlib import Path
+
+# ストリーミング比較で一度に読み込む行数
+STREAM_CHUNKSIZE = 100_000
+
+# キーカラムをpandasで読み直す場合に、一度に読み込む値の数（行数×列数）
+KEY_CHUNK_CELLS = 1_000_000
+
+# pd.read_csvが既定で欠損値とする文字列（pyarrowのCSVリーダーで同じ扱いにする）。
+# pandasの非公開モジュールから取れない場合に使う
+_DEFAULT_NA_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+]
+
+# 文字コード・区切り文字の判定に読むファイル先頭のバイト数
+SNIFF_SIZE = 64 * 1024
+
+# 並列読み込みで1つのワーカーに渡す範囲のおおよそのバイト数
+# （同時に読む範囲はワーカー数の2倍までなので、使うメモリはファイルの大きさによらない）
+PARALLEL_RANGE_BYTES = 16 * 1024 * 1024
+
+# 判定対象の区切り文字（ヘッダー行での出現数が同じなら先のものを優先）
+DELIMITERS = [',', '\t', ';', '|']
+
+# 入力ファイルのBOMと対応する文字コード
+_BOMS = [
+    (codecs.BOM_UTF8, 'utf-8'),
+    (codecs.BOM_UTF16_LE, 'utf-16-le'),
+    (codecs.BOM_UTF16_BE, 'utf-16-be'),
+]
+
+# BOM付きUTF-8出力の先頭に付けるバイト列
+BOM = '\ufeff'.encode('utf-8')
+
+# 比較結果の出力形式（write_exportのfmt）: (拡張子, MIMEタイプ)
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'csv.gz': ('.csv.gz', 'application/gzip'),
+    'csv.zst': ('.csv.zst', 'application/zstd'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+}
+
+
+# 処理時間の計測状態（start_profilingで設定する。Noneなら計測しない）
+# Streamlitのセッションごとのスレッドで混ざらないようContextVarで持つ
+_PROFILE = ContextVar('compare_core_profile', default=None)
+
+# tracemallocはプロセス全体で1つなので、ピークメモリを計測中の状態（セッション・スレッドごと）を
+# 登録し、最初の計測で開始・最後の計測の終了で停止する。ピークのリセットの前には
+# 全ての状態の工程に現在のピークを反映し、他の計測のリセットで値が欠けないようにする
+_MEMORY_LOCK = threading.Lock()
+_memory_states = []
+_memory_started = False
+
+
+def _fold_peak():
+    """現在のピークを、計測中の全ての状態の実行中の工程に反映する（_MEMORY_LOCKを取って呼ぶ）"""
+    _, peak = tracemalloc.get_traced_memory()
+    for state in _memory_states:
+        if state['peaks']:
+            state['peaks'][-1] = max(state['peaks'][-1], peak)
+
+
+def start_profiling(memory=False):
+    """以降のstage()・@profiledの工程の処理時間を計測し、結果を追記するレポート（list）を返す
+
+    レポートの各要素は {'stage': 'compare_data/match' のような工程名, 'seconds': 秒}。
+    memoryがTrueなら、工程開始時からのピークメモリの増分 'peak_bytes' も計測する
+    （tracemallocを使うため処理が遅くなり、プロセス内の他のスレッドの確保も含まれる）。
+    """
+    global _memory_started
+    stop_profiling()
+    report = []
+    state = {'report': report, 'path': [], 'memory': memory, 'peaks': []}
+    if memory:
+        with _MEMORY_LOCK:
+            if not _memory_states and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _memory_started = True
+            _memory_states.append(state)
+    _PROFILE.set(state)
+    return report
+
+
+def stop_profiling():
+    """計測を終了する（計測中でなければ何もしない）"""
+    global _memory_started
+    state = _PROFILE.get()
+    if state is not None and state['memory']:
+        with _MEMORY_LOCK:
+            _memory_states.remove(state)
+            if not _memory_states and _memory_started:
+                tracemalloc.stop()
+                _memory_started = False
+    _PROFILE.set(None)
+
+
+@contextmanager
+def profiling(memory=False):
+    """withの中の計測結果のレポートを返す（start_profiling / stop_profiling）"""
+    report = start_profiling(memory)
+    try:
+        yield report
+    finally:
+        stop_profiling()
+
+
+def add_profile(report):
+    """別のスレッドで計測したレポートを、現在の工程の下に追記する（計測中でなければ何もしない）"""
+    state = _PROFILE.get()
+    if state is None:
+        return
+    for entry in report:
+        state['report'].append({**entry, 'stage': '/'.join(state['path'] + [entry['stage']])})
+
+
+@contextmanager
+def stage(name):
+    """工程の処理時間を計測する。計測中でなければ何もしない
+
+    入れ子の工程は 'compare_data/match' のように親の工程名を付けて記録する。
+    """
+    state = _PROFILE.get()
+    if state is None:
+        yield
+        return
+    entry = {'stage': '/'.join(state['path'] + [name])}
+    state['report'].append(entry)
+    state['path'].append(name)
+    if state['memory']:
+        # ピークをリセットする前に、親の工程（他の計測の工程も含む）のピークを退避する
+        with _MEMORY_LOCK:
+            _fold_peak()
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            state['peaks'].append(current)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry['seconds'] = time.perf_counter() - start
+        if state['memory']:
+            with _MEMORY_LOCK:
+                peak = max(state['peaks'].pop(), tracemalloc.get_traced_memory()[1])
+                if state['peaks']:
+                    state['peaks'][-1] = max(state['peaks'][-1], peak)
+            entry['peak_bytes'] = peak - current
+        state['path'].pop()
+
+
+def profiled(name):
+    """関数全体をstage(name)で計測するデコレーター（計測中でなければそのまま呼ぶ）"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _PROFILE.get() is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def parse_csv_error_detail(e):
     """ParserErrorのメッセージから原因を日本語で説明する"""
+    if isinstance(e, UnicodeDecodeError):
+        return (
+            f"文字コードを判別できませんでした（{e.encoding}として読み込めません）\n\n"
+            f"UTF-8 / Shift_JIS(CP932) / UTF-16 のファイルを指定してください"
+        )
     msg = str(e)
     match = re.search(r'Expected (\d+) fields in line (\d+), saw (\d+)', msg)
     if match:
@@ -23,52 +210,1915 @@ def parse_csv_error_detail(e):
     return f"CSV読み込みエラー: {msg}"
 
 
-def load_csv(source, dtype=str):
-    """CSVを読み込む。文字列ならStringIOで、それ以外はそのまま渡す。
+def _rewind(source):
+    """ファイルオブジェクトなら先頭に戻す（パスはそのまま）"""
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+
+def _csv_input(source):
+    """read_csvに渡す入力を返す。文字列・バイト列はCSV本文としてStringIO/BytesIOで包む"""
+    if isinstance(source, str):
+        return StringIO(source)
+    if isinstance(source, bytes):
+        return BytesIO(source)
+    return _rewind(source)
+
+
+def _open_binary(source):
+    """CSV本文（文字列・バイト列）、バイナリのファイルオブジェクト、パスをバイナリで開く"""
+    if isinstance(source, str):
+        return BytesIO(source.encode('utf-8'))
+    if isinstance(source, bytes):
+        return BytesIO(source)
+    if hasattr(source, 'readinto'):
+        return nullcontext(_rewind(source))
+    return open(source, 'rb')
+
+
+def _detect_encoding(head):
+    """先頭のバイト列から文字コードを推定する
+
+    Returns:
+        (encoding, BOMのバイト列（無ければb''）)
+    """
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding, bom
+    # UTF-8/CP932のCSVにはNULバイトが無い。BOMなしのUTF-16では
+    # ASCII文字（区切り文字・改行・数字）の片側のバイトが0になる
+    if b'\x00' in head:
+        if head[1::2].count(0) >= head[0::2].count(0):
+            return 'utf-16-le', b''
+        return 'utf-16-be', b''
+    # 末尾で途切れたマルチバイト文字はエラーにしない（final=False）
+    for encoding in ('utf-8', 'cp932'):
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+            return encoding, b''
+        except UnicodeDecodeError:
+            pass
+    return 'utf-8', b''
+
+
+# 先頭がASCII文字だけのファイルの文字コード（_Utf8OrCp932Decoderで読む）
+UTF8_OR_CP932 = 'utf-8-or-cp932'
+
+_NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+
+class _Utf8OrCp932Decoder(codecs.IncrementalDecoder):
+    """先頭の数KBがASCII文字だけだったファイル用のデコーダー
+
+    ASCII文字はUTF-8とCP932で同じなので、ASCII以外の最初のバイト列がUTF-8として
+    読めるかで文字コードを決め、以降はその文字コードで読む。先頭だけで判定した
+    UTF-8を信じると、途中から日本語が始まるCP932のファイルが読めなくなるため。
+    """
+
+    def __init__(self, errors='strict'):
+        super().__init__(errors)
+        self.reset()
+
+    def reset(self):
+        self.decoder = None
+        self.pending = b''
+
+    def decode(self, input, final=False):
+        if self.decoder is not None:
+            return self.decoder.decode(input, final)
+        data = self.pending + bytes(input)
+        match = _NON_ASCII.search(data)
+        if match is None:
+            self.pending = b''
+            return data.decode('ascii')
+        start = match.start()
+        try:
+            text = codecs.getincrementaldecoder('utf-8')().decode(data[start:], final)
+        except UnicodeDecodeError:
+            encoding = 'cp932'
+        else:
+            if not text and not final:
+                # 最初の文字の途中で入力が途切れているので、次の入力と合わせて判定する
+                self.pending = data[start:]
+                return data[:start].decode('ascii')
+            encoding = 'utf-8'
+        self.pending = b''
+        self.decoder = codecs.getincrementaldecoder(encoding)(self.errors)
+        return data[:start].decode('ascii') + self.decoder.decode(data[start:], final)
+
+
+def _search_codec(name):
+    """UTF8_OR_CP932をPythonの文字コードとして登録する（pandas・pyarrowのCSVリーダーで使う）"""
+    if name != UTF8_OR_CP932.replace('-', '_'):
+        return None
+    return codecs.CodecInfo(
+        name=UTF8_OR_CP932,
+        encode=codecs.utf_8_encode,
+        decode=lambda data, errors='strict': (_Utf8OrCp932Decoder(errors).decode(data, True), len(data)),
+        incrementalencoder=codecs.getincrementalencoder('utf-8'),
+        incrementaldecoder=_Utf8OrCp932Decoder,
+    )
+
+
+codecs.register(_search_codec)
+
+
+def _detect_delimiter(text):
+    """ヘッダー行に最も多く含まれる区切り文字を返す（見つからなければカンマ）"""
+    header = text.split('\n', 1)[0]
+    counts = [header.count(d) for d in DELIMITERS]
+    if max(counts) == 0:
+        return ','
+    return DELIMITERS[counts.index(max(counts))]
+
+
+def sniff_csv(source, sample_size=SNIFF_SIZE):
+    """ファイル先頭の数KBだけを読み、文字コード・BOM・区切り文字を判定する
+
+    ファイル全体はデコードしないため、巨大なファイルでもすぐに終わる。
+    読んだ先頭がASCII文字だけで続きがある場合は、UTF-8かCP932かを
+    ASCII以外の文字が現れたところで決めるUTF8_OR_CP932にする。
+    文字列（CSV本文）の場合はUTF-8として扱い、区切り文字だけを判定する。
+
+    Returns:
+        dict with keys: encoding, bom, sep
+    """
+    if isinstance(source, str):
+        return {'encoding': 'utf-8', 'bom': b'', 'sep': _detect_delimiter(source[:sample_size])}
+    with _open_binary(source) as f:
+        head = f.read(sample_size)
+    encoding, bom = _detect_encoding(head)
+    if encoding == 'utf-8' and not bom and len(head) == sample_size and head.isascii():
+        encoding = UTF8_OR_CP932
+    text = codecs.getincrementaldecoder(encoding)(errors='ignore').decode(head[len(bom):])
+    return {'encoding': encoding, 'bom': bom, 'sep': _detect_delimiter(text)}
+
+
+def _read_csv(source, **kwargs):
+    """文字コード・区切り文字を判定してからpd.read_csvで読み込む"""
+    dialect = sniff_csv(source)
+    return pd.read_csv(_csv_input(source), encoding=dialect['encoding'], sep=dialect['sep'], **kwargs)
+
+
+def _read_csv_table(source, columns, include_columns=None, progress=None, invalid_row_handler=None):
+    """pyarrowのCSVリーダー（マルチスレッド）で、カラムの型をstringに固定してArrowのテーブルに読み込む
+
+    columnsはヘッダーのカラム名。include_columnsを指定すると、そのカラムだけを変換する
+    （区切りは全カラム解析するので、ヘッダーと列数の異なる行はpyarrow.ArrowInvalidになる）。
+    progressを指定すると、読み込みの進み具合を progress(読んだバイト数, 全体のバイト数) で通知する。
+    invalid_row_handlerを指定した場合は、列数の異なる行の行番号がわかるように1スレッドで読む。
+    """
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    try:
+        from pandas._libs.parsers import STR_NA_VALUES
+        na_values = sorted(STR_NA_VALUES)
+    except ImportError:
+        na_values = _DEFAULT_NA_VALUES
+
+    dialect = sniff_csv(source)
+    converted = columns if include_columns is None else include_columns
+    with _open_binary(source) as f:
+        return pa_csv.read_csv(
+            f if progress is None else BufferedReader(_PrefixedReader(b'', f, progress)),
+            read_options=pa_csv.ReadOptions(
+                column_names=columns, skip_rows=1, use_threads=invalid_row_handler is None,
+                encoding=dialect['encoding'],
+            ),
+            parse_options=pa_csv.ParseOptions(
+                delimiter=dialect['sep'], newlines_in_values=True, invalid_row_handler=invalid_row_handler,
+            ),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=include_columns,
+                column_types={column: pa.string() for column in converted},
+                null_values=na_values,
+                strings_can_be_null=True,
+            ),
+        )
+
+
+def _read_csv_pyarrow(source):
+    """pyarrowのCSVリーダー（マルチスレッド）で全カラムをArrowの文字列型として読み込む
+
+    pandasのengine='pyarrow'は型推論後に文字列へ変換するため先頭の0が落ちる。
+    ヘッダーからカラム名を取り、全カラムの型をstringに固定して読み込む。
+    """
+    import pyarrow as pa
+
+    table = _read_csv_table(source, _read_csv(source, nrows=0).columns.tolist())
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+
+# 列指向形式の入力（ファイル先頭のマジックバイト: 形式名）。FeatherはV2（Arrow IPCファイル形式）
+_COLUMNAR_MAGIC = {b'PAR1': 'parquet', b'ARROW1': 'feather'}
+
+
+def columnar_format(source):
+    """入力がParquet・Featherなら 'parquet' / 'feather' を、それ以外（CSV）ならNoneを返す
+
+    ファイル先頭のマジックバイトで判定するので、拡張子は問わない。文字列はCSV本文として扱う。
+    """
+    if isinstance(source, str):
+        return None
+    with _open_binary(source) as f:
+        head = f.read(max(map(len, _COLUMNAR_MAGIC)))
+    for magic, fmt in _COLUMNAR_MAGIC.items():
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def _columnar_fragment(source, fmt):
+    """Parquet・Featherの入力をpyarrowのフラグメントとして開く
+
+    フラグメントは読み込むカラムを指定でき（列の射影）、指定しないカラムの
+    データページは読まない。ローカルファイルはパスのまま開き、必要な部分だけを読む。
+    """
+    from pyarrow import BufferReader
+    from pyarrow import dataset as pa_ds
+    from pyarrow import fs as pa_fs
+
+    file_format = pa_ds.ParquetFileFormat() if fmt == 'parquet' else pa_ds.IpcFileFormat()
+    if isinstance(source, bytes):
+        return file_format.make_fragment(BufferReader(source))
+    if hasattr(source, 'read'):
+        return file_format.make_fragment(_rewind(source))
+    return file_format.make_fragment(str(source), filesystem=pa_fs.LocalFileSystem())
+
+
+def _columnar_columns(fragment):
+    """フラグメントのカラム名のリスト（pandasが保存したインデックスの列は除く）"""
+    return [name for name in fragment.physical_schema.names if not re.fullmatch(r'__index_level_\d+__', name)]
+
+
+def _nested_to_string(column):
+    """リスト・構造体・マップ等の入れ子のカラムを、値ごとのJSON文字列にする（nullはnull）"""
+    import pyarrow as pa
+
+    return pa.array(
+        [None if value is None else json.dumps(value, ensure_ascii=False, default=str) for value in column.to_pylist()],
+        type=pa.string(),
+    )
+
+
+def _arrow_to_frame(data):
+    """ArrowのテーブルまたはRecordBatchを、全カラムを文字列にしたDataFrameにする
+
+    CSVをdtype=strで読んだ場合と同じく、数値・日付等も文字列にし、nullはNaNにする。
+    文字列にキャストできない入れ子のカラム（リスト・構造体・マップ）はJSONの文字列にする。
+    """
+    import pyarrow as pa
+    from pyarrow import compute as pc
+
+    columns = [
+        column if pa.types.is_string(column.type) or pa.types.is_large_string(column.type)
+        else _nested_to_string(column) if pa.types.is_nested(column.type)
+        else pc.cast(column, pa.string())
+        for column in data.columns
+    ]
+    return pa.Table.from_arrays(columns, names=data.schema.names).to_pandas()
+
+
+def _columnar_error_detail(e, fmt):
+    """Parquet・Featherの読み込みエラーの表示用メッセージ"""
+    return f"{'Parquet' if fmt == 'parquet' else 'Feather'}読み込みエラー: {e}"
+
+
+def _load_columnar(source, fmt, columns=None, nrows=None, progress=None):
+    """Parquet・Featherから指定のカラムだけを読み込む（columnsがNoneなら全カラム）
+
+    progressを指定すると、読み込んだRecordBatchごとに progress(読んだ行数, 全体の行数) を呼ぶ。
 
     Returns:
         (DataFrame, None) on success
         (None, error_message) on failure
     """
+    from pyarrow import Table
+
     try:
-        if isinstance(source, str):
-            df = pd.read_csv(StringIO(source), dtype=dtype)
-        else:
-            df = pd.read_csv(source, dtype=dtype)
+        fragment = _columnar_fragment(source, fmt)
+        columns = _columnar_columns(fragment) if columns is None else columns
+        if nrows is not None:
+            return _arrow_to_frame(fragment.head(nrows, columns=columns)), None
+        total = fragment.count_rows() if progress is not None else 0
+        done = 0
+        batches = []
+        for batch in fragment.to_batches(columns=columns):
+            batches.append(batch)
+            if progress is not None:
+                done += batch.num_rows
+                progress(done, total)
+        table = Table.from_batches(batches) if batches else fragment.head(0, columns=columns)
+        return _arrow_to_frame(table), None
+    except (OSError, ValueError, NotImplementedError) as e:
+        # pyarrowの例外（ArrowInvalid等）はこれらのサブクラス
+        return None, _columnar_error_detail(e, fmt)
+
+
+@profiled('load_csv')
+def load_csv(source, dtype=str, nrows=None, engine=None):
+    """CSVを読み込む。文字列ならStringIO、バイト列ならBytesIOで、それ以外はそのまま渡す。
+
+    nrowsを指定した場合は先頭からその行数だけ読み込む（プレビュー用）。
+    engine='pyarrow'の場合はpyarrowのCSVリーダーで、全カラムをArrowの
+    文字列型として読み込む（dtypeは無視、nrows指定時は通常のエンジンを使う）。
+    pyarrowはヘッダーと列数の異なる行をすべてエラーにし行番号も返さないため、
+    その場合は通常のエンジンで読み直し、結果またはエラーメッセージを返す。
+    ParquetとFeatherのファイルも読み込める（全カラムを文字列にする。dtype・engineは無視）。
+
+    Returns:
+        (DataFrame, None) on success
+        (None, error_message) on failure
+    """
+    fmt = columnar_format(source)
+    if fmt:
+        return _load_columnar(source, fmt, nrows=nrows)
+    if engine == 'pyarrow' and nrows is None:
+        try:
+            return _read_csv_pyarrow(source), None
+        except (pd.errors.ParserError, ValueError):
+            # pyarrow.ArrowInvalidはValueErrorのサブクラス
+            pass
+
+    try:
+        df = _read_csv(source, dtype=dtype, nrows=nrows)
         return df, None
-    except pd.errors.ParserError as e:
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
         return None, parse_csv_error_detail(e)
 
 
-def compare_data(df1, df2, column1, column2):
+@profiled('read_csv_columns')
+def read_csv_columns(source):
+    """CSVのヘッダー行だけを読み込み、カラム名のリストを返す
+
+    Parquet・Featherの場合はスキーマのカラム名を返す（データは読まない）。
+
+    Returns:
+        (list of カラム名, None) on success
+        (None, error_message) on failure
+    """
+    fmt = columnar_format(source)
+    if fmt:
+        try:
+            return _columnar_columns(_columnar_fragment(source, fmt)), None
+        except (OSError, ValueError, NotImplementedError) as e:
+            return None, _columnar_error_detail(e, fmt)
+    try:
+        return _read_csv(source, nrows=0).columns.tolist(), None
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        return None, parse_csv_error_detail(e)
+
+
+class _PrefixedReader(RawIOBase):
+    """先頭にprefixのバイト列を付け足して読み出すバイナリストリーム
+
+    progressを指定すると、streamから読むたびに progress(読んだバイト数, 全体のバイト数) を呼ぶ。
+    """
+
+    def __init__(self, prefix, stream, progress=None):
+        self._streams = [BytesIO(prefix), stream]
+        self._progress = progress
+        if progress is not None:
+            self._done = stream.tell()
+            self._total = stream.seek(0, os.SEEK_END)
+            stream.seek(self._done)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._streams:
+            n = self._streams[0].readinto(buffer)
+            if n:
+                if self._progress is not None and len(self._streams) == 1:
+                    self._done += n
+                    self._progress(self._done, self._total)
+                return n
+            self._streams.pop(0)
+        return 0
+
+
+def compact_key(keys):
+    """キー列（Series、または複合キーのDataFrame）をArrowの文字列型で持つようにする
+
+    dtype=strで読んだ列はpandas 2まではPythonのstrオブジェクトの列（object型）で、
+    1件ごとにオブジェクトの分のメモリを使う。Arrowの文字列型は値を連続した
+    バッファに持つため、10桁のキーなら約1/4のメモリになる。値（先頭の0も含む）と
+    NaNはそのまま。pandas 3の'str'型（Arrow）や、文字列以外の値を含む列、
+    pyarrowが無い環境ではそのまま返す。
+    """
+    if isinstance(keys, pd.DataFrame):
+        return keys.apply(compact_key)
+    if keys.dtype != object or pd.api.types.infer_dtype(keys, skipna=True) not in ('string', 'empty'):
+        return keys
+    try:
+        return keys.astype(pd.StringDtype('pyarrow'))
+    except ImportError:
+        return keys
+
+
+@profiled('load_key_column')
+def load_key_column(source, column, progress=None):
+    """CSVからキーカラムだけを読み込む。
+
+    columnがカラム名のリスト（複合キー）の場合は、それらのカラムだけの
+    DataFrameを返す。progressを指定すると、読み込みの進み具合を
+    progress(読んだバイト数, 全体のバイト数) で通知する。
+    Parquet・Featherの場合はキーのカラムだけを読み（列の射影）、progressは行数で通知する。
+
+    pyarrowのCSVリーダーでキーのカラムだけを変換するため、列数の多いCSVでも
+    全カラムを読み込むより大幅に速く、メモリも少なくて済む。
+    ヘッダーより列の多い行があれば、その行まで通常の読み込みをやり直して
+    load_csvと同じエラーを返す。pyarrowが無い環境や、pyarrowで読めない場合は
+    pandasで全カラムを少しずつ読んでキーのカラムだけを残す。
+
+    Returns:
+        (Series または DataFrame, None) on success
+        (None, error_message) on failure
+    """
+    fmt = columnar_format(source)
+    if fmt:
+        df, err = _load_columnar(source, fmt, columns=_key_columns(column), progress=progress)
+        if err:
+            return None, err
+        return compact_key(df if isinstance(column, (list, tuple)) else df[column]), None
+
+    columns, err = read_csv_columns(source)
+    if err:
+        return None, err
+    keys = _key_columns(column)
+    try:
+        df = _read_key_columns_pyarrow(source, columns, keys, progress)
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        return None, parse_csv_error_detail(e)
+    except (ImportError, ValueError):
+        # pyarrowが無い、またはpyarrowで読めない（pyarrow.ArrowInvalidはValueErrorのサブクラス）
+        try:
+            df = _read_key_columns_chunked(source, keys, len(columns), progress)
+        except (pd.errors.ParserError, UnicodeDecodeError) as e:
+            return None, parse_csv_error_detail(e)
+
+    if isinstance(column, (list, tuple)):
+        return compact_key(df[list(column)]), None
+    return compact_key(df[column]), None
+
+
+def _read_key_columns_pyarrow(source, columns, keys, progress=None):
+    """pyarrowのCSVリーダーで、keysのカラムだけを読み込んだDataFrameを返す
+
+    pandasと同じく、ヘッダーより列の少ない行は足りないカラムを欠損値にする
+    （pyarrowでは読み飛ばし、その行だけpandasで読んで元の位置に戻す）。
+    列の多い行があれば読み込みを止め、その行までpandasで読み直して
+    load_csvと同じParserErrorを送出する。
+    """
+    wide = []
+    short = {}
+
+    def handle(row):
+        if row.actual_columns > row.expected_columns:
+            wide.append(row.number)
+            return 'error'
+        # row.numberはヘッダー行を1行目とした行番号（空行は数えない）
+        short[row.number - 2] = row.text
+        return 'skip'
+
+    try:
+        table = _read_csv_table(source, columns, include_columns=keys, progress=progress, invalid_row_handler=handle)
+    except ValueError:
+        if wide:
+            _read_csv(source, dtype=str, nrows=wide[0] - 1)
+        raise
+    df = table.to_pandas()
+    if short:
+        rows = pd.read_csv(
+            StringIO('\n'.join(short.values())),
+            sep=sniff_csv(source)['sep'], header=None, names=columns, dtype=str,
+        )[keys]
+        rows.index = list(short)
+        kept = np.ones(len(df) + len(rows), dtype=bool)
+        kept[rows.index] = False
+        df.index = np.flatnonzero(kept)
+        df = pd.concat([df, rows]).sort_index().reset_index(drop=True)
+    return df
+
+
+def _read_key_columns_chunked(source, columns, width, progress=None):
+    """pandasで全カラムを少しずつ読み、columnsのカラムだけを残したDataFrameを返す
+
+    usecolsを指定するとヘッダーより列の多い行がエラーにならないため、全カラムを読む。
+    1チャンクの値の数（行数×列数）をKEY_CHUNK_CELLSまでにして、列数の多いCSVでも
+    メモリを抑える。（pandasはチャンクの先頭の行の列数を検査しないため、
+    その行が列の多い行だった場合はエラーにならない）
+    """
+    dialect = sniff_csv(source)
+    with _open_binary(source) as f:
+        reader = pd.read_csv(
+            BufferedReader(_PrefixedReader(b'', f, progress)),
+            encoding=dialect['encoding'], sep=dialect['sep'], dtype=str,
+            chunksize=max(1, KEY_CHUNK_CELLS // width),
+        )
+        with reader:
+            chunks = [chunk[columns] for chunk in reader]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def iter_rows(source, mask, chunksize=STREAM_CHUNKSIZE, workers=1):
+    """maskがTrueの行だけを全カラムで、チャンク単位のDataFrameとして順に返すジェネレータ
+
+    maskはload_key_columnで読んだキーと同じ行順のbool配列。NaNは空文字列に置き換える。
+    対象外の行は全カラム分を保持せず、読み終わったチャンクも保持しない。
+    ローカルファイルのパスでworkersが2以上なら、load_csv_parallelと同じく
+    ファイルを分割して並列に読み込む（チャンクはPARALLEL_RANGE_BYTESごとの範囲）。
+    Parquet・FeatherはRecordBatch（最大chunksize行）ごとに全カラムを読む。
+
+    読み込みエラーはload_csv等と同じ表示用のメッセージのValueErrorとして送出する
+    （ダウンロード中に発生するため(None, error_message)では返せない）。
+    """
+    fmt = columnar_format(source)
+    try:
+        if fmt:
+            fragment = _columnar_fragment(source, fmt)
+            columns = _columnar_columns(fragment)
+            chunks = (_arrow_to_frame(batch) for batch in fragment.to_batches(columns=columns, batch_size=chunksize))
+            chunks = chain(chunks, [_arrow_to_frame(fragment.head(0, columns=columns))])
+        elif _can_parse_parallel(source, workers):
+            chunks = _iter_csv_parallel(source, workers)
+        else:
+            chunks = _read_csv(source, dtype=str, chunksize=chunksize)
+        offset = 0
+        for chunk in chunks:
+            # 並列読み込みのチャンクは0から番号が振られるので、ファイル全体での行番号にそろえる
+            chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+            yield chunk[mask[offset:offset + len(chunk)]].fillna('')
+            offset += len(chunk)
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        if fmt:
+            raise ValueError(_columnar_error_detail(e, fmt)) from e
+        raise ValueError(parse_csv_error_detail(e)) from e
+    except (OSError, ValueError, NotImplementedError) as e:
+        # pyarrowの例外（ArrowInvalid等）はこれらのサブクラス
+        if not fmt:
+            raise
+        raise ValueError(_columnar_error_detail(e, fmt)) from e
+
+
+@profiled('load_rows')
+def load_rows(source, mask, chunksize=STREAM_CHUNKSIZE, workers=1):
+    """maskがTrueの行だけを全カラムで読み込む（NaNは空文字列に置き換える）
+
+    iter_rowsのチャンクを1つのDataFrameにまとめる。
+    """
+    return pd.concat(iter_rows(source, mask, chunksize, workers))
+
+
+def _count_quotes(view, start, end):
+    """view[start:end]に含まれるダブルクォートの数"""
+    return int(np.count_nonzero(view[start:end] == ord('"')))
+
+
+def _next_line_start(data, view, pos, in_quotes):
+    """pos以降で、クォートの外にある改行の次の位置を返す（無ければ末尾）"""
+    while True:
+        newline = data.find(b'\n', pos)
+        if newline == -1:
+            return len(data)
+        if _count_quotes(view, pos, newline) % 2:
+            in_quotes = not in_quotes
+        if not in_quotes:
+            return newline + 1
+        pos = newline + 1
+
+
+def split_csv_ranges(path, n_chunks):
+    """CSVファイルをメモリマップし、行の途中で切らないようにn_chunks個のバイト範囲に分ける
+
+    クォート内の改行（"東京都\n新宿区" など）では分割しない。
+    ""によるエスケープはクォート数の偶奇を変えないのでそのまま扱える。
+    （UTF-8・CP932用。UTF-16は改行・クォートが1バイトでないため使えない）
+
+    Returns:
+        (ヘッダー行の終わりの位置, [(開始位置, 終了位置), ...])
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = np.frombuffer(data, dtype=np.uint8)
+        size = len(data)
+        header_end = _next_line_start(data, view, 0, False)
+        bounds = [header_end]
+        for k in range(1, n_chunks):
+            target = header_end + (size - header_end) * k // n_chunks
+            if target <= bounds[-1]:
+                continue
+            in_quotes = _count_quotes(view, bounds[-1], target) % 2 == 1
+            end = _next_line_start(data, view, target, in_quotes)
+            if end >= size:
+                break
+            bounds.append(end)
+        bounds.append(size)
+        # mmapを閉じる前にバッファの参照を外す
+        del view
+    return header_end, [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def _parse_csv_range(path, header_end, start, end, encoding, sep):
+    """ヘッダー行とstart〜endのバイト範囲をつなげて読み込む（並列読み込みのワーカー）"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        chunk = data[:header_end] + data[start:end]
+    return pd.read_csv(BytesIO(chunk), dtype=str, encoding=encoding, sep=sep)
+
+
+def _iter_csv_parallel(path, workers, progress=None):
+    """ローカルのCSVファイルを分割して並列に読み込み、DataFrameをファイル順に返す
+
+    ファイルをPARALLEL_RANGE_BYTESごとの範囲に分け、読み終わっていない範囲が
+    ワーカー数の2倍を超えないよう、1つ返すごとに次の範囲を渡す。
+    """
+    dialect = sniff_csv(path)
+    n_chunks = max(workers, -(-os.path.getsize(path) // PARALLEL_RANGE_BYTES))
+    header_end, ranges = split_csv_ranges(path, n_chunks)
+    if not ranges:
+        yield _read_csv(path, dtype=str)
+        return
+    remaining = iter(ranges)
+    with ProcessPoolExecutor(workers) as executor:
+        def submit(n):
+            for start, end in islice(remaining, n):
+                futures.append(executor.submit(
+                    _parse_csv_range, path, header_end, start, end, dialect['encoding'], dialect['sep'],
+                ))
+
+        futures = deque()
+        submit(2 * workers)
+        for i in range(1, len(ranges) + 1):
+            chunk = futures.popleft().result()
+            submit(1)
+            if progress:
+                progress(i, len(ranges))
+            yield chunk
+
+
+def _can_parse_parallel(source, workers):
+    """並列読み込みが使えるか（ローカルファイルのパスで、UTF-16以外、ヘッダー以外の行がある）"""
+    if workers <= 1 or isinstance(source, (str, bytes)) or hasattr(source, 'read'):
+        return False
+    if os.path.getsize(source) == 0 or columnar_format(source):
+        return False
+    return not sniff_csv(source)['encoding'].startswith('utf-16')
+
+
+@profiled('load_csv_parallel')
+def load_csv_parallel(path, workers=None, progress=None):
+    """ローカルのCSVファイルをメモリマップで行単位に分割し、複数プロセスで並列に読み込む
+
+    結果はload_csv(path)と同じ。UTF-16のファイルや1プロセスの場合はload_csvで読む。
+    progressを指定すると、並列に読む場合は progress(読んだ範囲の数, 範囲の数) で通知する。
+    エラー時の行番号は分割した範囲の中での番号になるため、通常の読み込みを
+    やり直してファイル全体での行番号のエラーメッセージを返す。
+
+    Returns:
+        (DataFrame, None) on success
+        (None, error_message) on failure
+    """
+    workers = workers or os.cpu_count()
+    if not _can_parse_parallel(path, workers):
+        return load_csv(path)
+    try:
+        return pd.concat(_iter_csv_parallel(path, workers, progress), ignore_index=True), None
+    except (pd.errors.ParserError, UnicodeDecodeError):
+        return load_csv(path)
+
+
+def _shared_codes(key1, key2):
+    """2つのキー列を連結して一度だけfactorizeし、共通のコード空間の整数コードを返す
+
+    NaN同士は同じコードになる。
+
+    Returns:
+        (codes1, codes2, コードの種類数)
+    """
+    n1 = len(key1)
+    codes, uniques = pd.factorize(
+        pd.concat([key1, key2], ignore_index=True), use_na_sentinel=False
+    )
+    return codes[:n1], codes[n1:], len(uniques)
+
+
+def membership_masks(key1, key2):
+    """2つのキー列を1回ずつハッシュし、相手側に存在するかのマスクを返す。
+
+    両方の列を連結して一度だけfactorizeし、共通のコード空間上で
+    存在フラグを引くことで、isinを4回呼ぶ場合のハッシュ計算を省く。
+    NaN同士は一致とみなす（Series.isinと同じ挙動）。
+
+    Returns:
+        (mask1, mask2): key1/key2 の各要素が相手側に存在するかの bool ndarray
+    """
+    codes1, codes2, n_codes = _shared_codes(key1, key2)
+
+    in2 = np.zeros(n_codes, dtype=bool)
+    in2[codes2] = True
+    in1 = np.zeros(n_codes, dtype=bool)
+    in1[codes1] = True
+    return in2[codes1], in1[codes2]
+
+
+def _key_columns(column):
+    """キーカラム指定（カラム名またはカラム名のリスト）をリストにそろえる"""
+    if isinstance(column, (list, tuple)):
+        return list(column)
+    return [column]
+
+
+def _same_values(a, b):
+    """2つの配列を要素ごとに比較する（NaN同士は等しいとみなす）"""
+    isna_a, isna_b = pd.isna(a), pd.isna(b)
+    # pd.NAとの==はboolにならないので、両方に値がある要素だけを比べる
+    same = isna_a & isna_b
+    both = ~isna_a & ~isna_b
+    same[both] = a[both] == b[both]
+    return same
+
+
+def composite_key_codes(keys1, keys2):
+    """複合キー（複数カラムのDataFrame）を行ごとの整数コードに変換する。
+
+    文字列連結ではなく、各カラムのハッシュを組み合わせた64bitの値を
+    キーとして使う。ハッシュ値が同じ行のキーが本当に同じかを
+    カラムごとにベクトル演算で検証し、衝突が見つかった場合だけ
+    groupbyによる厳密な採番に切り替える。
+
+    Returns:
+        (codes1, codes2): 同じキーなら同じ値になる ndarray
+    """
+    n1 = len(keys1)
+    keys = pd.concat(
+        [keys1.set_axis(range(keys1.shape[1]), axis=1), keys2.set_axis(range(keys2.shape[1]), axis=1)],
+        ignore_index=True,
+    )
+    hashes = pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+    # 各行を、同じハッシュ値を持つ最初の行（代表）と比較する
+    codes, uniques = pd.factorize(hashes)
+    first = np.empty(len(uniques), dtype=np.intp)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    representative = first[codes]
+    collision = not all(
+        _same_values(values, values[representative]).all()
+        for values in (keys[c].to_numpy() for c in keys.columns)
+    )
+    if collision:
+        codes = keys.groupby(list(keys.columns), dropna=False, sort=False).ngroup().to_numpy()
+    return codes[:n1], codes[n1:]
+
+
+def key_codes(keys1, keys2):
+    """キー（Series、複合キーのDataFrame、またはKeyIndex）を共通のコード空間の整数コードに変換する
+
+    Returns:
+        (codes1, codes2): 同じキーなら同じ値になる ndarray
+    """
+    if isinstance(keys1, KeyIndex) or isinstance(keys2, KeyIndex):
+        if not isinstance(keys1, KeyIndex):
+            keys1 = KeyIndex.from_series(keys1)
+        if not isinstance(keys2, KeyIndex):
+            keys2 = KeyIndex.from_series(keys2)
+        return _key_index_shared_codes(keys1, keys2)
+    if isinstance(keys1, pd.DataFrame):
+        if keys1.shape[1] != keys2.shape[1]:
+            raise ValueError('キーカラムの数が一致しません')
+        if keys1.shape[1] > 1:
+            return composite_key_codes(keys1, keys2)
+        keys1, keys2 = keys1.iloc[:, 0], keys2.iloc[:, 0]
+    codes1, codes2, _ = _shared_codes(keys1, keys2)
+    return codes1, codes2
+
+
+class KeyIndex:
+    """キー列の索引。重複を除いてソートしたキー（UTF-8のバイト列）と、各行のキー番号を持つ。
+
+    save()でディレクトリに保存し、load()ではメモリマップで開くため、
+    大きなマスターファイルでも再読み込み・再ハッシュなしで比較に使える。
+    （単一カラムのキーのみ。NaNのキーは行番号-1で表す）
+    """
+
+    def __init__(self, keys, codes, has_nan):
+        self.keys = keys
+        self.codes = codes
+        self.has_nan = has_nan
+
+    @classmethod
+    def from_series(cls, key):
+        """キー列のSeriesから索引を作る"""
+        isna = key.isna().to_numpy()
+        encoded = np.array(key[~isna].str.encode('utf-8').tolist(), dtype=bytes)
+        if len(encoded) == 0:
+            encoded = np.array([], dtype='S1')
+        keys, inverse = np.unique(encoded, return_inverse=True)
+        codes = np.full(len(key), -1, dtype=np.int64)
+        codes[~isna] = inverse
+        return cls(keys, codes, bool(isna.any()))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def save(self, directory):
+        """索引をディレクトリに保存する（既存の同名ディレクトリは置き換えない）"""
+        directory = Path(directory)
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=directory.parent))
+        np.save(tmp / 'keys.npy', self.keys)
+        np.save(tmp / 'codes.npy', self.codes)
+        (tmp / 'meta.json').write_text(json.dumps({'has_nan': self.has_nan}), encoding='utf-8')
+        try:
+            os.replace(tmp, directory)
+        except OSError:
+            # 別のプロセスが先に作成済み
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory):
+        """保存した索引をメモリマップで開く"""
+        directory = Path(directory)
+        meta = json.loads((directory / 'meta.json').read_text(encoding='utf-8'))
+        return cls(
+            np.load(directory / 'keys.npy', mmap_mode='r'),
+            np.load(directory / 'codes.npy', mmap_mode='r'),
+            meta['has_nan'],
+        )
+
+
+def key_index_masks(index1, index2):
+    """2つのKeyIndexを比較し、相手側に存在するかのマスクを返す
+
+    ソート済みのキー同士をsearchsortedで突き合わせるので、キーの文字列を
+    ハッシュし直さない。NaN同士は一致とみなす。
+    """
+    pos = np.searchsorted(index1.keys, index2.keys)
+    found = pos < len(index1.keys)
+    found[found] = index1.keys[pos[found]] == index2.keys[found]
+    nan_matched = index1.has_nan and index2.has_nan
+
+    # 末尾の要素はNaN（キー番号-1）用
+    in2 = np.zeros(len(index1.keys) + 1, dtype=bool)
+    in2[pos[found]] = True
+    in2[-1] = nan_matched
+    in1 = np.append(found, nan_matched)
+    return in2[index1.codes], in1[index2.codes]
+
+
+def _key_index_shared_codes(index1, index2):
+    """2つのKeyIndexの各行のキー番号を、共通のコード空間の整数コードにそろえる
+
+    index1のキー番号をそのまま使い、NaNはlen(index1.keys)、index2にだけある
+    キーはその後ろの番号にする。
+    """
+    n1 = len(index1.keys)
+    pos = np.searchsorted(index1.keys, index2.keys)
+    found = pos < n1
+    found[found] = index1.keys[pos[found]] == index2.keys[found]
+    map2 = np.append(np.where(found, pos, n1 + 1 + np.arange(len(index2.keys))), n1)
+    codes1 = np.where(np.asarray(index1.codes) < 0, n1, index1.codes)
+    return codes1, map2[index2.codes]
+
+
+def key_index_dir(index_dir, digest, column):
+    """ファイルのダイジェストとキーカラムから索引の保存先を返す"""
+    return Path(index_dir) / f"{digest}_{hashlib.sha256(column.encode('utf-8')).hexdigest()[:16]}"
+
+
+def file_digest(path, block_size=1 << 20, size=None):
+    """ファイル内容のSHA-256ダイジェストを、ブロック単位で読みながら計算する
+
+    sizeを指定した場合は先頭sizeバイトだけのダイジェスト（追記前の内容の確認用）。
+    """
+    digest = hashlib.sha256()
+    remaining = float('inf') if size is None else size
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            block = f.read(int(min(block_size, remaining)))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+@profiled('load_key_index')
+def load_key_index(source, column, digest, index_dir, progress=None):
+    """保存済みのキー索引を開く。無ければキーカラムを読み込んで作成・保存する
+
+    digestはファイル内容のダイジェスト（file_digest等）。内容が変われば別の索引になる。
+    progressは索引を作る場合のload_key_columnに渡す。
+
+    Returns:
+        (KeyIndex, None) on success
+        (None, error_message) on failure
+    """
+    directory = key_index_dir(index_dir, digest, column)
+    if (directory / 'meta.json').exists():
+        return KeyIndex.load(directory), None
+    key, err = load_key_column(source, column, progress)
+    if err:
+        return None, err
+    index = KeyIndex.from_series(key)
+    index.save(directory)
+    return index, None
+
+
+def estimate_nbytes(value):
+    """キャッシュする値のおおよそのメモリ使用量（バイト数）を返す
+
+    DataFrame・Series・ndarrayとそれらのタプル・リスト・辞書に対応する。
+    メモリマップで開いたKeyIndexの配列はファイルの内容なので数えない。
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.memmap):
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, KeyIndex):
+        return estimate_nbytes(value.keys) + estimate_nbytes(value.codes)
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+def _freeze(value):
+    """キャッシュで共有するndarrayを書き込み不可にする（タプル・リストの中も）"""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _freeze(v)
+
+
+class ResultCache:
+    """合計サイズ（estimate_nbytes）に上限のある、スレッド間で共有するLRUキャッシュ
+
+    上限を超えると最も長く使われていないものから破棄する。上限より大きい値は保存しない。
+    同じキーの計算が同時に要求された場合は1回だけ計算し、他はその結果を待つ。
+    キャッシュした値は要求したすべての呼び出し元で共有されるため、ndarrayは
+    書き込み不可にする（DataFrame・SeriesはCopy-on-Writeで元の値は変わらない）。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get_or_compute(self, key, func):
+        """keyの値があれば返し、無ければfunc()で計算して保存する"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = self._pending[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = func()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+        _freeze(value)
+        with self._lock:
+            self._put(key, value)
+            del self._pending[key]
+        future.set_result(value)
+        return value
+
+    def _put(self, key, value):
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# キーの正規化（normalize_keyのnormalizersに名前を指定した順に適用する）
+KEY_NORMALIZERS = {
+    'strip': lambda key: key.str.strip(),
+    'nfkc': lambda key: key.str.normalize('NFKC'),
+    'casefold': lambda key: key.str.casefold(),
+    # "000"は"0"にする
+    'lstrip0': lambda key: key.str.replace(r'^0+(?=.)', '', regex=True),
+}
+
+
+def _normalize_series(key, normalizers):
+    for name in normalizers:
+        if name.startswith('zfill:'):
+            key = key.str.zfill(int(name[len('zfill:'):]))
+        elif name in KEY_NORMALIZERS:
+            key = KEY_NORMALIZERS[name](key)
+        else:
+            raise ValueError(f'不明なキーの正規化: {name}')
+    return key
+
+
+def normalize_key(keys, normalizers):
+    """キー（Series、複合キーのDataFrame、またはKeyIndex）を正規化した比較用のキーを返す
+
+    normalizersはKEY_NORMALIZERSの名前、またはゼロ埋めの桁数を付けた'zfill:10'の
+    リストで、指定順に文字列メソッドでまとめて適用する。元のキーは変更しないので、
+    出力する行の値はそのまま残る。KeyIndexは重複を除いたキーだけを正規化する。
+    """
+    if not normalizers:
+        return keys
+    if isinstance(keys, KeyIndex):
+        uniques = pd.Series(np.asarray(keys.keys)).str.decode('utf-8')
+        normalized = KeyIndex.from_series(_normalize_series(uniques, normalizers))
+        return KeyIndex(normalized.keys, np.append(normalized.codes, -1)[keys.codes], keys.has_nan)
+    if isinstance(keys, pd.DataFrame):
+        return keys.apply(_normalize_series, normalizers=normalizers)
+    return _normalize_series(keys, normalizers)
+
+
+@profiled('compare_keys')
+def compare_keys(keys1, keys2, multiset=False):
+    """キー（Series、複合キーのDataFrame、またはKeyIndex）同士を比較し、相手側に存在するかのマスクを返す
+
+    multisetがTrueの場合は、同じキーの行を件数どおりに1対1で対応付ける（multiset_masks）。
+    """
+    if multiset:
+        return multiset_masks(keys1, keys2)
+    if isinstance(keys1, KeyIndex) or isinstance(keys2, KeyIndex):
+        if not isinstance(keys1, KeyIndex):
+            keys1 = KeyIndex.from_series(keys1)
+        if not isinstance(keys2, KeyIndex):
+            keys2 = KeyIndex.from_series(keys2)
+        return key_index_masks(keys1, keys2)
+    if isinstance(keys1, pd.DataFrame):
+        if keys1.shape[1] != keys2.shape[1]:
+            raise ValueError('キーカラムの数が一致しません')
+        if keys1.shape[1] > 1:
+            codes1, codes2 = composite_key_codes(keys1, keys2)
+            return membership_masks(pd.Series(codes1), pd.Series(codes2))
+        keys1, keys2 = keys1.iloc[:, 0], keys2.iloc[:, 0]
+    return membership_masks(keys1, keys2)
+
+
+class PartitionState:
+    """前回の比較結果（キーの番号・件数・マスク）を保持し、ファイル1の差分だけで更新する
+
+    ファイル1への行の追記・削除では、差分の行のキーだけを引き直し、
+    ファイル1での有無が変わったキーを持つファイル2の行だけマスクを書き換える。
+    （単一カラムのキーのみ。ファイル2は変わらないものとする）
+
+    ファイル2に無いキーは分類に影響しないので、まとめて番号n_codesで扱う。
+    """
+
+    def __init__(self, key1, key2):
+        codes, uniques = pd.factorize(pd.concat([key1, key2], ignore_index=True), use_na_sentinel=False)
+        n1 = len(key1)
+        self.uniques = pd.Index(uniques)
+        # 差分のキーを引くためのハッシュ表は初回の検索時に作られるので、先に作っておく
+        self.uniques.get_indexer(self.uniques[:1])
+        self.codes1 = codes[:n1]
+        n_codes = len(uniques)
+
+        # キーごとのファイル1の件数（末尾はファイル2に無いキー用）
+        self.count1 = np.bincount(self.codes1, minlength=n_codes + 1)
+        self.in2 = np.zeros(n_codes + 1, dtype=bool)
+        self.in2[codes[n1:]] = True
+
+        # ファイル2の行をキーの番号順に並べ、キーごとの行位置を引けるようにする
+        self.order2 = np.argsort(codes[n1:], kind='stable')
+        self.starts2 = np.searchsorted(codes[n1:][self.order2], np.arange(n_codes + 2))
+
+        self.mask1 = self.in2[self.codes1]
+        self.mask2 = (self.count1 > 0)[codes[n1:]]
+
+    def update(self, appended=None, deleted=None):
+        """ファイル1の行の削除・追記を反映する
+
+        Args:
+            appended: 末尾に追記された行のキー（Series）
+            deleted: 削除された行の位置（更新前のファイル1での行番号）
+
+        Returns:
+            ファイル1での有無が変わったキーを持つ、ファイル2の行位置の ndarray
+        """
+        changed = []
+        if deleted is not None and len(deleted):
+            deleted = np.asarray(deleted)
+            codes = self.codes1[deleted]
+            np.subtract.at(self.count1, codes, 1)
+            self.codes1 = np.delete(self.codes1, deleted)
+            self.mask1 = np.delete(self.mask1, deleted)
+            changed.append(codes)
+        if appended is not None and len(appended):
+            codes = self.uniques.get_indexer(appended)
+            codes[codes < 0] = len(self.uniques)
+            np.add.at(self.count1, codes, 1)
+            self.codes1 = np.concatenate([self.codes1, codes])
+            self.mask1 = np.concatenate([self.mask1, self.in2[codes]])
+            changed.append(codes)
+        if not changed:
+            return np.array([], dtype=np.intp)
+
+        # 件数が変わったキーのうち、ファイル2にあるものだけ対象
+        codes = np.unique(np.concatenate(changed))
+        codes = codes[self.in2[codes]]
+        rows = np.concatenate(
+            [self.order2[self.starts2[c]:self.starts2[c + 1]] for c in codes] or [np.array([], dtype=np.intp)]
+        )
+        present = np.repeat(self.count1[codes] > 0, np.diff(self.starts2)[codes])
+        flipped = self.mask2[rows] != present
+        self.mask2[rows] = present
+        return np.sort(rows[flipped])
+
+    def counts(self):
+        """4つの分類の件数"""
+        return {
+            'unique_data1': int((~self.mask1).sum()),
+            'unique_data2': int((~self.mask2).sum()),
+            'merge_data1': int(self.mask1.sum()),
+            'merge_data2': int(self.mask2.sum()),
+        }
+
+    # save()で保存する配列の属性
+    ARRAYS = ['codes1', 'count1', 'in2', 'order2', 'starts2', 'mask1', 'mask2']
+
+    def save(self, path, meta=None):
+        """状態を1つの.npzファイルに保存する（既存のファイルは置き換える）
+
+        キーはKeyIndexと同じくUTF-8のバイト列で保存し、NaNのキーは番号をmetaに持つ。
+        metaには比較したファイルの情報等、JSONにできる値を入れられる。
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        isna = np.asarray(self.uniques.isna())
+        keys = np.array(pd.Series(self.uniques[~isna]).str.encode('utf-8').tolist(), dtype=bytes)
+        if len(keys) == 0:
+            keys = np.array([], dtype='S1')
+        meta = dict(meta or {}, nan_code=int(isna.argmax()) if isna.any() else -1)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, keys=keys, meta=np.array(json.dumps(meta)), **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """save()で保存した状態を読み込む
+
+        Returns:
+            (PartitionState, meta)
+        """
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            values = pd.Series(data['keys']).str.decode('utf-8').tolist()
+            state = cls.__new__(cls)
+            for name in cls.ARRAYS:
+                setattr(state, name, data[name])
+        nan_code = meta.pop('nan_code')
+        if nan_code >= 0:
+            values.insert(nan_code, np.nan)
+        state.uniques = pd.Index(values, dtype='str')
+        state.uniques.get_indexer(state.uniques[:1])
+        return state, meta
+
+
+def read_appended_keys(path, column, offset):
+    """ローカルのCSVファイルのoffsetバイト目以降（追記された行）だけからキーカラムを読み込む
+
+    offsetは追記前のファイルサイズ。追記前の内容が変わっていないことは
+    file_digest(path, size=offset)を追記前のダイジェストと比べて確認する。
+    （UTF-16のファイルは使えない）
+
+    Returns:
+        (Series, None) on success
+        (None, error_message) on failure
+    """
+    header_end, _ = split_csv_ranges(path, 1)
+    dialect = sniff_csv(path)
+    size = os.path.getsize(path)
+    try:
+        df = _parse_csv_range(path, header_end, max(offset, header_end), size, dialect['encoding'], dialect['sep'])
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        return None, parse_csv_error_detail(e)
+    return df[column], None
+
+
+def _prefix_digests(path, size, block_size=1 << 20):
+    """先頭sizeバイトとファイル全体のSHA-256ダイジェストを、1回読むだけで計算する"""
+    digest = hashlib.sha256()
+    prefix = None
+    done = 0
+    with open(path, 'rb') as f:
+        while True:
+            if prefix is None and done == size:
+                prefix = digest.hexdigest()
+            block = f.read(block_size if prefix is not None else min(block_size, size - done))
+            if not block:
+                break
+            digest.update(block)
+            done += len(block)
+    return prefix, digest.hexdigest()
+
+
+def _ends_with_newline(path, size):
+    """ファイルの先頭sizeバイトが改行で終わっているか（最後の行の途中に追記されていないか）"""
+    with open(path, 'rb') as f:
+        f.seek(size - 1)
+        return f.read(1) == b'\n'
+
+
+@profiled('incremental_partition')
+def incremental_partition(path1, path2, column1, column2, state_path, normalizers=None):
+    """前回の比較状態を使い、ファイル1に追記された行だけで比較結果を更新する
+
+    state_pathにPartitionStateと、ファイル1のサイズ・ダイジェスト、ファイル2のダイジェスト、
+    キーカラム・正規化を保存する。次回はファイル1の先頭（前回のサイズまで）が同じで
+    改行で終わっていれば、追記された行のキーだけを読んで更新する。
+    ファイル2・キーカラム・正規化が変わった場合や、ファイル1が追記以外で変わった場合
+    （途中の行の挿入・削除・書き換え、末尾の削除）は全体を比較し直す。
+    （単一カラムのキーのローカルのCSVファイルのみ。UTF-16・Parquet・Featherは毎回全体を比較する）
+
+    Returns:
+        ((PartitionState, 追記分だけで更新したか), None) on success
+        (None, error_message) on failure
+    """
+    path1, path2, state_path = Path(path1), Path(path2), Path(state_path)
+    size1 = os.path.getsize(path1)
+    signature = {
+        'column1': column1, 'column2': column2, 'normalizers': list(normalizers or []),
+        'digest2': file_digest(path2),
+    }
+    meta = None
+    if state_path.exists():
+        try:
+            state, meta = PartitionState.load(state_path)
+        except (OSError, ValueError, KeyError):
+            meta = None
+    appendable = (
+        meta is not None
+        and all(meta.get(key) == value for key, value in signature.items())
+        and 0 < meta['size1'] <= size1
+        and not columnar_format(path1)
+        and not sniff_csv(path1)['encoding'].startswith('utf-16')
+        and _ends_with_newline(path1, meta['size1'])
+    )
+    prefix, digest1 = _prefix_digests(path1, meta['size1'] if appendable else size1)
+    if appendable and prefix == meta['digest1']:
+        appended, err = read_appended_keys(path1, column1, meta['size1'])
+        if err:
+            return None, err
+        state.update(appended=normalize_key(appended, normalizers))
+        incremental = True
+    else:
+        key1, err = load_key_column(path1, column1)
+        if err:
+            return None, err
+        key2, err = load_key_column(path2, column2)
+        if err:
+            return None, err
+        state = PartitionState(normalize_key(key1, normalizers), normalize_key(key2, normalizers))
+        incremental = False
+    state.save(state_path, dict(signature, size1=size1, digest1=digest1))
+    return (state, incremental), None
+
+
+def _occurrences(codes):
+    """同じコードの中での出現順（0始まり）"""
+    return pd.Series(codes).groupby(codes, sort=False).cumcount().to_numpy()
+
+
+def _code_counts(codes1, codes2):
+    """コードごとのファイル1・ファイル2の件数"""
+    n_codes = max(codes1.max(initial=-1), codes2.max(initial=-1)) + 1
+    return np.bincount(codes1, minlength=n_codes), np.bincount(codes2, minlength=n_codes)
+
+
+def _first_rows(codes, n_codes):
+    """コードごとに最初に出現する行の位置"""
+    first = np.full(n_codes, -1, dtype=np.intp)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    return first
+
+
+def _key_frame(keys, rows, columns):
+    """キー（Series・DataFrame・KeyIndex）の指定行を、columnsを列名とするDataFrameにする"""
+    if isinstance(keys, KeyIndex):
+        codes = np.asarray(keys.codes)[rows]
+        if len(keys.keys) == 0:
+            # 全行のキーがNaN（空欄）の索引
+            return pd.DataFrame({columns[0]: pd.Series(np.nan, index=range(len(codes)), dtype='str')})
+        values = pd.Series(np.asarray(keys.keys)[np.maximum(codes, 0)]).str.decode('utf-8')
+        return pd.DataFrame({columns[0]: values.where(codes >= 0)})
+    if isinstance(keys, pd.Series):
+        keys = keys.to_frame()
+    return keys.iloc[rows].set_axis(columns, axis=1).reset_index(drop=True)
+
+
+def multiset_masks(keys1, keys2):
+    """同じキーの行を出現順に1対1で対応付け、相手側に対応する行があるかのマスクを返す
+
+    キーがファイル1に3件、ファイル2に1件ある場合は、ファイル1の1件目だけが
+    一致（merge_data1）になり、残りの2件はunique_data1になる。
+    キーごとの件数はbincount、出現順はgroupby().cumcount()で一度に求める。
+
+    Returns:
+        (mask1, mask2): keys1/keys2 の各行に対応する行があるかの bool ndarray
+    """
+    codes1, codes2 = key_codes(keys1, keys2)
+    count1, count2 = _code_counts(codes1, codes2)
+    return _occurrences(codes1) < count2[codes1], _occurrences(codes2) < count1[codes2]
+
+
+def duplicate_report(keys1, keys2, column):
+    """どちらかのファイルで重複しているキーと、ファイルごとの件数を返す
+
+    Args:
+        column: レポートのキーの列名（ファイル1のキーカラム名、複合キーならそのリスト）
+
+    Returns:
+        DataFrame: キーカラム、ファイル1の件数、ファイル2の件数、一致件数（1対1で対応付けた件数）
+    """
+    codes1, codes2 = key_codes(keys1, keys2)
+    return _duplicate_report(keys1, keys2, column, codes1, codes2, *_code_counts(codes1, codes2))
+
+
+def _duplicate_report(keys1, keys2, column, codes1, codes2, count1, count2):
+    """duplicate_reportの本体（コードと件数は呼び出し側で求めたものを使う）"""
+    duplicated = np.flatnonzero((count1 > 1) | (count2 > 1))
+    columns = _key_columns(column)
+
+    # ファイル1にあるキーはファイル1の行、ファイル2にだけあるキーはファイル2の行から値を取る
+    in1 = count1[duplicated] > 0
+    report = pd.concat([
+        _key_frame(keys1, _first_rows(codes1, len(count1))[duplicated[in1]], columns),
+        _key_frame(keys2, _first_rows(codes2, len(count2))[duplicated[~in1]], columns),
+    ], ignore_index=True).fillna('')
+    duplicated = np.concatenate([duplicated[in1], duplicated[~in1]])
+    report['ファイル1の件数'] = count1[duplicated]
+    report['ファイル2の件数'] = count2[duplicated]
+    report['一致件数'] = np.minimum(count1, count2)[duplicated]
+    return report
+
+
+def _split_by_mask(df, mask):
+    """マスクでDataFrameを (Falseの行, Trueの行) に分割する"""
+    return df[~mask], df[mask]
+
+
+@profiled('compare_data')
+def compare_data(df1, df2, column1, column2, multiset=False, normalizers=None):
     """2つのDataFrameをキーカラムで比較する。
 
+    column1/column2にカラム名のリストを渡すと、その順に対応する
+    カラムの組み合わせ（複合キー）で比較する。
+    multisetがTrueの場合は、同じキーの行を件数どおりに1対1で対応付け、
+    重複しているキーのレポート（duplicate_report）も返す。
+    normalizersを指定すると、正規化したキー（normalize_key）で比較する。
+
     Returns:
         dict with keys:
             unique_data1: df1にのみ存在するデータ
             unique_data2: df2にのみ存在するデータ
             merge_data1: 両方に存在するデータ（df1のフォーマット）
             merge_data2: 両方に存在するデータ（df2のフォーマット）
+            duplicates: 重複しているキーと件数（multiset=Trueの場合のみ）
     """
-    unique_data1 = df1[~df1[column1].isin(df2[column2])]
-    unique_data2 = df2[~df2[column2].isin(df1[column1])]
-    merge_data1 = df1[df1[column1].isin(df2[column2])]
-    merge_data2 = df2[df2[column2].isin(df1[column1])]
+    with stage('normalize'):
+        keys1 = normalize_key(compact_key(df1[_key_columns(column1)]), normalizers)
+        keys2 = normalize_key(compact_key(df2[_key_columns(column2)]), normalizers)
+    result = {}
+    with stage('match'):
+        if multiset:
+            codes1, codes2 = key_codes(keys1, keys2)
+            count1, count2 = _code_counts(codes1, codes2)
+            mask1 = _occurrences(codes1) < count2[codes1]
+            mask2 = _occurrences(codes2) < count1[codes2]
+            result['duplicates'] = _duplicate_report(keys1, keys2, column1, codes1, codes2, count1, count2)
+        else:
+            mask1, mask2 = compare_keys(keys1, keys2)
 
-    # NaN値を空文字列に置き換える
-    unique_data1 = unique_data1.fillna('')
-    unique_data2 = unique_data2.fillna('')
-    merge_data1 = merge_data1.fillna('')
-    merge_data2 = merge_data2.fillna('')
+    # NaN値を空文字列に置き換える（片側1回ずつ）
+    with stage('fillna'):
+        df1 = df1.fillna('')
+        df2 = df2.fillna('')
+    with stage('split'):
+        unique_data1, merge_data1 = _split_by_mask(df1, mask1)
+        unique_data2, merge_data2 = _split_by_mask(df2, mask2)
 
     return {
         'unique_data1': unique_data1,
         'unique_data2': unique_data2,
         'merge_data1': merge_data1,
         'merge_data2': merge_data2,
+        **result,
+    }
+
+
+@profiled('diff_data')
+def diff_data(df1, df2, column1, column2, column_map=None, normalizers=None):
+    """両方に存在する行をキーで対応付け、指定カラムの値の違いを検出する。
+
+    同じキーが複数行ある場合は、出現順に1対1で対応付ける
+    （ファイル1の2件目とファイル2の2件目を比較する）。
+    値はNaNを空文字列とみなして比較する（出力CSVと同じ扱い）。
+    対応付け・比較はすべてベクトル演算で行い、行ごとのループは使わない。
+
+    Args:
+        column_map: {df1のカラム名: df2のカラム名} の比較対象。
+            省略時はキー以外で両方に同じ名前があるカラム。
+        normalizers: 対応付けに使うキーの正規化（normalize_key）
+
+    Returns:
+        dict with keys:
+            changed_rows: 値が1つ以上異なる行（df1のキーカラムと、比較カラムごとの
+                「カラム名(ファイル1)」「カラム名(ファイル2)」の値）
+            change_counts: 比較カラム（df1のカラム名）ごとの異なる行数のSeries
+    """
+    columns1 = _key_columns(column1)
+    columns2 = _key_columns(column2)
+    if column_map is None:
+        column_map = {c: c for c in df1.columns if c in df2.columns and c not in columns1 + columns2}
+
+    codes1, codes2 = key_codes(normalize_key(df1[columns1], normalizers), normalize_key(df2[columns2], normalizers))
+    pairs = pd.DataFrame({'code': codes1, 'occurrence': _occurrences(codes1), 'row1': np.arange(len(df1))}).merge(
+        pd.DataFrame({'code': codes2, 'occurrence': _occurrences(codes2), 'row2': np.arange(len(df2))}),
+        on=['code', 'occurrence'],
+    )
+    rows1 = pairs['row1'].to_numpy()
+    rows2 = pairs['row2'].to_numpy()
+
+    changed = np.zeros(len(pairs), dtype=bool)
+    values = {}
+    change_counts = {}
+    for c1, c2 in column_map.items():
+        values1 = df1[c1].fillna('').to_numpy()[rows1]
+        values2 = df2[c2].fillna('').to_numpy()[rows2]
+        column_changed = values1 != values2
+        changed |= column_changed
+        change_counts[c1] = int(column_changed.sum())
+        values[f'{c1}(ファイル1)'] = values1
+        values[f'{c2}(ファイル2)'] = values2
+
+    changed_rows = df1[columns1].fillna('').iloc[rows1[changed]].reset_index(drop=True)
+    for name, column_values in values.items():
+        changed_rows[name] = column_values[changed]
+
+    return {
+        'changed_rows': changed_rows,
+        'change_counts': pd.Series(change_counts, dtype='int64'),
+    }
+
+
+def partition_rows(df, mask, column=None, search=None, sort_by=None, ascending=True):
+    """分類（maskがTrueの行）の行位置を、検索・並べ替えを反映して返す
+
+    Args:
+        column: 検索対象のキーカラム名（複合キーならそのリスト。いずれかのカラムで一致すればよい）
+        search: キーに含まれる文字列（部分一致）
+        sort_by: 並べ替えるカラム名（空欄は末尾）
+
+    Returns:
+        行位置の ndarray（ページごとの表示はpage_rowsでこの配列を切り出す）
+    """
+    rows = np.flatnonzero(mask)
+    if search:
+        found = np.zeros(len(rows), dtype=bool)
+        for c in _key_columns(column):
+            found |= df[c].iloc[rows].str.contains(search, regex=False, na=False).to_numpy()
+        rows = rows[found]
+    if sort_by is not None:
+        values = df[sort_by].iloc[rows].reset_index(drop=True)
+        order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index
+        rows = rows[order.to_numpy()]
+    return rows
+
+
+def page_rows(df, rows, page, page_size):
+    """partition_rowsの行位置からpage番目（0始まり）のページの行だけを取り出す（NaNは空文字列）"""
+    return df.iloc[rows[page * page_size:(page + 1) * page_size]].fillna('')
+
+
+def output_file_names(file_name1, file_name2, timestamp):
+    """比較結果の出力ファイル名を返す（file_name1/2は拡張子を除いた元ファイル名）
+
+    Returns:
+        dict with keys: unique_data1, unique_data2, merge_data1, merge_data2
+    """
+    return {
+        'unique_data1': f"[only_exists]{file_name1}_{timestamp}.csv",
+        'unique_data2': f"[only_exists]{file_name2}_{timestamp}.csv",
+        'merge_data1': f"[merge_data]Format={file_name1}_{timestamp}.csv",
+        'merge_data2': f"[merge_data]Format={file_name2}_{timestamp}.csv",
     }
 
 
+def _encode_csv_chunks(df, chunksize, header=True):
+    """DataFrameをchunksize行ずつUTF-8のCSVバイト列にして返すジェネレータ
+
+    header=Trueなら最初のチャンクにヘッダー行を含める（0行でもヘッダーは出力する）。
+    """
+    if header or len(df) == 0:
+        yield df.iloc[:chunksize].to_csv(index=False, header=header).encode('utf-8')
+        start = chunksize
+    else:
+        start = 0
+    for i in range(start, len(df), chunksize):
+        yield df.iloc[i:i + chunksize].to_csv(index=False, header=False).encode('utf-8')
+
+
+def _iter_frames(data):
+    """DataFrame、またはDataFrameのイテラブル（iter_rowsのチャンク等）を順に返す"""
+    if isinstance(data, pd.DataFrame):
+        yield data
+    else:
+        yield from data
+
+
+def iter_csv_bom(df, chunksize=STREAM_CHUNKSIZE):
+    """DataFrameをBOM付きUTF-8のCSVとして、バイト列のチャンクを順に返すジェネレータ
+
+    dfにはDataFrameのイテラブル（iter_rowsのチャンク等）も指定でき、
+    最初のDataFrameのヘッダーを使って続けて1つのCSVにする。
+    """
+    yield BOM
+    for i, frame in enumerate(_iter_frames(df)):
+        yield from _encode_csv_chunks(frame, chunksize, header=i == 0)
+
+
+def write_csv_bom(df, target, chunksize=STREAM_CHUNKSIZE):
+    """DataFrameをBOM付きUTF-8のCSVとして、パスまたはバイナリのファイルオブジェクトに書き出す
+
+    全体を1つのバイト列にせずチャンク単位で書き込むため、
+    出力全体のコピーをメモリに持たない。
+    """
+    with _open_output(target) as f:
+        for chunk in iter_csv_bom(df, chunksize):
+            f.write(chunk)
+
+
+@profiled('convert_df_bom')
 def convert_df_bom(df):
     """DataFrameをBOM付きUTF-8のCSVバイト列に変換する"""
-    return '\ufeff'.encode('utf-8') + df.to_csv(index=False).encode('utf-8')
+    buffer = BytesIO()
+    write_csv_bom(df, buffer)
+    return buffer.getvalue()
+
+
+def _open_output(target):
+    """出力先がパスなら書き込み用に開き、ファイルオブジェクトならそのまま使う"""
+    if hasattr(target, 'write'):
+        return nullcontext(target)
+    return open(target, 'wb')
+
+
+class _UnclosedWriter(RawIOBase):
+    """閉じても元のファイルオブジェクトは閉じない書き込み用のストリーム
+
+    pyarrowの出力ストリームは閉じる時に出力先も閉じるため、
+    ZIPの中のファイル等に続けて書けるよう間に挟む。
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._stream.write(b)
+
+
+def _compressed_output(f, compression):
+    """fに圧縮して書き込むストリームを返す（compressionは None, 'gzip', 'zstd'）"""
+    if compression is None:
+        return nullcontext(f)
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+    import pyarrow as pa
+
+    return pa.CompressedOutputStream(_UnclosedWriter(f), compression)
+
+
+def write_parquet(df, target, chunksize=STREAM_CHUNKSIZE):
+    """DataFrame（またはDataFrameのイテラブル）をParquetとして書き出す
+
+    chunksize行ずつ（イテラブルならDataFrameごとにも）行グループにして書き込むため、
+    全体をArrowのテーブルに変換したコピーをメモリに持たない。
+    全カラムを文字列型で書く（最初のチャンクから推定すると、pandas 2のobject型の
+    空のチャンクがnull型になり、以降のチャンクを書けなくなる）。
+    """
+    import pyarrow as pa
+    from pyarrow import parquet as pq
+
+    writer = None
+    with _open_output(target) as f:
+        for frame in _iter_frames(df):
+            if writer is None:
+                schema = pa.schema([(column, pa.string()) for column in frame.columns])
+                writer = pq.ParquetWriter(f, schema)
+            for start in range(0, max(len(frame), 1), chunksize):
+                table = pa.Table.from_pandas(
+                    frame.iloc[start:start + chunksize], preserve_index=False, schema=schema,
+                )
+                if table.num_rows:
+                    writer.write_table(table)
+        if writer is not None:
+            writer.close()
+
+
+@profiled('write_export')
+def write_export(df, target, fmt='csv', chunksize=STREAM_CHUNKSIZE):
+    """DataFrame（またはDataFrameのイテラブル）をEXPORT_FORMATSの形式で書き出す
+
+    'csv'はBOM付きUTF-8のCSV、'csv.gz'・'csv.zst'はそれをgzip・zstdで圧縮したもの。
+    どの形式もチャンク単位で変換・圧縮して書き込む。
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不明な出力形式です: {fmt}")
+    if fmt == 'parquet':
+        write_parquet(df, target, chunksize)
+        return
+    compression = {'csv': None, 'csv.gz': 'gzip', 'csv.zst': 'zstd'}[fmt]
+    with _open_output(target) as f, _compressed_output(f, compression) as out:
+        for chunk in iter_csv_bom(df, chunksize):
+            out.write(chunk)
+
+
+def export_file_name(file_name, fmt):
+    """output_file_namesのCSVのファイル名の拡張子を、出力形式の拡張子にする"""
+    return file_name.removesuffix('.csv') + EXPORT_FORMATS[fmt][0]
+
+
+@profiled('write_zip')
+def write_zip(frames, target, fmt='csv', chunksize=STREAM_CHUNKSIZE):
+    """複数の結果を1つのZIPファイルにまとめて書き出す
+
+    framesは {ZIP内のファイル名: DataFrame、DataFrameのイテラブル、またはそれを返す関数}。
+    関数は書き込む直前に1つずつ呼ぶので、読み込み中の結果は1つ分だけになる。
+    各ファイルはwrite_exportでfmtの形式にし、CSVはZIPの中でdeflate圧縮する。
+    """
+    compression = zipfile.ZIP_DEFLATED if fmt == 'csv' else zipfile.ZIP_STORED
+    with _open_output(target) as f, zipfile.ZipFile(f, 'w', compression=compression) as archive:
+        for name, df in frames.items():
+            if callable(df):
+                df = df()
+            with archive.open(name, 'w', force_zip64=True) as member:
+                write_export(df, member, fmt, chunksize)
+
+
+def read_key_set(source, column, chunksize=STREAM_CHUNKSIZE):
+    """CSVのキーカラムだけをチャンク単位で読み込み、重複を除いたキーを返す"""
+    parts = [
+        chunk[column].drop_duplicates()
+        for chunk in _read_csv(source, usecols=[column], dtype=str, chunksize=chunksize)
+    ]
+    return pd.Index(compact_key(pd.concat(parts, ignore_index=True).drop_duplicates()))
+
+
+def _stream_partition(source, column, key_set, out_unique, out_merge, chunksize):
+    """sourceをチャンク単位で読み、key_setに無い行/有る行をそれぞれ書き出す
+
+    Returns:
+        (uniqueの行数, mergeの行数)
+    """
+    n_unique = n_merge = 0
+    with _open_output(out_unique) as f_unique, _open_output(out_merge) as f_merge:
+        f_unique.write(BOM)
+        f_merge.write(BOM)
+        header = True
+        for chunk in _read_csv(source, dtype=str, chunksize=chunksize):
+            # isinはチャンクごとにkey_setのハッシュ表を作り直すため、Indexが保持する
+            # ハッシュ表を使い回すget_indexerで引く（key_setは重複なし）
+            mask = key_set.get_indexer(chunk[column]) >= 0
+            unique, merge = _split_by_mask(chunk.fillna(''), mask)
+            f_unique.writelines(_encode_csv_chunks(unique, chunksize, header))
+            f_merge.writelines(_encode_csv_chunks(merge, chunksize, header))
+            header = False
+            n_unique += len(unique)
+            n_merge += len(merge)
+    return n_unique, n_merge
+
+
+def compare_csv_streaming(source1, source2, column1, column2, outputs, chunksize=STREAM_CHUNKSIZE):
+    """メモリに載りきらないCSV同士をチャンク単位で比較し、結果を直接書き出す。
+
+    相手側はキーカラムだけを読み込んでキー集合を作り、自分側を
+    チャンク単位で読みながら振り分ける。これを両方向で1回ずつ行うため、
+    使用メモリは行データ全体ではなくキー集合の大きさで決まる。
+    出力はconvert_df_bomと同じBOM付きUTF-8のCSV。
+
+    Args:
+        source1, source2: CSVファイルのパス、またはシーク可能なファイルオブジェクト
+        outputs: unique_data1 / unique_data2 / merge_data1 / merge_data2 をキーに、
+            出力先のパスまたはバイナリのファイルオブジェクトを持つdict
+
+    Returns:
+        (dict of 行数, None) on success
+        (None, error_message) on failure
+    """
+    try:
+        keys2 = read_key_set(source2, column2, chunksize)
+        n_unique1, n_merge1 = _stream_partition(
+            source1, column1, keys2, outputs['unique_data1'], outputs['merge_data1'], chunksize
+        )
+        del keys2
+        keys1 = read_key_set(source1, column1, chunksize)
+        n_unique2, n_merge2 = _stream_partition(
+            source2, column2, keys1, outputs['unique_data2'], outputs['merge_data2'], chunksize
+        )
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        return None, parse_csv_error_detail(e)
+
+    return {
+        'unique_data1': n_unique1,
+        'unique_data2': n_unique2,
+        'merge_data1': n_merge1,
+        'merge_data2': n_merge2,
+    }, None
+
+
+def _merge_keys(chunk, column):
+    """ソート済み比較用のキー（文字列のndarray）を返す
+
+    空欄（NaN）は空文字列として扱う（昇順では先頭に並ぶ）。複合キーは各カラムを
+    NUL文字でつないだ1つの文字列にし、カラムの順に比べた場合と同じ大小関係にする。
+    """
+    if isinstance(column, (list, tuple)):
+        keys = chunk[column[0]].fillna('')
+        for c in column[1:]:
+            keys = keys.str.cat(chunk[c].fillna(''), sep='\x00')
+    else:
+        keys = chunk[column].fillna('')
+    return keys.to_numpy(dtype=object)
+
+
+def _sorted_key_chunks(source, column, label, chunksize, usecols=None):
+    """CSVをチャンク単位で読み、(チャンク, キーのndarray) を順に返すジェネレータ
+
+    キーが昇順（同じキーの連続は可）でない行があれば ValueError を送出する。
+    """
+    previous = None
+    offset = 0
+    for chunk in _read_csv(source, dtype=str, chunksize=chunksize, usecols=usecols):
+        keys = _merge_keys(chunk, column)
+        if len(keys):
+            bad = np.flatnonzero(keys[:-1] > keys[1:]) + 1
+            if previous is not None and previous > keys[0]:
+                bad = np.r_[0, bad]
+            if len(bad):
+                # ヘッダー行の分を足したファイル上の行番号（セル内の改行は数えない）
+                raise ValueError(f"{label}のキーが昇順に並んでいません（{offset + int(bad[0]) + 2}行目）")
+            previous = keys[-1]
+        offset += len(chunk)
+        yield chunk, keys
+
+
+def _sorted_isin(keys, other):
+    """ソート済みのkeysの各要素が、ソート済みのotherに含まれるかのbool ndarray"""
+    pos = np.searchsorted(other, keys)
+    found = pos < len(other)
+    found[found] = other[pos[found]] == keys[found]
+    return found
+
+
+def is_sorted_csv(source, column, chunksize=STREAM_CHUNKSIZE):
+    """CSVのキーカラムが昇順に並んでいるかを、キーカラムだけをチャンク単位で読んで調べる
+
+    columnはカラム名、または複合キーのカラム名のリスト（カラムの順に比べる）。
+    Parquet・FeatherはCSVではないのでFalseを返す。
+    """
+    if columnar_format(source):
+        return False
+    try:
+        for _ in _sorted_key_chunks(source, column, '', chunksize, usecols=_key_columns(column)):
+            pass
+    except ValueError:
+        return False
+    return True
+
+
+@profiled('compare_csv_sorted')
+def compare_csv_sorted(source1, source2, column1, column2, outputs, chunksize=STREAM_CHUNKSIZE):
+    """キーの昇順に並んだCSV同士を、マージ結合のように1回ずつ読みながら比較して書き出す
+
+    両方のファイルをチャンク単位で同時に読み進め、両方の読み込み済みの範囲の
+    最後のキーの小さい方より前のキーは、以降のチャンクに現れないので振り分けを確定する。
+    ハッシュ表やキー集合を作らないため、使用メモリはファイルの大きさによらず
+    チャンク数個分で一定（同じキーの行がチャンクをまたいで続く場合はその分だけ増える）。
+    結果（行の順序・内容）はcompare_csv_streamingと同じ。
+
+    キーは文字列として昇順（Pythonの文字列の大小、空欄は先頭）である必要があり、
+    そうでない行があればその行番号のエラーを返す（それまでの出力は途中のまま）。
+    事前に確かめる場合はis_sorted_csvを使う。
+
+    Args:
+        source1, source2: CSVファイルのパス、またはファイルオブジェクト
+        column1, column2: キーのカラム名、または複合キーのカラム名のリスト
+        outputs: compare_csv_streamingと同じ
+
+    Returns:
+        (dict of 行数, None) on success
+        (None, error_message) on failure
+    """
+    counts = dict.fromkeys(['unique_data1', 'unique_data2', 'merge_data1', 'merge_data2'], 0)
+    if len(_key_columns(column1)) != len(_key_columns(column2)):
+        return None, 'キーカラムの数が一致しません'
+    if columnar_format(source1) or columnar_format(source2):
+        return None, 'キーの昇順を前提とした比較はCSVのファイルのみに対応しています'
+    sides = [
+        {'chunks': _sorted_key_chunks(source1, column1, 'ファイル1', chunksize), 'unique': 'unique_data1', 'merge': 'merge_data1'},
+        {'chunks': _sorted_key_chunks(source2, column2, 'ファイル2', chunksize), 'unique': 'unique_data2', 'merge': 'merge_data2'},
+    ]
+    try:
+        with ExitStack() as stack:
+            files = {key: stack.enter_context(_open_output(outputs[key])) for key in counts}
+            for f in files.values():
+                f.write(BOM)
+            for side in sides:
+                side.update(rows=None, keys=np.array([], dtype=object), done=False, header=True)
+
+            def read_next(side):
+                chunk = next(side['chunks'], None)
+                if chunk is None:
+                    side['done'] = True
+                elif side['rows'] is None:
+                    side['rows'], side['keys'] = chunk
+                else:
+                    side['rows'] = pd.concat([side['rows'], chunk[0]])
+                    side['keys'] = np.concatenate([side['keys'], chunk[1]])
+
+            def write(side, n, mask):
+                unique, merge = _split_by_mask(side['rows'].iloc[:n].fillna(''), mask)
+                files[side['unique']].writelines(_encode_csv_chunks(unique, chunksize, side['header']))
+                files[side['merge']].writelines(_encode_csv_chunks(merge, chunksize, side['header']))
+                side['header'] = False
+                counts[side['unique']] += len(unique)
+                counts[side['merge']] += len(merge)
+                side['rows'] = side['rows'].iloc[n:]
+                side['keys'] = side['keys'][n:]
+
+            while True:
+                for side in sides:
+                    if not side['done'] and len(side['keys']) == 0:
+                        read_next(side)
+                if any(not side['done'] and len(side['keys']) == 0 for side in sides):
+                    continue
+                # 読み終わっていない側の最後のキーのうち最小のもの。これより前のキーは確定
+                pending = [side['keys'][-1] for side in sides if not side['done']]
+                bound = min(pending) if pending else None
+                ns = [
+                    len(side['keys']) if bound is None else int(np.searchsorted(side['keys'], bound))
+                    for side in sides
+                ]
+                if ns[0] or ns[1]:
+                    keys1, keys2 = sides[0]['keys'][:ns[0]], sides[1]['keys'][:ns[1]]
+                    mask1, mask2 = _sorted_isin(keys1, keys2), _sorted_isin(keys2, keys1)
+                    write(sides[0], ns[0], mask1)
+                    write(sides[1], ns[1], mask2)
+                if bound is None:
+                    break
+                if not (ns[0] or ns[1]):
+                    # 確定できる行が無い（残りがすべてboundと同じキー）ので続きを読む
+                    for side in sides:
+                        if not side['done'] and side['keys'][-1] == bound:
+                            read_next(side)
+
+            # 0行のファイルもヘッダーだけは出力する
+            for side in sides:
+                if side['header'] and side['rows'] is not None:
+                    write(side, 0, np.array([], dtype=bool))
+    except (pd.errors.ParserError, UnicodeDecodeError) as e:
+        return None, parse_csv_error_detail(e)
+    except KeyError as e:
+        return None, f"カラムが見つかりません: {e}"
+    except ValueError as e:
+        return None, str(e)
+    return counts, None
@@ -0,0 +1,88 @@
+"""ベンチマーク（benchmark.py）のテスト"""
+import json
+import pandas as pd
+import pytest
+from benchmark import generate_frames, run_scenario, find_regressions, measure, main
+from compare_core import load_csv
+
+
+class TestGenerateFrames:
+    """合成データの生成"""
+
+    def test_shape_and_key_format(self):
+        df1, df2 = generate_frames(100, cols=5, text_width=3)
+        assert df1.shape == (100, 5)
+        assert df2.shape == (100, 5)
+        assert df1['宛名番号'].str.len().eq(10).all()
+        assert df1['項目1'].str.len().eq(3).all()
+
+    def test_no_overlap(self):
+        df1, df2 = generate_frames(100, dup_ratio=0, overlap=0)
+        assert not df2['宛名番号'].isin(df1['宛名番号']).any()
+        assert not df1['宛名番号'].duplicated().any()
+
+    @pytest.mark.parametrize('dup_ratio', [0, 0.1, 0.5])
+    @pytest.mark.parametrize('overlap', [0.25, 0.5, 1.0])
+    def test_exact_ratios(self, dup_ratio, overlap):
+        """重複している行の割合・ファイル2のキーの種類のうちファイル1にもある割合が指定どおり"""
+        df1, df2 = generate_frames(1000, cols=2, dup_ratio=dup_ratio, overlap=overlap)
+        for df in (df1, df2):
+            assert df['宛名番号'].duplicated(keep=False).mean() == dup_ratio
+        keys2 = pd.Series(df2['宛名番号'].unique())
+        assert keys2.isin(set(df1['宛名番号'])).sum() == int(len(keys2) * overlap)
+
+    def test_cardinality(self):
+        df1, df2 = generate_frames(1000, cols=2, cardinality=10, overlap=0.5)
+        assert df1['宛名番号'].nunique() == 10
+        assert df2['宛名番号'].nunique() == 10
+        assert df1['宛名番号'].value_counts().eq(100).all()
+        assert df2['宛名番号'].isin(df1['宛名番号']).mean() == 0.5
+
+
+class TestMeasure:
+    """処理時間とピークメモリの計測"""
+
+    def test_peak_includes_arrow_memory(self, tmp_path):
+        """Arrowに確保される文字列カラムのメモリもピークに含める（tracemallocだけでは約4割）"""
+        rows = 200_000
+        path = tmp_path / 'wide.csv'
+        path.write_text('A,B,C,D,E\n' + '\n'.join(','.join([f'{i:040d}'] * 5) for i in range(rows)))
+        (df, _), seconds, peak = measure(load_csv, path)
+        assert df.shape == (rows, 5)
+        assert seconds > 0
+        assert peak >= rows * 40 * 5
+
+
+class TestRegression:
+    """ベースラインとの比較"""
+
+    def setup_method(self):
+        self.baseline = {'s:compare_data': {'seconds': 1.0, 'peak_bytes': 1000}}
+
+    def test_within_threshold(self):
+        results = {'s:compare_data': {'seconds': 1.1, 'peak_bytes': 1100}}
+        assert find_regressions(results, self.baseline, threshold=0.2) == []
+
+    def test_slower_and_larger(self):
+        results = {'s:compare_data': {'seconds': 1.5, 'peak_bytes': 2000}}
+        metrics = [metric for _, metric, _, _ in find_regressions(results, self.baseline, threshold=0.2)]
+        assert metrics == ['seconds', 'peak_bytes']
+
+    def test_new_scenario_ignored(self):
+        results = {'other:compare_data': {'seconds': 9.0, 'peak_bytes': 9000}}
+        assert find_regressions(results, self.baseline) == []
+
+
+class TestMain:
+    """コマンドラインからの実行"""
+
+    def test_run_scenario_stages(self):
+        stages = run_scenario(100, cols=3, dup_ratio=0.1, overlap=0.5, text_width=2)
+        assert list(stages) == ['load_csv', 'load_csv_parallel', 'compare_data', 'convert_df_bom']
+
+    def test_save_and_compare(self, tmp_path):
+        path = tmp_path / 'baseline.json'
+        assert main(['--sizes', '100', '--cols', '3', '--save', str(path)]) == 0
+        baseline = json.loads(path.read_text(encoding='utf-8'))
+        assert len(baseline) == 4
+        assert main(['--sizes', '100', '--cols', '3', '--compare', str(path), '--threshold', '1000']) == 0
@@ -1,5 +1,6 @@
 """AtasoPy Streamlit UIテスト（AppTest使用）"""
 import pytest
+from unittest import mock
 from pathlib import Path
 from streamlit.testing.v1 import AppTest
 
@@ -135,3 +136,222 @@ class TestDirectInputError:
         assert len(app.error) >= 1
         # DLボタンは表示されない
         assert len(app.button) == 0
+
+
+class TestResultCache:
+    """アップロード内容のダイジェストによるキャッシュのUIテスト"""
+
+    def test_preview_toggle_reuses_cached_result(self):
+        """比較後にプレビューを切り替えても比較をやり直さず、同じ結果で再描画される"""
+        import compare_core
+        calls = []
+
+        def counting_compare_keys(*args, **kwargs):
+            calls.append(1)
+            return original(*args, **kwargs)
+
+        original = compare_core.compare_keys
+        with mock.patch.object(compare_core, 'compare_keys', counting_compare_keys):
+            app = create_app()
+            app.run()
+            app.checkbox[0].set_value(True).run()
+
+            # 他のテストの結果が共有キャッシュに残っていないよう、このテストだけの入力にする
+            app.text_area[0].set_value(
+                "キャッシュID,名前\n1,山田太郎\n2,鈴木花子"
+            ).run()
+            app.text_area[1].set_value(
+                "キャッシュID,名前\n1,山田太郎\n3,田中一郎"
+            ).run()
+            assert len(calls) == 1
+
+            # チェックボックス: [0]直接入力, [1]プレビュー
+            app.checkbox[1].set_value(True).run()
+            assert not app.exception
+            assert len(app.selectbox) >= 2
+            assert len(app.error) == 0
+            assert len(calls) == 1
+
+
+class TestKeyColumnSelect:
+    """ヘッダー読み込み後すぐにキーカラムを選択できる"""
+
+    def test_selectbox_shown_per_input(self):
+        """片方の入力だけでもそのデータのキーカラム選択が表示される"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+
+        app.text_area[0].set_value(
+            "ID,名前,住所\n1,山田太郎,東京都"
+        ).run()
+
+        assert not app.exception
+        assert len(app.selectbox) == 1
+        assert app.selectbox[0].options == ['ID', '名前', '住所']
+
+    def test_composite_key_count_mismatch_warns(self):
+        """複合キーのカラム数が左右で異なる場合は比較せず警告する"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+
+        app.text_area[0].set_value(
+            "宛名番号,枝番,名前\n1,1,山田太郎"
+        ).run()
+        app.text_area[1].set_value(
+            "宛名番号,枝番\n1,1"
+        ).run()
+        app.multiselect[0].set_value(['枝番']).run()
+
+        assert not app.exception
+        assert any('キーカラムの数' in w.value for w in app.warning)
+
+
+class TestPartitionPreview:
+    """比較結果のページ単位のプレビュー"""
+
+    def run_comparison(self):
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value(
+            "ID,名前\n1,山田太郎\n2,鈴木花子\n12,田中一郎"
+        ).run()
+        app.text_area[1].set_value(
+            "ID,名前\n1,山田太郎\n3,佐藤二郎"
+        ).run()
+        # チェックボックス: [0]直接入力, [1]プレビュー, [2]件数どおりの対応付け, [3]比較結果のプレビュー
+        app.checkbox[3].set_value(True).run()
+        return app
+
+    def test_shows_partition_page(self):
+        """ファイル1のみに存在するデータが表示される"""
+        app = self.run_comparison()
+        assert not app.exception
+        assert app.dataframe[0].value['ID'].tolist() == ['2', '12']
+
+    def test_search_and_sort(self):
+        """キーの検索と並べ替えが反映される"""
+        app = self.run_comparison()
+        app.text_input[0].set_value('2').run()
+        app.selectbox[-1].set_value('名前').run()
+        assert not app.exception
+        assert app.dataframe[0].value['名前'].tolist() == ['田中一郎', '鈴木花子']
+
+
+class TestMultisetMode:
+    """同じキーの行を件数どおりに対応付けるモード"""
+
+    def test_duplicate_report(self):
+        """重複キーのレポートが表示される"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value(
+            "ID,名前\n1,山田太郎\n1,山田太郎\n2,鈴木花子"
+        ).run()
+        app.text_area[1].set_value(
+            "ID,名前\n1,山田太郎\n3,田中一郎"
+        ).run()
+        app.checkbox[2].set_value(True).run()
+
+        assert not app.exception
+        report = app.dataframe[0].value
+        assert report['ID'].tolist() == ['1']
+        assert report['ファイル1の件数'].tolist() == [2]
+        assert report['一致件数'].tolist() == [1]
+
+
+    def test_preview_follows_mode_change(self):
+        """プレビューの表示後にモードを切り替えても、切り替え後の比較結果が表示される"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value("ID,名前\n1,山田太郎\n1,山田太郎\n2,鈴木花子").run()
+        app.text_area[1].set_value("ID,名前\n1,山田太郎\n3,田中一郎").run()
+        # チェックボックス: [0]直接入力, [1]プレビュー, [2]件数どおりの対応付け, [3]比較結果のプレビュー
+        app.checkbox[3].set_value(True).run()
+        assert app.dataframe[-1].value['ID'].tolist() == ['2']
+        app.checkbox[2].set_value(True).run()
+
+        assert not app.exception
+        assert app.dataframe[-1].value['ID'].tolist() == ['1', '2']
+
+
+class TestKeyNormalizers:
+    """キーの正規化の選択"""
+
+    def test_normalized_keys_match(self):
+        """先頭の0を除去すると、0埋めの有無が違うキーも一致する"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value(
+            "コード,名前\n001,山田太郎\n002,鈴木花子"
+        ).run()
+        app.text_area[1].set_value(
+            "コード,名前\n1,山田太郎\n3,田中一郎"
+        ).run()
+        app.multiselect[-1].set_value(['先頭の0を除去']).run()
+        # チェックボックス: [0]直接入力, [1]プレビュー, [2]件数どおりの対応付け, [3]比較結果のプレビュー
+        app.checkbox[3].set_value(True).run()
+        app.selectbox[-2].set_value(app.selectbox[-2].options[2]).run()
+
+        assert not app.exception
+        assert app.dataframe[0].value['コード'].tolist() == ['001']
+
+
+    def test_preview_follows_normalizer_change(self):
+        """プレビューの表示後に正規化を変えても、変更後の比較結果が表示される"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value("コード,名前\n001,山田太郎\n002,鈴木花子").run()
+        app.text_area[1].set_value("コード,名前\n1,山田太郎\n3,田中一郎").run()
+        app.checkbox[3].set_value(True).run()
+        assert app.dataframe[-1].value['コード'].tolist() == ['001', '002']
+        app.multiselect[-1].set_value(['先頭の0を除去']).run()
+
+        assert not app.exception
+        assert app.dataframe[-1].value['コード'].tolist() == ['002']
+
+
+class TestProfiling:
+    """処理時間の計測結果の表示"""
+
+    def test_profile_report(self):
+        """計測を有効にすると工程ごとの処理時間が表示される"""
+        app = create_app()
+        app.run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value(
+            "ID,名前\n1,山田太郎\n2,鈴木花子"
+        ).run()
+        app.text_area[1].set_value(
+            "ID,名前\n1,山田太郎\n3,田中一郎"
+        ).run()
+        app.checkbox[-1].set_value(True).run()
+
+        assert not app.exception
+        report = app.dataframe[-1].value
+        assert 'membership_masks' in report['stage'].tolist()
+        assert (report['seconds'] >= 0).all()
+
+    def test_profile_includes_background_stages(self):
+        """バックグラウンドのジョブの中の工程も、ジョブを始めた工程の下に記録される"""
+        app = create_app()
+        app.run()
+        app.checkbox[-1].set_value(True).run()
+        app.checkbox[0].set_value(True).run()
+        app.text_area[0].set_value(
+            "番号,名前\n11,山田太郎\n12,鈴木花子"
+        ).run()
+        app.text_area[1].set_value(
+            "番号,名前\n11,山田太郎\n13,田中一郎"
+        ).run()
+
+        assert not app.exception
+        stages = app.dataframe[-1].value['stage'].tolist()
+        assert any(s.startswith('load_key:') and s.endswith('/load_key_column') for s in stages)
+        assert 'membership_masks/compare_keys' in stages
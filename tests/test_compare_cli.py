@@ -0,0 +1,228 @@
+"""AtasoPy コマンドライン版のテスト"""
+import json
+from compare_core import load_csv, compare_data, convert_df_bom, output_file_names
+from compare_cli import run_job, run_batch, main, PARTITIONS
+
+
+class TestRunJob:
+    """1つのファイル組の比較"""
+
+    def setup_method(self):
+        self.csv1 = "宛名番号,名前\n1,山田太郎\n2,鈴木花子\n3,田中一郎"
+        self.csv2 = "口座番号,宛名番号\nA001,1\nA002,3\nA003,4"
+
+    def write_inputs(self, tmp_path):
+        (tmp_path / 'master.csv').write_text(self.csv1, encoding='utf-8')
+        (tmp_path / 'daily.csv').write_text(self.csv2, encoding='utf-8')
+        return {
+            'file1': str(tmp_path / 'master.csv'), 'file2': str(tmp_path / 'daily.csv'),
+            'column1': '宛名番号', 'column2': '宛名番号',
+        }
+
+    def test_outputs_same_as_ui(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        assert [summary[key] for key in PARTITIONS] == [1, 1, 2, 2]
+
+        result = compare_data(load_csv(self.csv1)[0], load_csv(self.csv2)[0], '宛名番号', '宛名番号')
+        file_names = output_file_names('master', 'daily', '20260101_000000')
+        for key in PARTITIONS:
+            assert (tmp_path / 'out' / file_names[key]).read_bytes() == convert_df_bom(result[key])
+
+    def test_multiset_writes_duplicates(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        (tmp_path / 'daily.csv').write_text(self.csv2 + "\nA004,1", encoding='utf-8')
+        job['multiset'] = True
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        assert summary['duplicates'] == 1
+        report, _ = load_csv(tmp_path / 'out' / '[duplicates]master_daily_20260101_000000.csv')
+        assert report['宛名番号'].tolist() == ['1']
+
+    def test_normalizers(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        (tmp_path / 'daily.csv').write_text("口座番号,宛名番号\nA001, 001\nA002,003", encoding='utf-8')
+        job['normalizers'] = ['strip', 'lstrip0']
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert [summary[key] for key in PARTITIONS] == [1, 0, 2, 2]
+
+    def test_profile(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        summary = run_job(job, tmp_path / 'out', '20260101_000000', profile=True)
+        stages = [entry['stage'] for entry in summary['profile']]
+        assert stages[0] == 'load_csv'
+        assert 'compare_data' in stages
+        assert 'write_csv' in stages
+        assert 'profile' not in run_job(job, tmp_path / 'out', '20260101_000000')
+
+    def test_format(self, tmp_path):
+        import gzip
+        job = self.write_inputs(tmp_path)
+        job['format'] = 'csv.gz'
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        result = compare_data(load_csv(self.csv1)[0], load_csv(self.csv2)[0], '宛名番号', '宛名番号')
+        file_names = output_file_names('master', 'daily', '20260101_000000')
+        for key in PARTITIONS:
+            data = (tmp_path / 'out' / (file_names[key] + '.gz')).read_bytes()
+            assert gzip.decompress(data) == convert_df_bom(result[key])
+
+    def test_unknown_format(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        summary = run_job(job, tmp_path / 'out', '20260101_000000', fmt='xlsx')
+        assert '出力形式' in summary['error']
+
+    def test_parquet_input(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        load_csv(self.csv1)[0].to_parquet(tmp_path / 'master.parquet')
+        job['file1'] = str(tmp_path / 'master.parquet')
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        assert [summary[key] for key in PARTITIONS] == [1, 1, 2, 2]
+
+    def test_sorted(self, tmp_path):
+        """キーの昇順を前提とした比較でも同じCSVを出力する"""
+        job = self.write_inputs(tmp_path)
+        job['sorted'] = True
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        assert summary['sorted'] is True
+        assert (summary['rows1'], summary['rows2']) == (3, 3)
+        result = compare_data(load_csv(self.csv1)[0], load_csv(self.csv2)[0], '宛名番号', '宛名番号')
+        file_names = output_file_names('master', 'daily', '20260101_000000')
+        for key in PARTITIONS:
+            assert (tmp_path / 'out' / file_names[key]).read_bytes() == convert_df_bom(result[key])
+
+    def test_sorted_auto_falls_back(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        (tmp_path / 'daily.csv').write_text("口座番号,宛名番号\nA003,4\nA001,1", encoding='utf-8')
+        job['sorted'] = 'auto'
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is None
+        assert summary['sorted'] is False
+        assert [summary[key] for key in PARTITIONS] == [2, 1, 1, 1]
+
+    def test_sorted_with_multiset(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        job.update(sorted=True, multiset=True)
+        assert 'sorted' in run_job(job, tmp_path / 'out', '20260101_000000')['error']
+
+    def test_incremental(self, tmp_path):
+        """2回目からはファイル1に追記された行だけで比較し、結果は通常の比較と同じ"""
+        job = self.write_inputs(tmp_path)
+        (tmp_path / 'master.csv').write_text(self.csv1 + "\n", encoding='utf-8')
+        job['incremental'] = True
+        assert run_job(job, tmp_path / 'out', '20260101_000000')['incremental'] is False
+
+        with open(tmp_path / 'master.csv', 'a', encoding='utf-8') as f:
+            f.write("4,佐藤二郎\n")
+        summary = run_job(job, tmp_path / 'out', '20260102_000000')
+        assert summary['error'] is None
+        assert summary['incremental'] is True
+        assert [summary[key] for key in PARTITIONS] == [1, 0, 3, 3]
+
+        df1, _ = load_csv(tmp_path / 'master.csv')
+        result = compare_data(df1, load_csv(self.csv2)[0], '宛名番号', '宛名番号')
+        file_names = output_file_names('master', 'daily', '20260102_000000')
+        for key in PARTITIONS:
+            assert (tmp_path / 'out' / file_names[key]).read_bytes() == convert_df_bom(result[key])
+
+    def test_incremental_falls_back_on_other_changes(self, tmp_path):
+        """ファイル1の途中の行を削除した場合や、ファイル2が変わった場合は全体を比較し直す"""
+        job = self.write_inputs(tmp_path)
+        job['incremental'] = True
+        run_job(job, tmp_path / 'out', '20260101_000000')
+
+        (tmp_path / 'master.csv').write_text("宛名番号,名前\n1,山田太郎\n3,田中一郎\n", encoding='utf-8')
+        summary = run_job(job, tmp_path / 'out', '20260102_000000')
+        assert summary['incremental'] is False
+        assert [summary[key] for key in PARTITIONS] == [0, 1, 2, 2]
+
+        (tmp_path / 'daily.csv').write_text("口座番号,宛名番号\nA001,1\n", encoding='utf-8')
+        summary = run_job(job, tmp_path / 'out', '20260103_000000')
+        assert summary['incremental'] is False
+        assert [summary[key] for key in PARTITIONS] == [1, 0, 1, 1]
+
+    def test_incremental_with_multiset(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        job.update(incremental=True, multiset=True)
+        assert 'incremental' in run_job(job, tmp_path / 'out', '20260101_000000')['error']
+
+    def test_missing_column(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        job['column2'] = '存在しないカラム'
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert 'カラムが見つかりません' in summary['error']
+
+    def test_missing_file(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        job['file1'] = str(tmp_path / 'none.csv')
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert summary['error'] is not None
+
+    def test_broken_csv(self, tmp_path):
+        job = self.write_inputs(tmp_path)
+        (tmp_path / 'master.csv').write_text("宛名番号,名前\n1,山田太郎\n2,鈴木花子,追加", encoding='utf-8')
+        summary = run_job(job, tmp_path / 'out', '20260101_000000')
+        assert '3行目' in summary['error']
+
+
+class TestBatch:
+    """マニフェストによる並列実行"""
+
+    def test_batch_keeps_manifest_order(self, tmp_path):
+        jobs = []
+        for i in range(3):
+            (tmp_path / f'a{i}.csv').write_text("ID\n" + "\n".join(str(n) for n in range(i + 1)), encoding='utf-8')
+            (tmp_path / f'b{i}.csv').write_text("ID\n0", encoding='utf-8')
+            jobs.append({'file1': str(tmp_path / f'a{i}.csv'), 'file2': str(tmp_path / f'b{i}.csv'),
+                         'column1': 'ID', 'column2': 'ID'})
+        summaries = run_batch(jobs, tmp_path / 'out', max_workers=2)
+        assert [s['unique_data1'] for s in summaries] == [0, 1, 2]
+        assert len(list((tmp_path / 'out').iterdir())) == 12
+
+    def test_main_writes_summary_and_exit_code(self, tmp_path):
+        (tmp_path / 'a.csv').write_text("ID\n1", encoding='utf-8')
+        manifest = tmp_path / 'manifest.json'
+        manifest.write_text(json.dumps([
+            {'file1': str(tmp_path / 'a.csv'), 'file2': str(tmp_path / 'a.csv'), 'column1': 'ID', 'column2': 'ID'},
+            {'file1': str(tmp_path / 'none.csv'), 'file2': str(tmp_path / 'a.csv'), 'column1': 'ID', 'column2': 'ID'},
+        ]), encoding='utf-8')
+        summary_path = tmp_path / 'summary.json'
+        code = main([str(manifest), '--output-dir', str(tmp_path / 'out'), '--jobs', '2',
+                     '--summary', str(summary_path)])
+        assert code == 1
+        summaries = json.loads(summary_path.read_text(encoding='utf-8'))
+        assert summaries[0]['merge_data1'] == 1
+        assert summaries[1]['error'] is not None
+
+    def test_rejects_jobs_with_same_output_names(self, tmp_path):
+        """同じファイル1を複数のファイル2と比較するとき、結果を上書きし合わない"""
+        (tmp_path / 'master.csv').write_text("ID\n1\n2\n3", encoding='utf-8')
+        (tmp_path / 'd1.csv').write_text("ID\n1", encoding='utf-8')
+        (tmp_path / 'd2.csv').write_text("ID\n1\n2", encoding='utf-8')
+        jobs = [{'file1': str(tmp_path / 'master.csv'), 'file2': str(tmp_path / name),
+                 'column1': 'ID', 'column2': 'ID'} for name in ('d1.csv', 'd2.csv')]
+        summaries = run_batch(jobs, tmp_path / 'out', max_workers=2, timestamp='20260101_000000')
+        assert summaries[0]['error'] is None
+        assert '1番目のジョブ' in summaries[1]['error']
+        unique, _ = load_csv(tmp_path / 'out' / '[only_exists]master_20260101_000000.csv')
+        assert unique['ID'].tolist() == ['2', '3']
+
+        jobs[1]['output_dir'] = str(tmp_path / 'out2')
+        summaries = run_batch(jobs, tmp_path / 'out', max_workers=2, timestamp='20260101_000000')
+        assert [s['error'] for s in summaries] == [None, None]
+        assert [s['unique_data1'] for s in summaries] == [2, 1]
+
+    def test_malformed_job_does_not_abort_batch(self, tmp_path):
+        (tmp_path / 'a.csv').write_text("ID\n1", encoding='utf-8')
+        jobs = [
+            {'file2': str(tmp_path / 'a.csv'), 'column1': 'ID', 'column2': 'ID'},
+            'a.csv',
+            {'file1': str(tmp_path / 'a.csv'), 'file2': str(tmp_path / 'a.csv'), 'column1': 'ID', 'column2': 'ID'},
+        ]
+        summaries = run_batch(jobs, tmp_path / 'out', max_workers=2)
+        assert 'file1' in summaries[0]['error']
+        assert summaries[1]['error'] is not None
+        assert summaries[2]['error'] is None
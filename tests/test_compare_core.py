@@ -1,7 +1,17 @@
 """AtasoPy コアロジックのユニットテスト"""
 import pytest
+import numpy as np
 import pandas as pd
-from compare_core import load_csv, compare_data, convert_df_bom, parse_csv_error_detail
+import io
+from compare_core import (
+    load_csv, compare_data, convert_df_bom, parse_csv_error_detail, membership_masks,
+    compare_csv_streaming, compare_csv_sorted, is_sorted_csv, iter_csv_bom, write_csv_bom, iter_rows, write_export, write_zip, export_file_name,
+    read_csv_columns, load_key_column, load_rows, compare_keys, composite_key_codes,
+    diff_data, sniff_csv, split_csv_ranges, load_csv_parallel,
+    KeyIndex, load_key_index, file_digest, PartitionState, read_appended_keys, incremental_partition,
+    partition_rows, page_rows, multiset_masks, duplicate_report,
+    normalize_key, profiling, start_profiling, stop_profiling, stage, add_profile, compact_key, BOM, ResultCache, estimate_nbytes, columnar_format,
+)
 
 
 # ============================================================
@@ -113,6 +123,113 @@ class TestA4_DifferentColumns:
         assert len(self.result['merge_data2'].columns) == 4
 
 
+class TestA5_MembershipMasks:
+    """A-5: membership_masksがisinと同じ結果を返す"""
+
+    def test_masks_match_isin(self):
+        key1 = pd.Series(['1', '2', '3', '3', '5'])
+        key2 = pd.Series(['3', '4', '5', '5'])
+        mask1, mask2 = membership_masks(key1, key2)
+        assert mask1.tolist() == key1.isin(key2).tolist()
+        assert mask2.tolist() == key2.isin(key1).tolist()
+
+    def test_nan_keys_match_each_other(self):
+        csv1 = "ID,名前\n,山田太郎\n2,鈴木花子"
+        csv2 = "ID,名前\n,田中一郎"
+        df1, _ = load_csv(csv1)
+        df2, _ = load_csv(csv2)
+        mask1, mask2 = membership_masks(df1['ID'], df2['ID'])
+        assert mask1.tolist() == df1['ID'].isin(df2['ID']).tolist()
+        assert mask2.tolist() == df2['ID'].isin(df1['ID']).tolist()
+
+    def test_empty_keys(self):
+        mask1, mask2 = membership_masks(pd.Series([], dtype=str), pd.Series(['1']))
+        assert len(mask1) == 0
+        assert mask2.tolist() == [False]
+
+
+class TestA6_CompositeKeys:
+    """A-6: 複数カラムの複合キーでの比較"""
+
+    def setup_method(self):
+        csv1 = "宛名番号,枝番,名前\n1,1,山田太郎\n1,2,山田花子\n2,1,鈴木一郎\n3,,田中次郎"
+        csv2 = "口座番号,支店コード,宛名番号,枝番\nA001,001,1,2\nA002,002,2,2\nA003,003,3,\nA004,004,12,"
+        self.df1, _ = load_csv(csv1)
+        self.df2, _ = load_csv(csv2)
+        self.result = compare_data(self.df1, self.df2, ['宛名番号', '枝番'], ['宛名番号', '枝番'])
+
+    def test_partitions(self):
+        assert self.result['merge_data1']['名前'].tolist() == ['山田花子', '田中次郎']
+        assert self.result['unique_data1']['名前'].tolist() == ['山田太郎', '鈴木一郎']
+        assert self.result['merge_data2']['口座番号'].tolist() == ['A001', 'A003']
+        assert self.result['unique_data2']['口座番号'].tolist() == ['A002', 'A004']
+
+    def test_not_confused_by_concatenation(self):
+        """("1","12")と("11","2")のように連結すると同じになるキーを区別する"""
+        df1 = pd.DataFrame({'a': ['1'], 'b': ['12']})
+        df2 = pd.DataFrame({'a': ['11'], 'b': ['2']})
+        result = compare_data(df1, df2, ['a', 'b'], ['a', 'b'])
+        assert len(result['merge_data1']) == 0
+
+    def test_single_column_list_same_as_name(self):
+        result = compare_data(self.df1, self.df2, ['宛名番号'], ['宛名番号'])
+        assert len(result['merge_data1']) == 4
+        assert len(result['unique_data2']) == 1
+
+    def test_codes_equal_for_equal_keys(self):
+        codes1, codes2 = composite_key_codes(self.df1[['宛名番号', '枝番']], self.df2[['宛名番号', '枝番']])
+        assert codes1[1] == codes2[0]
+        assert codes1[3] == codes2[2]
+        assert len(set(codes1)) == 4
+
+    def test_hash_collision_falls_back_to_exact_codes(self, monkeypatch):
+        """全行が同じハッシュ値になっても正しく比較できる"""
+        monkeypatch.setattr(
+            pd.util, 'hash_pandas_object', lambda obj, index: pd.Series(0, index=obj.index, dtype='uint64')
+        )
+        result = compare_data(self.df1, self.df2, ['宛名番号', '枝番'], ['宛名番号', '枝番'])
+        for key, df in self.result.items():
+            pd.testing.assert_frame_equal(result[key], df)
+
+    def test_column_count_mismatch_raises(self):
+        with pytest.raises(ValueError):
+            compare_keys(self.df1[['宛名番号', '枝番']], self.df2[['宛名番号']])
+
+
+class TestA7_DiffMatchedRows:
+    """A-7: 両方に存在する行の値の違いを検出する"""
+
+    def setup_method(self):
+        csv1 = "宛名番号,名前,住所\n1,山田太郎,東京都\n2,鈴木花子,\n2,鈴木花子,大阪府\n3,田中一郎,愛知県\n4,佐藤二郎,福岡県"
+        csv2 = "宛名番号,氏名,住所,電話番号\n2,鈴木花子,\n1,山田太郎,千葉県\n2,鈴木花子,京都府\n3,田中一郎,愛知県\n5,伊藤三郎,北海道"
+        self.df1, _ = load_csv(csv1)
+        self.df2, _ = load_csv(csv2)
+
+    def test_default_maps_shared_columns(self):
+        result = diff_data(self.df1, self.df2, '宛名番号', '宛名番号')
+        assert result['changed_rows'].columns.tolist() == ['宛名番号', '住所(ファイル1)', '住所(ファイル2)']
+        assert result['change_counts'].to_dict() == {'住所': 2}
+
+    def test_duplicate_keys_paired_in_order(self):
+        result = diff_data(self.df1, self.df2, '宛名番号', '宛名番号')
+        rows = result['changed_rows']
+        assert rows['宛名番号'].tolist() == ['1', '2']
+        assert rows['住所(ファイル1)'].tolist() == ['東京都', '大阪府']
+        assert rows['住所(ファイル2)'].tolist() == ['千葉県', '京都府']
+
+    def test_column_map(self):
+        result = diff_data(
+            self.df1, self.df2, '宛名番号', '宛名番号', column_map={'名前': '氏名', '住所': '住所'}
+        )
+        assert result['change_counts'].to_dict() == {'名前': 0, '住所': 2}
+        assert '氏名(ファイル2)' in result['changed_rows'].columns
+
+    def test_no_changes(self):
+        result = diff_data(self.df1, self.df1, '宛名番号', '宛名番号')
+        assert len(result['changed_rows']) == 0
+        assert result['change_counts'].sum() == 0
+
+
 # ============================================================
 # B. 境界値・エッジケース
 # ============================================================
@@ -234,6 +351,117 @@ class TestC3_DuplicateKeys:
         assert len(result['unique_data2']) == 1   # 宛名番号4×1行
 
 
+class TestC7_MultisetDuplicateKeys:
+    """C-7: 重複キーを件数どおりに1対1で対応付ける（multisetモード）"""
+
+    csv1 = "宛名番号,名前,住所\n1,山田太郎,東京都\n1,山田太郎,神奈川県\n2,鈴木花子,大阪府\n3,田中一郎,愛知県\n3,田中一郎,福岡県\n3,田中一郎,北海道"
+    csv2 = "宛名番号,口座番号\n1,ACC001\n2,ACC002\n2,ACC003\n4,ACC004"
+
+    def test_occurrences_matched_one_to_one(self):
+        df1, _ = load_csv(self.csv1)
+        df2, _ = load_csv(self.csv2)
+        result = compare_data(df1, df2, '宛名番号', '宛名番号', multiset=True)
+        # 宛名番号1はファイル1に2行・ファイル2に1行 → ファイル1の2行目は対応する行が無い
+        assert result['merge_data1']['住所'].tolist() == ['東京都', '大阪府']
+        assert result['unique_data1']['住所'].tolist() == ['神奈川県', '愛知県', '福岡県', '北海道']
+        assert result['merge_data2']['口座番号'].tolist() == ['ACC001', 'ACC002']
+        assert result['unique_data2']['口座番号'].tolist() == ['ACC003', 'ACC004']
+
+    def test_duplicate_report(self):
+        df1, _ = load_csv(self.csv1)
+        df2, _ = load_csv(self.csv2)
+        report = compare_data(df1, df2, '宛名番号', '宛名番号', multiset=True)['duplicates']
+        assert report['宛名番号'].tolist() == ['1', '2', '3']
+        assert report['ファイル1の件数'].tolist() == [2, 1, 3]
+        assert report['ファイル2の件数'].tolist() == [1, 2, 0]
+        assert report['一致件数'].tolist() == [1, 1, 0]
+
+    def test_default_mode_has_no_report(self):
+        df1, _ = load_csv(self.csv1)
+        df2, _ = load_csv(self.csv2)
+        assert 'duplicates' not in compare_data(df1, df2, '宛名番号', '宛名番号')
+
+    def test_composite_key(self):
+        df1 = pd.DataFrame({'口座番号': ['1', '1', '1'], '支店コード': ['A', 'A', 'B']})
+        df2 = pd.DataFrame({'口座番号': ['1', '1'], '支店コード': ['A', 'B']})
+        result = compare_data(df1, df2, ['口座番号', '支店コード'], ['口座番号', '支店コード'], multiset=True)
+        assert result['unique_data1'].index.tolist() == [1]
+        assert len(result['unique_data2']) == 0
+        assert result['duplicates'].columns.tolist()[:2] == ['口座番号', '支店コード']
+        assert result['duplicates']['支店コード'].tolist() == ['A']
+
+    def test_key_index_same_as_series(self):
+        key1 = pd.Series(['1', '1', None, None, '3'], dtype='str')
+        key2 = pd.Series(['1', None, '4', '4'], dtype='str')
+        expected = multiset_masks(key1, key2)
+        masks = compare_keys(KeyIndex.from_series(key1), key2, multiset=True)
+        assert masks[0].tolist() == expected[0].tolist()
+        assert masks[1].tolist() == expected[1].tolist()
+        pd.testing.assert_frame_equal(
+            duplicate_report(KeyIndex.from_series(key1), KeyIndex.from_series(key2), 'ID'),
+            duplicate_report(key1, key2, 'ID'),
+        )
+
+    def test_key_index_all_blank_keys(self):
+        """キーが全行空欄（NaNが重複）の索引でも重複キーのレポートを作れる"""
+        key1 = pd.Series([None, None], dtype='str')
+        key2 = pd.Series(['1'], dtype='str')
+        report = duplicate_report(KeyIndex.from_series(key1), key2, 'ID')
+        pd.testing.assert_frame_equal(report, duplicate_report(key1, key2, 'ID'))
+        assert len(report) == 1
+
+
+class TestC8_KeyNormalizers:
+    """C-8: キーを正規化して比較する（出力の値はそのまま）"""
+
+    def test_strip(self):
+        df1, _ = load_csv("ID,名前\n 001,田中一郎\n002 ,佐藤二郎")
+        df2, _ = load_csv("ID,名前\n001,田中一郎\n002,佐藤二郎")
+        result = compare_data(df1, df2, 'ID', 'ID', normalizers=['strip'])
+        assert result['merge_data1']['ID'].tolist() == [' 001', '002 ']
+
+    def test_zero_padding(self):
+        df1, _ = load_csv("コード,名前\n001,山田太郎\n010,田中一郎\n000,佐藤二郎")
+        df2, _ = load_csv("コード,名前\n1,山田太郎\n10,田中一郎\n0,佐藤二郎")
+        for normalizers in (['lstrip0'], ['zfill:3']):
+            result = compare_data(df1, df2, 'コード', 'コード', normalizers=normalizers)
+            assert len(result['merge_data1']) == 3
+            assert result['merge_data2']['コード'].tolist() == ['1', '10', '0']
+
+    def test_nfkc_and_casefold(self):
+        df1, _ = load_csv("ID,名前\n１２３,全角数字\nｶﾀｶﾅ,半角カナ\nABC,大文字")
+        df2, _ = load_csv("ID,名前\n123,半角数字\nカタカナ,全角カナ\nabc,小文字")
+        result = compare_data(df1, df2, 'ID', 'ID', normalizers=['nfkc', 'casefold'])
+        assert len(result['unique_data1']) == 0
+        assert result['merge_data1']['ID'].tolist() == ['１２３', 'ｶﾀｶﾅ', 'ABC']
+
+    def test_applied_in_order(self):
+        key = pd.Series([' 7 '], dtype='str')
+        assert normalize_key(key, ['zfill:3', 'strip']).tolist() == ['7']
+        assert normalize_key(key, ['strip', 'zfill:3']).tolist() == ['007']
+
+    def test_composite_key_and_key_index(self):
+        keys = pd.DataFrame({'口座番号': [' 01', None], '支店コード': ['Ａ', 'b']})
+        normalized = normalize_key(keys, ['strip', 'nfkc', 'lstrip0'])
+        assert normalized['口座番号'].tolist()[0] == '1'
+        assert normalized['支店コード'].tolist() == ['A', 'b']
+
+        key = pd.Series([' 01', '1', None, 'ｱ'], dtype='str')
+        index = normalize_key(KeyIndex.from_series(key), ['strip', 'lstrip0', 'nfkc'])
+        mask1, _ = compare_keys(index, pd.Series(['1', 'ア'], dtype='str'))
+        assert mask1.tolist() == [True, True, False, True]
+
+    def test_diff_data(self):
+        df1 = pd.DataFrame({'ID': ['001'], '名前': ['山田']})
+        df2 = pd.DataFrame({'ID': ['1'], '名前': ['山田太郎']})
+        result = diff_data(df1, df2, 'ID', 'ID', normalizers=['lstrip0'])
+        assert result['changed_rows']['ID'].tolist() == ['001']
+
+    def test_unknown_normalizer(self):
+        with pytest.raises(ValueError):
+            normalize_key(pd.Series(['1']), ['upper'])
+
+
 class TestC4_ZeroPadding:
     """C-4: ゼロパディング（dtype=strの仕様確認）"""
 
@@ -341,6 +569,112 @@ class TestE1_BOMOutput:
         assert '山田太郎' in content
 
 
+class TestE3_StreamingBOMWriter:
+    """E-3: チャンク単位のBOM付き出力がconvert_df_bomと一致する"""
+
+    def setup_method(self):
+        csv = "ID,名前,備考\n" + "\n".join(f"{i},社員{i:04d},\"備考,{i}\"" for i in range(1, 8))
+        self.df, _ = load_csv(csv)
+
+    def test_chunks_identical_to_whole_to_csv(self):
+        """チャンクをつなげると、全体を一度にto_csvしたBOM付きUTF-8と同じ"""
+        chunks = list(iter_csv_bom(self.df, chunksize=3))
+        assert chunks[0] == b'\xef\xbb\xbf'
+        assert len(chunks) == 4
+        assert b''.join(chunks) == self.df.to_csv(index=False).encode('utf-8-sig')
+        assert b''.join(chunks).startswith('\ufeffID,名前,備考\n1,社員0001,"備考,1"\n'.encode('utf-8'))
+
+    def test_write_to_buffer(self):
+        buffer = io.BytesIO()
+        write_csv_bom(self.df, buffer, chunksize=2)
+        assert buffer.getvalue() == convert_df_bom(self.df)
+
+    def test_write_to_path(self, tmp_path):
+        path = tmp_path / 'out.csv'
+        write_csv_bom(self.df, path, chunksize=5)
+        assert path.read_bytes() == convert_df_bom(self.df)
+
+    def test_header_only(self):
+        df, _ = load_csv("ID,名前")
+        assert b''.join(iter_csv_bom(df, chunksize=2)) == b'\xef\xbb\xbfID,\xe5\x90\x8d\xe5\x89\x8d\n'
+
+
+class TestE4_ExportFormats:
+    """E-4: 圧縮CSV・Parquet・ZIPでの出力"""
+
+    def setup_method(self):
+        csv = "ID,名前,備考\n" + "\n".join(f"{i:03d},社員{i},\"備考,{i}\"" for i in range(1, 8))
+        self.df, _ = load_csv(csv)
+
+    def export(self, data, fmt):
+        buffer = io.BytesIO()
+        write_export(data, buffer, fmt, chunksize=3)
+        return buffer.getvalue()
+
+    def test_gzip_csv(self):
+        import gzip
+        assert gzip.decompress(self.export(self.df, 'csv.gz')) == convert_df_bom(self.df)
+
+    def test_zstd_csv(self):
+        pa = pytest.importorskip('pyarrow')
+        data = self.export(self.df, 'csv.zst')
+        assert pa.input_stream(io.BytesIO(data), compression='zstd').read() == convert_df_bom(self.df)
+
+    def test_parquet_keeps_leading_zeros(self):
+        pq = pytest.importorskip('pyarrow.parquet')
+        data = self.export(self.df, 'parquet')
+        assert pq.ParquetFile(io.BytesIO(data)).num_row_groups == 3
+        restored = pd.read_parquet(io.BytesIO(data))
+        assert restored['ID'].tolist() == self.df['ID'].tolist()
+        assert restored.columns.tolist() == ['ID', '名前', '備考']
+
+    def test_parquet_header_only(self):
+        pytest.importorskip('pyarrow')
+        df, _ = load_csv("ID,名前")
+        restored = pd.read_parquet(io.BytesIO(self.export(df, 'parquet')))
+        assert restored.columns.tolist() == ['ID', '名前'] and len(restored) == 0
+
+    def test_parquet_object_columns_after_empty_chunk(self):
+        """pandas 2のobject型の列で最初のチャンクが空でも、以降のチャンクを文字列として書ける"""
+        pytest.importorskip('pyarrow')
+        df = self.df.astype(object)
+        data = self.export(iter([df.iloc[:0], df]), 'parquet')
+        restored = pd.read_parquet(io.BytesIO(data))
+        assert restored['ID'].tolist() == self.df['ID'].tolist()
+        assert restored.columns.tolist() == ['ID', '名前', '備考']
+
+    def test_streamed_rows_same_as_dataframe(self):
+        """iter_rowsのチャンクから書いても、読み込んだDataFrameから書いた場合と同じ"""
+        source = convert_df_bom(self.df)
+        mask = np.array([True, False] * 3 + [True])
+        expected = self.df[mask]
+        for fmt in ('csv', 'csv.gz'):
+            assert self.export(iter_rows(source, mask, chunksize=2), fmt) == self.export(expected, fmt)
+
+    def test_unknown_format(self):
+        with pytest.raises(ValueError):
+            self.export(self.df, 'xlsx')
+
+    def test_file_name(self):
+        assert export_file_name('[only_exists]a_20260101.csv', 'csv.zst') == '[only_exists]a_20260101.csv.zst'
+        assert export_file_name('[only_exists]a_20260101.csv', 'parquet') == '[only_exists]a_20260101.parquet'
+
+    def test_zip_loads_partitions_lazily(self):
+        import zipfile
+        loaded = []
+
+        def load(name):
+            loaded.append(name)
+            return self.df
+
+        buffer = io.BytesIO()
+        write_zip({'a.csv': lambda: load('a'), 'b.csv': self.df}, buffer)
+        assert loaded == ['a']
+        with zipfile.ZipFile(buffer) as archive:
+            assert archive.namelist() == ['a.csv', 'b.csv']
+            assert archive.read('a.csv') == convert_df_bom(self.df)
+
+
 class TestE2_OutputCounts:
     """E-2: 件数の一致"""
 
@@ -355,6 +689,969 @@ class TestE2_OutputCounts:
         assert len(result['unique_data2']) + len(result['merge_data2']) == len(df2)
 
 
+# ============================================================
+# F. ストリーミング比較
+# ============================================================
+
+class TestF1_StreamingCompare:
+    """F-1: チャンク単位の比較結果がcompare_dataと一致する"""
+
+    KEYS = ['unique_data1', 'unique_data2', 'merge_data1', 'merge_data2']
+
+    def setup_method(self):
+        self.csv1 = "宛名番号,名前,備考\n1,山田太郎,\n2,鈴木花子,転居\n3,田中一郎,\n3,田中一郎,重複\n5,伊藤三郎,"
+        self.csv2 = "口座番号,宛名番号\nA001,3\nA002,4\nA003,1\nA004,6"
+        self.outputs = {key: io.BytesIO() for key in self.KEYS}
+        self.counts, self.err = compare_csv_streaming(
+            io.BytesIO(self.csv1.encode('utf-8')), io.BytesIO(self.csv2.encode('utf-8')),
+            '宛名番号', '宛名番号', self.outputs, chunksize=2,
+        )
+
+    def test_counts(self):
+        assert self.err is None
+        assert self.counts == {'unique_data1': 2, 'unique_data2': 2, 'merge_data1': 3, 'merge_data2': 2}
+
+    def test_output_identical_to_convert_df_bom(self):
+        df1, _ = load_csv(self.csv1)
+        df2, _ = load_csv(self.csv2)
+        result = compare_data(df1, df2, '宛名番号', '宛名番号')
+        for key in self.KEYS:
+            assert self.outputs[key].getvalue() == convert_df_bom(result[key])
+
+    def test_writes_to_paths(self, tmp_path):
+        path1 = tmp_path / 'file1.csv'
+        path2 = tmp_path / 'file2.csv'
+        path1.write_text(self.csv1, encoding='utf-8')
+        path2.write_text(self.csv2, encoding='utf-8')
+        outputs = {key: tmp_path / f'{key}.csv' for key in self.KEYS}
+        counts, err = compare_csv_streaming(path1, path2, '宛名番号', '宛名番号', outputs, chunksize=2)
+        assert err is None
+        assert counts == self.counts
+        assert outputs['unique_data2'].read_bytes()[:3] == b'\xef\xbb\xbf'
+
+    def test_broken_csv_returns_error(self):
+        broken = "宛名番号,名前\n1,山田太郎\n2,鈴木花子,追加"
+        counts, err = compare_csv_streaming(
+            io.BytesIO(broken.encode('utf-8')), io.BytesIO(self.csv2.encode('utf-8')),
+            '宛名番号', '宛名番号', {key: io.BytesIO() for key in self.KEYS},
+        )
+        assert counts is None
+        assert '3行目' in err
+
+
+class TestF2_SortedMerge:
+    """F-2: キーの昇順に並んだCSV同士のマージ結合による比較"""
+
+    KEYS = ['unique_data1', 'unique_data2', 'merge_data1', 'merge_data2']
+
+    def setup_method(self):
+        self.csv1 = "宛名番号,名前\n,空欄\n001,山田太郎\n002,鈴木花子\n002,鈴木花子\n002,重複\n004,田中一郎\n007,伊藤三郎"
+        self.csv2 = "口座番号,宛名番号\nA000,\nA002,002\nA003,003\nA004,004\nA005,004\nA009,009"
+
+    def compare(self, csv1, csv2, column1='宛名番号', column2='宛名番号', chunksize=2):
+        outputs = {key: io.BytesIO() for key in self.KEYS}
+        counts, err = compare_csv_sorted(
+            io.BytesIO(csv1.encode('utf-8')), io.BytesIO(csv2.encode('utf-8')),
+            column1, column2, outputs, chunksize=chunksize,
+        )
+        return counts, err, outputs
+
+    @pytest.mark.parametrize('chunksize', [1, 2, 3, 100])
+    def test_same_as_compare_data(self, chunksize):
+        """チャンクの大きさによらず、compare_dataの結果と同じCSVになる"""
+        counts, err, outputs = self.compare(self.csv1, self.csv2, chunksize=chunksize)
+        assert err is None
+        result = compare_data(load_csv(self.csv1)[0], load_csv(self.csv2)[0], '宛名番号', '宛名番号')
+        for key in self.KEYS:
+            assert outputs[key].getvalue() == convert_df_bom(result[key])
+            assert counts[key] == len(result[key])
+
+    def test_composite_key(self):
+        csv1 = "支店,口座\n01,9\n02,1\n02,3"
+        csv2 = "支店,口座\n01,9\n02,3\n03,1"
+        counts, err, _ = self.compare(csv1, csv2, ['支店', '口座'], ['支店', '口座'], chunksize=1)
+        assert err is None
+        assert counts == {'unique_data1': 1, 'unique_data2': 1, 'merge_data1': 2, 'merge_data2': 2}
+
+    def test_header_only(self):
+        counts, err, outputs = self.compare("宛名番号,名前", self.csv2)
+        assert err is None
+        assert outputs['unique_data1'].getvalue() == BOM + '宛名番号,名前\n'.encode('utf-8')
+        assert counts['unique_data2'] == 6
+
+    def test_unsorted_returns_error(self):
+        counts, err, _ = self.compare(self.csv1, "宛名番号\n001\n003\n002")
+        assert counts is None
+        assert err == 'ファイル2のキーが昇順に並んでいません（4行目）'
+
+    def test_is_sorted_csv(self):
+        assert is_sorted_csv(io.BytesIO(self.csv1.encode('utf-8')), '宛名番号', chunksize=2)
+        assert not is_sorted_csv(io.BytesIO("ID\n2\n1".encode('utf-8')), 'ID')
+        assert not is_sorted_csv(io.BytesIO("支店,口座\n01,2\n01,1".encode('utf-8')), ['支店', '口座'])
+
+
+# ============================================================
+# G. キーカラムのみの読み込み
+# ============================================================
+
+class TestG1_KeyColumnLoad:
+    """G-1: ヘッダー・キーカラムだけを読み込み、必要な行だけ全カラムで読む"""
+
+    def setup_method(self):
+        self.csv1 = 'ID,名前,住所\n1,山田太郎,"東京都新宿区, 都庁"\n\n2,,神奈川県\n3,"田中\n一郎",大阪府'
+        self.csv2 = "ID,名前\n1,山田太郎\n3,田中一郎\n4,佐藤二郎"
+
+    def test_read_columns(self):
+        columns, err = read_csv_columns(self.csv1)
+        assert err is None
+        assert columns == ['ID', '名前', '住所']
+
+    def test_key_column_same_as_load_csv(self):
+        df, _ = load_csv(self.csv1)
+        for column in df.columns:
+            key, err = load_key_column(self.csv1, column)
+            assert err is None
+            assert key.tolist() == df[column].tolist()
+
+    def test_bytes_and_file_sources(self, tmp_path):
+        data = ('\ufeff' + self.csv1).encode('utf-8')
+        path = tmp_path / 'file1.csv'
+        path.write_bytes(data)
+        for source in (data, io.BytesIO(data), path):
+            key, err = load_key_column(source, 'ID')
+            assert err is None
+            assert key.tolist() == ['1', '2', '3']
+
+    def test_extra_fields_return_same_error_as_load_csv(self):
+        csv = "ID,名前,住所\n1,山田太郎,東京都\n2,鈴木花子,神奈川県\n3,田中一郎,大阪府,中央区,追加データ1\n4,佐藤二郎,愛知県"
+        key, err = load_key_column(csv, '名前')
+        assert key is None
+        assert err == load_csv(csv)[1]
+        assert '4行目' in err
+
+    def test_large_input(self):
+        """パーサーの内部チャンク（約26万行）を超える行数でも読み込める"""
+        csv = 'ID,名前\n' + ''.join(f'{i},名前{i}\n' for i in range(300000))
+        key, err = load_key_column(csv, 'ID')
+        assert err is None
+        assert len(key) == 300000
+        assert key.iloc[-1] == '299999'
+
+    def test_short_rows_same_as_load_csv(self):
+        """ヘッダーより列の少ない行は、load_csvと同じく足りないカラムを欠損値にする"""
+        csv = 'ID,名前,住所\n1,山田太郎,東京都\n2,"鈴木\n花子"\n3\n\n4,田中一郎,大阪府'
+        df, _ = load_csv(csv)
+        keys, err = load_key_column(csv, ['名前', 'ID'])
+        assert err is None
+        assert keys.columns.tolist() == ['名前', 'ID']
+        for column in ('名前', 'ID'):
+            assert keys[column].tolist() == df[column].tolist()
+
+    def test_without_pyarrow(self, monkeypatch):
+        """pyarrowが無い環境では、pandasで少しずつ読んで同じ結果・エラーを返す"""
+        import compare_core
+
+        def no_pyarrow(*args, **kwargs):
+            raise ImportError('pyarrow')
+        monkeypatch.setattr(compare_core, '_read_key_columns_pyarrow', no_pyarrow)
+        monkeypatch.setattr(compare_core, 'KEY_CHUNK_CELLS', 4)
+        df, _ = load_csv(self.csv1)
+        key, err = load_key_column(self.csv1, 'ID')
+        assert err is None
+        assert key.tolist() == df['ID'].tolist()
+        csv = "ID,名前\n1,山田太郎\n2,鈴木花子\n3,田中一郎\n4,佐藤二郎,愛知県"
+        key, err = load_key_column(csv, 'ID')
+        assert key is None
+        assert err == load_csv(csv)[1]
+
+    def test_wide_file_memory(self, tmp_path):
+        """列の多いCSVでも、キーカラムだけを読むメモリはファイルの大きさより十分小さい"""
+        resource = pytest.importorskip('resource')
+        import subprocess
+        import sys
+        from pathlib import Path
+        path = tmp_path / 'wide.csv'
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(','.join(f'c{i}' for i in range(200)) + '\n')
+            row = ','.join(['abcde'] * 199)
+            for i in range(60_000):
+                f.write(f'{i:08d},{row}\n')
+        script = (
+            'import resource, sys\n'
+            'from pathlib import Path\n'
+            'import pyarrow.csv\n'
+            'from compare_core import load_key_column\n'
+            'before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n'
+            'key, err = load_key_column(Path(sys.argv[1]), "c0")\n'
+            'assert err is None and len(key) == 60000\n'
+            'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)\n'
+        )
+        pytest.importorskip('pyarrow')
+        result = subprocess.run(
+            [sys.executable, '-c', script, str(path)], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).resolve().parent.parent,
+        )
+        # ru_maxrssの単位はLinuxではKB、macOSではバイト
+        peak = int(result.stdout) * (1 if sys.platform == 'darwin' else 1024)
+        assert peak < path.stat().st_size / 2
+
+    def test_composite_key_columns(self):
+        keys, err = load_key_column(self.csv1, ['住所', 'ID'])
+        assert err is None
+        assert keys.columns.tolist() == ['住所', 'ID']
+        assert keys['ID'].tolist() == ['1', '2', '3']
+
+    def test_load_rows_same_as_compare_data(self):
+        key1, _ = load_key_column(self.csv1, 'ID')
+        key2, _ = load_key_column(self.csv2, 'ID')
+        mask1, _ = membership_masks(key1, key2)
+        df1, _ = load_csv(self.csv1)
+        df2, _ = load_csv(self.csv2)
+        result = compare_data(df1, df2, 'ID', 'ID')
+        pd.testing.assert_frame_equal(load_rows(self.csv1, mask1, chunksize=2), result['merge_data1'])
+        pd.testing.assert_frame_equal(load_rows(self.csv1, ~mask1, chunksize=2), result['unique_data1'])
+
+
+class TestG2_CompactKeys:
+    """G-2: キー列をArrowの文字列型で持つ"""
+
+    def object_keys(self, n=10_000):
+        return pd.Series([str(i).zfill(10) for i in range(n)] + [None], dtype=object)
+
+    def test_values_kept(self):
+        key = self.object_keys()
+        compact = compact_key(key)
+        assert compact.dtype == pd.StringDtype('pyarrow')
+        assert compact.tolist()[:2] == ['0000000000', '0000000001']
+        assert compact.isna().tolist() == key.isna().tolist()
+        assert compact.memory_usage(deep=True) < key.memory_usage(deep=True) / 2
+
+    def test_non_string_keys_unchanged(self):
+        key = pd.Series([1, '1'], dtype=object)
+        assert compact_key(key) is key
+        key = pd.Series(['1'], dtype='str')
+        assert compact_key(key) is key
+
+    def test_composite_keys_with_missing_values(self):
+        df1 = pd.DataFrame({'口座番号': ['001', None, '001'], '支店コード': ['A', 'B', None]}, dtype=object)
+        df2 = pd.DataFrame({'口座番号': ['001', None], '支店コード': ['A', 'B']}, dtype=object)
+        result = compare_data(df1, df2, ['口座番号', '支店コード'], ['口座番号', '支店コード'])
+        assert result['unique_data1'].index.tolist() == [2]
+        assert result['merge_data1']['口座番号'].tolist() == ['001', '']
+        assert len(result['unique_data2']) == 0
+
+    def test_output_bytes_unchanged(self):
+        df1 = pd.DataFrame({'宛名番号': ['0001', '0002'], '名前': ['山田', '鈴木']}, dtype=object)
+        df2 = pd.DataFrame({'宛名番号': ['0001']}, dtype=object)
+        result = compare_data(df1, df2, '宛名番号', '宛名番号')
+        assert convert_df_bom(result['unique_data1']) == BOM + '宛名番号,名前\n0002,鈴木\n'.encode('utf-8')
+
+
+# ============================================================
+# H. pyarrowエンジン
+# ============================================================
+
+class TestH1_PyArrowEngine:
+    """H-1: engine='pyarrow'でも通常のエンジンと同じ値・比較結果になる"""
+
+    def setup_method(self):
+        pytest.importorskip('pyarrow')
+        self.csv1 = 'コード,名前,備考\n001,山田太郎,\n010,"田中,一郎",NA\n\n100,"佐藤\n二郎",備考'
+        self.csv2 = "コード,名前\n001,山田太郎\n100,佐藤二郎\n200,伊藤三郎"
+
+    def test_arrow_string_dtype(self):
+        df, err = load_csv(self.csv1, engine='pyarrow')
+        assert err is None
+        assert all(dtype == pd.StringDtype('pyarrow') for dtype in df.dtypes)
+
+    def test_same_values_as_default_engine(self):
+        df_arrow, _ = load_csv(self.csv1, engine='pyarrow')
+        df_default, _ = load_csv(self.csv1)
+        assert df_arrow.columns.tolist() == df_default.columns.tolist()
+        assert df_arrow.fillna('').values.tolist() == df_default.fillna('').values.tolist()
+
+    def test_leading_zeros_preserved(self):
+        df, _ = load_csv(self.csv1, engine='pyarrow')
+        assert df['コード'].tolist() == ['001', '010', '100']
+
+    def test_compare_data_output_identical(self):
+        result_arrow = compare_data(
+            load_csv(self.csv1, engine='pyarrow')[0], load_csv(self.csv2, engine='pyarrow')[0], 'コード', 'コード'
+        )
+        result_default = compare_data(load_csv(self.csv1)[0], load_csv(self.csv2)[0], 'コード', 'コード')
+        for key, df in result_default.items():
+            assert convert_df_bom(result_arrow[key]) == convert_df_bom(df)
+
+    def test_broken_csv_error_has_line_number(self):
+        csv = "ID,名前,住所\n1,山田太郎,東京都\n2,鈴木花子,神奈川県\n3,田中一郎,大阪府,中央区,追加データ1,追加データ2\n4,佐藤二郎,愛知県"
+        df, err = load_csv(csv, engine='pyarrow')
+        assert df is None
+        assert '4行目' in err
+        assert '6列' in err
+
+    def test_na_values_without_pandas_internals(self, monkeypatch):
+        """pandasの非公開モジュールが無くても、通常のエンジンと同じ値を欠損値にする"""
+        import sys
+        from compare_core import _DEFAULT_NA_VALUES
+        parsers = pytest.importorskip('pandas._libs.parsers')
+        assert _DEFAULT_NA_VALUES == sorted(parsers.STR_NA_VALUES)
+        monkeypatch.setitem(sys.modules, 'pandas._libs.parsers', None)
+        csv = 'ID,値\n1,NA\n2,null\n3,None\n4,'
+        df, err = load_csv(csv, engine='pyarrow')
+        assert err is None
+        assert df['値'].isna().tolist() == load_csv(csv)[0]['値'].isna().tolist() == [True] * 4
+
+    def test_short_row_falls_back_to_default_engine(self):
+        df, err = load_csv("ID,名前,住所\n1,山田太郎", engine='pyarrow')
+        assert err is None
+        assert df.fillna('').values.tolist() == [['1', '山田太郎', '']]
+
+
+# ============================================================
+# I. 文字コード・区切り文字の判定
+# ============================================================
+
+class TestI1_SniffCSV:
+    """I-1: ファイル先頭だけで文字コード・区切り文字を判定して読み込む"""
+
+    CSV = "宛名番号,名前,住所\n001,山田太郎,東京都\n002,鈴木花子,神奈川県"
+
+    @pytest.mark.parametrize('encoding, bom', [
+        ('utf-8', b''),
+        ('utf-8', b'\xef\xbb\xbf'),
+        ('cp932', b''),
+        ('utf-16-le', b'\xff\xfe'),
+        ('utf-16-be', b'\xfe\xff'),
+        ('utf-16-le', b''),
+    ])
+    def test_encodings(self, encoding, bom):
+        data = bom + self.CSV.encode(encoding)
+        dialect = sniff_csv(data)
+        assert dialect['encoding'] == encoding
+        assert dialect['bom'] == bom
+        df, err = load_csv(data)
+        assert err is None
+        assert df['名前'].tolist() == ['山田太郎', '鈴木花子']
+        key, err = load_key_column(data, '宛名番号')
+        assert key.tolist() == ['001', '002']
+
+    @pytest.mark.parametrize('sep', [',', '\t', ';', '|'])
+    def test_delimiters(self, sep):
+        csv = self.CSV.replace(',', sep)
+        assert sniff_csv(csv)['sep'] == sep
+        df, err = load_csv(csv.encode('cp932'))
+        assert err is None
+        assert df.columns.tolist() == ['宛名番号', '名前', '住所']
+
+    def test_cp932_cut_in_middle_of_character(self):
+        data = self.CSV.encode('cp932')
+        assert sniff_csv(data, sample_size=len('宛名番号,名'.encode('cp932')) + 1)['encoding'] == 'cp932'
+
+    def test_reads_only_head_of_file(self, tmp_path):
+        path = tmp_path / 'large.csv'
+        path.write_bytes(self.CSV.encode('cp932') + b'\n' + b'\x82' * 10)  # 先頭以降は壊れたバイト列
+        assert sniff_csv(path, sample_size=16)['encoding'] == 'cp932'
+
+    @pytest.mark.parametrize('encoding', ['cp932', 'utf-8'])
+    def test_non_ascii_after_head(self, tmp_path, encoding):
+        """先頭の数KBがASCII文字だけでも、後から現れる日本語の文字コードで全体を読む"""
+        rows = [f'{i:06d},name{i},tokyo' for i in range(5000)] + ['999999,山田太郎,東京都']
+        path = tmp_path / 'late.csv'
+        path.write_bytes(b'ID,name,address\n'
+                         + '\n'.join(rows).encode(encoding) + b'\n')
+        assert path.stat().st_size > 64 * 1024
+
+        df, err = load_csv(path)
+        assert err is None
+        assert df['name'].iloc[-1] == '山田太郎'
+        assert load_csv(path, engine='pyarrow')[0]['address'].iloc[-1] == '東京都'
+        assert load_csv_parallel(path, workers=2)[0]['name'].iloc[-1] == '山田太郎'
+        key, err = load_key_column(path, 'name')
+        assert err is None
+        assert key.iloc[-1] == '山田太郎'
+        mask = np.zeros(len(rows), dtype=bool)
+        mask[-1] = True
+        assert load_rows(path, mask, chunksize=1000)['address'].tolist() == ['東京都']
+
+    def test_utf8_or_cp932_decoder_split_input(self):
+        """最初のASCII以外の文字が入力の区切りで途切れても正しく判定する"""
+        import codecs
+        for encoding in ('cp932', 'utf-8'):
+            data = 'ab,山田\n'.encode(encoding)
+            decoder = codecs.getincrementaldecoder('utf-8-or-cp932')()
+            text = ''.join(decoder.decode(data[i:i + 1]) for i in range(len(data))) + decoder.decode(b'', True)
+            assert text == 'ab,山田\n'
+
+    def test_undecodable_returns_error(self):
+        df, err = load_csv(b'ID,name\n1,\x81\x20\x81\x20')
+        assert df is None
+        assert '文字コード' in err
+
+
+# ============================================================
+# J. ローカルファイルの並列読み込み
+# ============================================================
+
+class TestJ1_ParallelLoad:
+    """J-1: メモリマップで行単位に分割し、並列に読み込む"""
+
+    def setup_method(self):
+        rows = []
+        for i in range(1, 41):
+            if i % 3 == 0:
+                rows.append(f'{i:03d},"田中,{i}","東京都\n新宿区{i}"')
+            elif i % 5 == 0:
+                rows.append(f'{i:03d},"引用符""{i}""",')
+            else:
+                rows.append(f'{i:03d},社員{i},大阪府')
+        self.csv = "ID,名前,住所\n" + "\n".join(rows) + "\n"
+
+    def write(self, tmp_path, data):
+        path = tmp_path / 'local.csv'
+        path.write_bytes(data)
+        return path
+
+    def test_ranges_split_at_line_boundaries(self, tmp_path):
+        path = self.write(tmp_path, self.csv.encode('utf-8'))
+        data = path.read_bytes()
+        header_end, ranges = split_csv_ranges(path, 7)
+        assert len(ranges) > 1
+        assert ranges[0][0] == header_end
+        assert ranges[-1][1] == len(data)
+        for start, end in ranges:
+            assert data[start - 1:start] == b'\n'
+            assert data[:start].count(b'"') % 2 == 0
+
+    def test_progress(self, tmp_path):
+        path = self.write(tmp_path, self.csv.encode('utf-8'))
+        calls = []
+        df, err = load_csv_parallel(path, workers=4, progress=lambda done, total: calls.append((done, total)))
+        assert err is None
+        assert calls[-1][0] == calls[-1][1] > 1
+
+    @pytest.mark.parametrize('encoding, bom', [('utf-8', b''), ('utf-8', b'\xef\xbb\xbf'), ('cp932', b'')])
+    def test_same_as_load_csv(self, tmp_path, encoding, bom):
+        path = self.write(tmp_path, bom + self.csv.encode(encoding))
+        df, err = load_csv_parallel(path, workers=4)
+        assert err is None
+        pd.testing.assert_frame_equal(df, load_csv(path)[0])
+
+    def test_bounded_ranges_in_flight(self, tmp_path, monkeypatch):
+        """小さな範囲に分け、読み終わっていない範囲はワーカー数の2倍までにする"""
+        import compare_core
+        from concurrent.futures import Future
+        submitted = []
+
+        class SyncExecutor:
+            def __init__(self, workers):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def submit(self, func, *args):
+                submitted.append(args)
+                future = Future()
+                future.set_result(func(*args))
+                return future
+
+        monkeypatch.setattr(compare_core, 'PARALLEL_RANGE_BYTES', 64)
+        monkeypatch.setattr(compare_core, 'ProcessPoolExecutor', SyncExecutor)
+        path = self.write(tmp_path, self.csv.encode('utf-8'))
+        mask = np.ones(40, dtype=bool)
+        chunks = []
+        for chunk in iter_rows(path, mask, workers=2):
+            chunks.append(chunk)
+            assert len(submitted) - len(chunks) <= 4
+        assert len(chunks) > 4
+        pd.testing.assert_frame_equal(pd.concat(chunks), load_csv(path)[0].fillna(''))
+
+    def test_header_only(self, tmp_path):
+        path = self.write(tmp_path, "ID,名前\n".encode('utf-8'))
+        df, err = load_csv_parallel(path, workers=4)
+        assert err is None
+        assert df.columns.tolist() == ['ID', '名前']
+        assert len(df) == 0
+
+    def test_error_has_line_number_of_whole_file(self, tmp_path):
+        path = self.write(tmp_path, (self.csv + "999,追加,列,あり\n").encode('utf-8'))
+        df, err = load_csv_parallel(path, workers=4)
+        assert df is None
+        assert err == load_csv(path)[1]
+
+    def test_load_rows_parallel(self, tmp_path):
+        path = self.write(tmp_path, self.csv.encode('utf-8'))
+        key, _ = load_key_column(path, 'ID')
+        mask = key.str.endswith('0').to_numpy()
+        pd.testing.assert_frame_equal(load_rows(path, mask, workers=4), load_rows(path, mask))
+
+
+# ============================================================
+# K. キー索引の保存・再利用
+# ============================================================
+
+class TestK1_KeyIndex:
+    """K-1: ディスクに保存したキー索引で比較する"""
+
+    csv = "宛名番号,名前\n0001,山田\n0002,佐藤\n,不明\n0001,山田2\n0003,鈴木\n"
+
+    def keys(self, *values):
+        return pd.Series(list(values), dtype='str')
+
+    def test_same_as_membership_masks(self):
+        key1 = self.keys('0001', '0002', None, '0001', '0003', 'ｱ')
+        key2 = self.keys('0003', None, '9999', '0001', 'ｱ')
+        expected = membership_masks(key1, key2)
+        for masks in (
+            compare_keys(KeyIndex.from_series(key1), key2),
+            compare_keys(key1, KeyIndex.from_series(key2)),
+            compare_keys(KeyIndex.from_series(key1), KeyIndex.from_series(key2)),
+        ):
+            assert masks[0].tolist() == expected[0].tolist()
+            assert masks[1].tolist() == expected[1].tolist()
+
+    def test_nan_only_on_one_side(self):
+        mask1, mask2 = compare_keys(KeyIndex.from_series(self.keys('1', None)), self.keys('1'))
+        assert mask1.tolist() == [True, False]
+        assert mask2.tolist() == [True]
+
+    def test_empty(self):
+        mask1, mask2 = compare_keys(KeyIndex.from_series(self.keys()), self.keys('1'))
+        assert mask1.tolist() == []
+        assert mask2.tolist() == [False]
+
+    def test_reuses_saved_index(self, tmp_path):
+        path = tmp_path / 'master.csv'
+        path.write_text(self.csv, encoding='utf-8')
+        digest = file_digest(path)
+        index, err = load_key_index(path, '宛名番号', digest, tmp_path / 'index')
+        assert err is None
+        assert len(index) == 5
+
+        # 2回目はCSVを読まず、保存済みの索引をメモリマップで開く
+        path.unlink()
+        reopened, err = load_key_index(path, '宛名番号', digest, tmp_path / 'index')
+        assert err is None
+        assert isinstance(reopened.codes, np.memmap)
+        mask1, mask2 = compare_keys(reopened, self.keys('0001', '0004', None))
+        assert mask1.tolist() == [True, False, True, True, False]
+        assert mask2.tolist() == [True, False, True]
+
+    def test_error(self, tmp_path):
+        path = tmp_path / 'master.csv'
+        path.write_text(self.csv + "0004,高橋,余分,列\n", encoding='utf-8')
+        index, err = load_key_index(path, '宛名番号', file_digest(path), tmp_path / 'index')
+        assert index is None
+        assert err
+        assert not list((tmp_path / 'index').glob('*'))
+
+
+class TestK2_IncrementalUpdate:
+    """K-2: ファイル1の追記・削除分だけで比較結果を更新する"""
+
+    def keys(self, *values):
+        return pd.Series(list(values), dtype='str')
+
+    def assert_same_as_full(self, state, key1, key2):
+        mask1, mask2 = membership_masks(key1, key2)
+        assert state.mask1.tolist() == mask1.tolist()
+        assert state.mask2.tolist() == mask2.tolist()
+
+    def test_initial_state(self):
+        key1 = self.keys('A', 'B', None, 'B')
+        key2 = self.keys('B', 'C', None)
+        state = PartitionState(key1, key2)
+        self.assert_same_as_full(state, key1, key2)
+        assert state.counts() == {'unique_data1': 1, 'unique_data2': 1, 'merge_data1': 3, 'merge_data2': 2}
+
+    def test_append(self):
+        key1 = self.keys('A', 'B')
+        key2 = self.keys('B', 'C', 'C', 'D')
+        state = PartitionState(key1, key2)
+        appended = self.keys('C', 'E')
+        rows = state.update(appended=appended)
+        assert rows.tolist() == [1, 2]
+        self.assert_same_as_full(state, pd.concat([key1, appended], ignore_index=True), key2)
+
+    def test_delete(self):
+        key1 = self.keys('A', 'B', 'B', 'C')
+        key2 = self.keys('B', 'C')
+        state = PartitionState(key1, key2)
+        # Bは1行残るので、ファイル2の分類が変わるのはCだけ
+        rows = state.update(deleted=[1, 3])
+        assert rows.tolist() == [1]
+        self.assert_same_as_full(state, self.keys('A', 'B'), key2)
+
+    def test_delete_and_append(self):
+        key1 = self.keys('A', 'B', None)
+        key2 = self.keys(None, 'B', 'X')
+        state = PartitionState(key1, key2)
+        state.update(appended=self.keys('X', 'Y', None), deleted=[2])
+        self.assert_same_as_full(state, self.keys('A', 'B', 'X', 'Y', None), key2)
+
+    def test_save_and_load(self, tmp_path):
+        key1 = self.keys('A', 'B', None)
+        key2 = self.keys(None, 'B', 'X')
+        PartitionState(key1, key2).save(tmp_path / 'state.npz', {'size1': 10})
+        state, meta = PartitionState.load(tmp_path / 'state.npz')
+        assert meta == {'size1': 10}
+        state.update(appended=self.keys('X', None, 'Z'))
+        self.assert_same_as_full(state, self.keys('A', 'B', None, 'X', None, 'Z'), key2)
+
+    def test_incremental_partition(self, tmp_path):
+        """追記だけなら差分で更新し、それ以外の変更では全体を比較し直す"""
+        path1, path2, state_path = tmp_path / 'master.csv', tmp_path / 'daily.csv', tmp_path / 'state.npz'
+        path1.write_text("ID,名前\n1,山田\n2,佐藤\n", encoding='utf-8')
+        path2.write_text("ID\n2\n3\n", encoding='utf-8')
+
+        def run():
+            (state, incremental), err = incremental_partition(path1, path2, 'ID', 'ID', state_path)
+            assert err is None
+            key1, _ = load_key_column(path1, 'ID')
+            key2, _ = load_key_column(path2, 'ID')
+            self.assert_same_as_full(state, key1, key2)
+            return incremental
+
+        assert run() is False
+        with open(path1, 'a', encoding='utf-8') as f:
+            f.write("3,鈴木\n")
+        assert run() is True
+        # 先頭の行の書き換え
+        path1.write_text(path1.read_text(encoding='utf-8').replace('1,山田', '4,山田'), encoding='utf-8')
+        assert run() is False
+        # 最後の行が改行で終わっていなければ、追記で行が変わった可能性がある
+        path1.write_text("ID,名前\n1,山田\n2", encoding='utf-8')
+        assert run() is False
+        with open(path1, 'a', encoding='utf-8') as f:
+            f.write(",佐藤\n")
+        assert run() is False
+
+    def test_read_appended_keys(self, tmp_path):
+        path = tmp_path / 'master.csv'
+        path.write_text("宛名番号,名前\n0001,山田\n0002,佐藤\n", encoding='utf-8')
+        size = path.stat().st_size
+        digest = file_digest(path)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("0003,鈴木\n,不明\n")
+
+        assert file_digest(path, size=size) == digest
+        key, err = read_appended_keys(path, '宛名番号', size)
+        assert err is None
+        assert key.tolist()[0] == '0003'
+        assert key.isna().tolist() == [False, True]
+
+    def test_read_appended_keys_error(self, tmp_path):
+        path = tmp_path / 'master.csv'
+        path.write_text("宛名番号,名前\n0001,山田\n", encoding='utf-8')
+        size = path.stat().st_size
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("0002,佐藤\n0003,鈴木,余分\n")
+        key, err = read_appended_keys(path, '宛名番号', size)
+        assert key is None
+        assert '行目' in err
+
+
+class TestK3_PartitionPage:
+    """K-3: 比較結果の分類をページ単位で切り出す"""
+
+    def setup_method(self):
+        self.df = pd.DataFrame({
+            '宛名番号': ['0003', '0001', '0012', None, '0002'],
+            '名前': ['鈴木', '山田', '佐藤', '不明', '田中'],
+        })
+        self.mask = np.array([True, True, True, True, False])
+
+    def test_rows_in_file_order(self):
+        assert partition_rows(self.df, self.mask).tolist() == [0, 1, 2, 3]
+
+    def test_search(self):
+        rows = partition_rows(self.df, self.mask, '宛名番号', search='1')
+        assert rows.tolist() == [1, 2]
+
+    def test_search_composite_key(self):
+        rows = partition_rows(self.df, self.mask, ['宛名番号', '名前'], search='田')
+        assert rows.tolist() == [1]
+
+    def test_sort(self):
+        rows = partition_rows(self.df, self.mask, sort_by='宛名番号')
+        assert rows.tolist() == [1, 0, 2, 3]
+        rows = partition_rows(self.df, self.mask, sort_by='宛名番号', ascending=False)
+        assert rows.tolist() == [2, 0, 1, 3]
+
+    def test_page(self):
+        rows = partition_rows(self.df, self.mask, sort_by='宛名番号')
+        assert page_rows(self.df, rows, 0, 3)['名前'].tolist() == ['山田', '鈴木', '佐藤']
+        page = page_rows(self.df, rows, 1, 3)
+        assert page['宛名番号'].tolist() == ['']
+        assert page_rows(self.df, rows, 2, 3).empty
+
+
+# ============================================================
+# L. 処理時間の計測
+# ============================================================
+
+class TestL1_Profiling:
+    """L-1: 工程ごとの処理時間・ピークメモリの計測"""
+
+    def compare(self):
+        df1, _ = load_csv("ID,名前\n1,山田太郎\n2,鈴木花子")
+        df2, _ = load_csv("ID,名前\n1,山田太郎\n3,田中一郎")
+        return convert_df_bom(compare_data(df1, df2, 'ID', 'ID')['unique_data1'])
+
+    def test_report_stages(self):
+        with profiling() as report:
+            self.compare()
+        stages = [entry['stage'] for entry in report]
+        assert stages[:2] == ['load_csv', 'load_csv']
+        assert 'compare_data/match/compare_keys' in stages
+        assert 'compare_data/fillna' in stages
+        assert stages[-1] == 'convert_df_bom'
+        assert all(entry['seconds'] >= 0 for entry in report)
+        assert all('peak_bytes' not in entry for entry in report)
+
+    def test_peak_memory(self):
+        with profiling(memory=True) as report:
+            with stage('outer'):
+                with stage('inner'):
+                    data = bytearray(10 * 2 ** 20)
+                del data
+        outer, inner = report
+        assert inner['stage'] == 'outer/inner'
+        assert inner['peak_bytes'] >= 10 * 2 ** 20
+        assert outer['peak_bytes'] >= inner['peak_bytes']
+
+    def test_peak_memory_with_concurrent_sessions(self):
+        """別のセッションの計測の開始・終了・ピークのリセットで、計測中の値が壊れない"""
+        import contextvars
+        import tracemalloc
+        session1, session2 = contextvars.Context(), contextvars.Context()
+
+        def other_session():
+            with stage('other'):
+                pass
+
+        report = session1.run(start_profiling, True)
+        outer = stage('outer')
+        session1.run(outer.__enter__)
+        data = bytearray(10 * 2 ** 20)
+        del data
+        session2.run(start_profiling, True)
+        session2.run(other_session)
+        session2.run(stop_profiling)
+        assert tracemalloc.is_tracing()
+        session1.run(outer.__exit__, None, None, None)
+        session1.run(stop_profiling)
+        assert not tracemalloc.is_tracing()
+        assert report[0]['peak_bytes'] >= 10 * 2 ** 20
+
+    def test_disabled_by_default(self):
+        with profiling() as report:
+            pass
+        self.compare()
+        assert report == []
+
+    def test_same_result_as_unprofiled(self):
+        expected = self.compare()
+        with profiling(memory=True):
+            assert self.compare() == expected
+
+    def test_add_profile_from_other_thread(self):
+        """別のスレッドで計測したレポートを、現在の工程の下に追記する"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        def job():
+            with profiling() as report:
+                self.compare()
+            return report
+
+        with profiling() as report:
+            with stage('background'):
+                with ThreadPoolExecutor(1) as executor:
+                    add_profile(executor.submit(job).result())
+        stages = [entry['stage'] for entry in report]
+        assert stages[0] == 'background'
+        assert 'background/compare_data/match/compare_keys' in stages
+        add_profile([{'stage': 'x', 'seconds': 0.0}])
+
+
+# ============================================================
+# M. セッション間で共有するキャッシュ
+# ============================================================
+
+class TestM1_ResultCache:
+    """M-1: 合計サイズに上限のある共有キャッシュ"""
+
+    def test_reuses_result(self):
+        cache = ResultCache(1 << 20)
+        calls = []
+        compute = lambda: calls.append(1) or load_csv("ID\n1\n2")
+        first = cache.get_or_compute(('load_csv', 'a'), compute)
+        second = cache.get_or_compute(('load_csv', 'a'), compute)
+        assert second is first
+        assert len(calls) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_evicts_least_recently_used_by_size(self):
+        cache = ResultCache(2500)
+        for key in 'abc':
+            cache.get_or_compute(key, lambda: np.zeros(1000, dtype=np.uint8))
+            if key == 'b':
+                cache.get_or_compute('a', lambda: None)
+        assert 'a' in cache and 'c' in cache and 'b' not in cache
+        assert cache.nbytes == 2000
+
+    def test_oversized_value_not_stored(self):
+        cache = ResultCache(100)
+        value = cache.get_or_compute('big', lambda: np.zeros(1000))
+        assert len(value) == 1000
+        assert len(cache) == 0 and cache.nbytes == 0
+
+    def test_concurrent_requests_compute_once(self):
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+        cache = ResultCache(1 << 20)
+        started = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.wait(1)
+            return np.arange(10)
+
+        with ThreadPoolExecutor(4) as executor:
+            futures = [executor.submit(cache.get_or_compute, 'k', compute) for _ in range(4)]
+            started.set()
+            results = [f.result() for f in futures]
+        assert len(calls) == 1
+        assert all(r is results[0] for r in results)
+
+    def test_failure_not_cached(self):
+        cache = ResultCache(1 << 20)
+
+        def fail():
+            raise ValueError('broken')
+
+        with pytest.raises(ValueError):
+            cache.get_or_compute('k', fail)
+        assert cache.get_or_compute('k', lambda: 1) == 1
+
+    def test_shared_arrays_are_read_only(self):
+        """ある呼び出し元の書き換えが他の呼び出し元の結果に及ばない"""
+        cache = ResultCache(1 << 20)
+        mask1, _ = cache.get_or_compute('masks', lambda: compare_keys(pd.Series(['1', '2']), pd.Series(['1'])))
+        with pytest.raises(ValueError):
+            mask1[0] = False
+
+    def test_estimate_nbytes(self):
+        df, _ = load_csv("ID,名前\n1,山田太郎\n2,鈴木花子")
+        assert estimate_nbytes(df) == df.memory_usage(index=True, deep=True).sum()
+        assert estimate_nbytes([np.zeros(10), np.zeros(5)]) == 120
+
+
+# ============================================================
+# N. Parquet・Featherの入力
+# ============================================================
+
+class TestN1_ColumnarInput:
+    """N-1: Parquet・Featherをキーのカラムだけ読み込んで比較する"""
+
+    def setup_method(self):
+        pytest.importorskip('pyarrow')
+        self.csv = "宛名番号,名前,年齢\n001,山田太郎,30\n002,,41\n003,田中一郎,25"
+        self.df = pd.DataFrame({
+            '宛名番号': ['001', '002', '003'], '名前': ['山田太郎', None, '田中一郎'], '年齢': [30, 41, 25],
+        })
+
+    def write(self, tmp_path, fmt):
+        path = tmp_path / f'input.{fmt}'
+        if fmt == 'parquet':
+            self.df.to_parquet(path)
+        else:
+            self.df.to_feather(path)
+        return path
+
+    @pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+    def test_same_as_csv(self, tmp_path, fmt):
+        """数値も含め、CSVを読み込んだ場合と同じ文字列になる"""
+        path = self.write(tmp_path, fmt)
+        expected, _ = load_csv(self.csv)
+        for source in (path, path.read_bytes(), io.BytesIO(path.read_bytes())):
+            assert columnar_format(source) == fmt
+            assert read_csv_columns(source) == (['宛名番号', '名前', '年齢'], None)
+            df, err = load_csv(source)
+            assert err is None
+            pd.testing.assert_frame_equal(df, expected)
+
+    @pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+    def test_nested_columns_download(self, tmp_path, fmt):
+        """リスト・構造体のカラムもJSONの文字列としてダウンロードできる"""
+        import pyarrow as pa
+        from pyarrow import feather, parquet
+        table = pa.table({
+            '宛名番号': ['001', '002'],
+            'タグ': pa.array([['a', '東京'], None], type=pa.list_(pa.string())),
+            '住所': pa.array([{'市': '横浜', '番地': 1}, {'市': None, '番地': 2}]),
+        })
+        path = tmp_path / f'nested.{fmt}'
+        parquet.write_table(table, path) if fmt == 'parquet' else feather.write_feather(table, path)
+        df = load_rows(path, np.array([True, True]), chunksize=1)
+        assert df['タグ'].tolist() == ['["a", "東京"]', '']
+        assert df['住所'].tolist() == ['{"市": "横浜", "番地": 1}', '{"市": null, "番地": 2}']
+
+    def test_download_cast_error_is_user_facing(self, tmp_path):
+        """文字列にできないカラムは、CSVと同じく表示用のメッセージのValueErrorになる"""
+        import pyarrow as pa
+        from pyarrow import parquet
+        path = tmp_path / 'binary.parquet'
+        parquet.write_table(pa.table({'宛名番号': ['001'], 'データ': pa.array([b'\xff\xfe'])}), path)
+        with pytest.raises(ValueError, match='Parquet読み込みエラー'):
+            list(iter_rows(path, np.array([True])))
+
+    def test_csv_is_not_columnar(self):
+        assert columnar_format(self.csv) is None
+        assert columnar_format(self.csv.encode('utf-8')) is None
+
+    def test_index_column_excluded(self, tmp_path):
+        path = tmp_path / 'indexed.parquet'
+        self.df.set_index(pd.Index([10, 20, 30])).to_parquet(path)
+        assert read_csv_columns(path)[0] == ['宛名番号', '名前', '年齢']
+
+    @pytest.mark.parametrize('fmt', ['parquet', 'feather'])
+    def test_key_column_projection(self, tmp_path, fmt):
+        path = self.write(tmp_path, fmt)
+        calls = []
+        key, err = load_key_column(path, '宛名番号', progress=lambda done, total: calls.append((done, total)))
+        assert err is None
+        assert key.name == '宛名番号' and key.tolist() == ['001', '002', '003']
+        assert calls[-1] == (3, 3)
+        keys, _ = load_key_column(path, ['年齢', '宛名番号'])
+        assert keys.columns.tolist() == ['年齢', '宛名番号']
+
+    def test_rows_for_partition(self, tmp_path):
+        path = self.write(tmp_path, 'parquet')
+        mask = np.array([False, True, True])
+        df = load_rows(path, mask, chunksize=1)
+        assert df.index.tolist() == [1, 2]
+        assert df['名前'].tolist() == ['', '田中一郎']
+        assert load_rows(path, np.zeros(3, dtype=bool)).columns.tolist() == ['宛名番号', '名前', '年齢']
+
+    def test_compare_with_csv(self, tmp_path):
+        path = self.write(tmp_path, 'parquet')
+        key1, _ = load_key_column(path, '宛名番号')
+        key2, _ = load_key_column("宛名番号\n002\n004", '宛名番号')
+        mask1, mask2 = compare_keys(key1, key2)
+        assert mask1.tolist() == [False, True, False]
+        assert mask2.tolist() == [True, False]
+
+    def test_broken_file(self):
+        df, err = load_csv(b'PAR1broken')
+        assert df is None
+        assert 'Parquet読み込みエラー' in err
+
+
 class TestParseErrorDetail:
     """parse_csv_error_detail関数のテスト"""
 